@@ -0,0 +1,53 @@
+-- Turns the flat orderbooks and orders tables into tables range partitioned by day on timestamp, with a
+-- (ticker, timestamp) index that every partition inherits. Run once with the collector stopped:
+--     psql "$DATABASE_URL" -f migrations/001_partition_tick_tables.sql
+-- The old tables stay as orderbooks_flat / orders_flat until 002_drop_flat_tables.sql. Later days are created by
+-- the collector (src/partitions.py), partitions are named <table>_YYYYMMDD and bounded by UTC midnights.
+-- Assumes id columns, where there are any, are serial (a sequence default), not identity columns.
+
+BEGIN;
+
+SET LOCAL TimeZone = 'UTC';
+
+CREATE FUNCTION pg_temp.create_daily_partitions(parent TEXT, first_day DATE, last_day DATE) RETURNS VOID AS $$
+DECLARE
+    day DATE := first_day;
+BEGIN
+    WHILE day <= last_day LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                       parent || '_' || to_char(day, 'YYYYMMDD'), parent, day || ' 00:00:00+00', (day + 1) || ' 00:00:00+00');
+        day := day + 1;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION pg_temp.partition_tick_table(parent TEXT) RETURNS VOID AS $$
+DECLARE
+    flat TEXT := parent || '_flat';
+    seq TEXT;
+    first_day DATE;
+    last_day DATE;
+BEGIN
+    SELECT pg_get_serial_sequence(parent, 'id') INTO seq
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = parent AND column_name = 'id';
+
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', parent, flat);
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)', parent, flat);
+    IF seq IS NOT NULL THEN -- the id sequence moves over, so dropping the flat table later leaves it alone
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, parent);
+    END IF;
+    EXECUTE format('CREATE INDEX %I ON %I (ticker, timestamp)', parent || '_ticker_timestamp', parent);
+
+    EXECUTE format('SELECT min(timestamp)::date, max(timestamp)::date FROM %I', flat) INTO first_day, last_day;
+    PERFORM pg_temp.create_daily_partitions(parent, coalesce(first_day, current_date),
+                                            greatest(last_day, current_date) + 2);
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', parent, flat);
+    EXECUTE format('ANALYZE %I', parent);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT pg_temp.partition_tick_table('orderbooks');
+SELECT pg_temp.partition_tick_table('orders');
+
+COMMIT;
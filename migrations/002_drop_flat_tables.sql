@@ -0,0 +1,9 @@
+-- After 001 and a look at the row counts (SELECT count(*) FROM orderbooks / orderbooks_flat, same for orders):
+--     psql "$DATABASE_URL" -f migrations/002_drop_flat_tables.sql
+
+BEGIN;
+
+DROP TABLE orderbooks_flat;
+DROP TABLE orders_flat;
+
+COMMIT;
@@ -0,0 +1,290 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from logs import get_logger, fields, should_sample
+
+logger = get_logger("aggregates")
+
+INTERVALS = (1, 60) # seconds
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS book_bars (
+    ticker TEXT NOT NULL,
+    bar_seconds INTEGER NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    bid_open DOUBLE PRECISION,
+    bid_close DOUBLE PRECISION,
+    ask_open DOUBLE PRECISION,
+    ask_close DOUBLE PRECISION,
+    mid_open DOUBLE PRECISION,
+    mid_high DOUBLE PRECISION,
+    mid_low DOUBLE PRECISION,
+    mid_close DOUBLE PRECISION,
+    spread_sum DOUBLE PRECISION,
+    updates INTEGER NOT NULL,
+    PRIMARY KEY (ticker, bar_seconds, timestamp)
+);
+CREATE TABLE IF NOT EXISTS trade_bars (
+    ticker TEXT NOT NULL,
+    bar_seconds INTEGER NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    open DOUBLE PRECISION,
+    high DOUBLE PRECISION,
+    low DOUBLE PRECISION,
+    close DOUBLE PRECISION,
+    quantity DOUBLE PRECISION,
+    volume DOUBLE PRECISION,
+    trades INTEGER NOT NULL,
+    PRIMARY KEY (ticker, bar_seconds, timestamp)
+);
+"""
+
+# a bar can be written more than once (a flush of a stale bar that gets more updates, a restart mid bar),
+# so rows are merged instead of replaced
+UPSERT_BOOK_BARS = """
+INSERT INTO book_bars (ticker, bar_seconds, timestamp, bid_open, bid_close, ask_open, ask_close,
+                       mid_open, mid_high, mid_low, mid_close, spread_sum, updates)
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+ON CONFLICT (ticker, bar_seconds, timestamp) DO UPDATE SET
+    bid_close = EXCLUDED.bid_close,
+    ask_close = EXCLUDED.ask_close,
+    mid_high = GREATEST(book_bars.mid_high, EXCLUDED.mid_high),
+    mid_low = LEAST(book_bars.mid_low, EXCLUDED.mid_low),
+    mid_close = EXCLUDED.mid_close,
+    spread_sum = book_bars.spread_sum + EXCLUDED.spread_sum,
+    updates = book_bars.updates + EXCLUDED.updates
+"""
+
+UPSERT_TRADE_BARS = """
+INSERT INTO trade_bars (ticker, bar_seconds, timestamp, open, high, low, close, quantity, volume, trades)
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+ON CONFLICT (ticker, bar_seconds, timestamp) DO UPDATE SET
+    high = GREATEST(trade_bars.high, EXCLUDED.high),
+    low = LEAST(trade_bars.low, EXCLUDED.low),
+    close = EXCLUDED.close,
+    quantity = trade_bars.quantity + EXCLUDED.quantity,
+    volume = trade_bars.volume + EXCLUDED.volume,
+    trades = trade_bars.trades + EXCLUDED.trades
+"""
+
+# the same bars rebuilt from the raw tables for one range of whole buckets; they replace what is there, so a rerun
+# gives the same rows. $1 bar seconds, $2/$3 the range
+BACKFILL_BOOK_BARS = """
+INSERT INTO book_bars (ticker, bar_seconds, timestamp, bid_open, bid_close, ask_open, ask_close,
+                       mid_open, mid_high, mid_low, mid_close, spread_sum, updates)
+SELECT ticker, $1::integer, bucket,
+       (array_agg(bid ORDER BY timestamp))[1], (array_agg(bid ORDER BY timestamp DESC))[1],
+       (array_agg(ask ORDER BY timestamp))[1], (array_agg(ask ORDER BY timestamp DESC))[1],
+       (array_agg((bid + ask) / 2 ORDER BY timestamp))[1], max((bid + ask) / 2), min((bid + ask) / 2),
+       (array_agg((bid + ask) / 2 ORDER BY timestamp DESC))[1], sum(ask - bid), count(*)
+FROM (
+    SELECT ticker, timestamp,
+           to_timestamp(floor(extract(epoch FROM timestamp)::double precision / $1::integer) * $1::integer) AS bucket,
+           (bids::jsonb -> 0 ->> 'price')::double precision AS bid,
+           (asks::jsonb -> 0 ->> 'price')::double precision AS ask
+    FROM orderbooks
+    WHERE timestamp >= $2 AND timestamp < $3
+) books
+WHERE bid IS NOT NULL AND ask IS NOT NULL
+GROUP BY ticker, bucket
+ON CONFLICT (ticker, bar_seconds, timestamp) DO UPDATE SET
+    bid_open = EXCLUDED.bid_open,
+    bid_close = EXCLUDED.bid_close,
+    ask_open = EXCLUDED.ask_open,
+    ask_close = EXCLUDED.ask_close,
+    mid_open = EXCLUDED.mid_open,
+    mid_high = EXCLUDED.mid_high,
+    mid_low = EXCLUDED.mid_low,
+    mid_close = EXCLUDED.mid_close,
+    spread_sum = EXCLUDED.spread_sum,
+    updates = EXCLUDED.updates
+"""
+
+BACKFILL_TRADE_BARS = """
+INSERT INTO trade_bars (ticker, bar_seconds, timestamp, open, high, low, close, quantity, volume, trades)
+SELECT ticker, $1::integer, bucket,
+       (array_agg(price ORDER BY timestamp))[1], max(price), min(price), (array_agg(price ORDER BY timestamp DESC))[1],
+       sum(quantity), sum(volume), count(*)
+FROM (
+    SELECT ticker, timestamp, price, quantity, volume,
+           to_timestamp(floor(extract(epoch FROM timestamp)::double precision / $1::integer) * $1::integer) AS bucket
+    FROM orders
+    WHERE timestamp >= $2 AND timestamp < $3
+) trades
+GROUP BY ticker, bucket
+ON CONFLICT (ticker, bar_seconds, timestamp) DO UPDATE SET
+    open = EXCLUDED.open,
+    high = EXCLUDED.high,
+    low = EXCLUDED.low,
+    close = EXCLUDED.close,
+    quantity = EXCLUDED.quantity,
+    volume = EXCLUDED.volume,
+    trades = EXCLUDED.trades
+"""
+
+
+async def ensure_tables(conn):
+    await conn.execute(CREATE_TABLES)
+
+
+class BarAggregator:
+    # incremental bars next to the raw inserts: one open bar per (ticker, interval), a bar is closed and queued for
+    # writing when the first update of a later bucket arrives, or one full interval after its bucket ended
+    def __init__(self, intervals=INTERVALS):
+        self.intervals = intervals
+        self.book_bars = {} # (ticker, interval) -> list of book bar fields
+        self.trade_bars = {}
+        self.book_rows = []
+        self.trade_rows = []
+
+    @staticmethod
+    def _bucket(ts, interval):
+        return ts - ts % interval
+
+    def on_book(self, ticker, timestamp, bid, ask):
+        if bid is None or ask is None:
+            return
+        ts = timestamp.timestamp()
+        mid = (bid + ask) / 2
+        spread = ask - bid
+        for interval in self.intervals:
+            bucket = self._bucket(ts, interval)
+            bar = self.book_bars.get((ticker, interval))
+            if bar is not None and bar[0] != bucket:
+                self.book_rows.append(self._row(ticker, interval, bar))
+                bar = None
+            if bar is None:
+                # bucket, bid open/close, ask open/close, mid open/high/low/close, spread sum, updates
+                self.book_bars[(ticker, interval)] = [bucket, bid, bid, ask, ask, mid, mid, mid, mid, spread, 1]
+                continue
+            bar[2] = bid
+            bar[4] = ask
+            if mid > bar[6]:
+                bar[6] = mid
+            if mid < bar[7]:
+                bar[7] = mid
+            bar[8] = mid
+            bar[9] += spread
+            bar[10] += 1
+
+    def on_trade(self, ticker, timestamp, price, quantity, volume):
+        ts = timestamp.timestamp()
+        for interval in self.intervals:
+            bucket = self._bucket(ts, interval)
+            bar = self.trade_bars.get((ticker, interval))
+            if bar is not None and bar[0] != bucket:
+                self.trade_rows.append(self._row(ticker, interval, bar))
+                bar = None
+            if bar is None:
+                # bucket, open, high, low, close, quantity, volume, trades
+                self.trade_bars[(ticker, interval)] = [bucket, price, price, price, price, quantity, volume, 1]
+                continue
+            if price > bar[2]:
+                bar[2] = price
+            if price < bar[3]:
+                bar[3] = price
+            bar[4] = price
+            bar[5] += quantity
+            bar[6] += volume
+            bar[7] += 1
+
+    @staticmethod
+    def _row(ticker, interval, bar):
+        return (ticker, interval, datetime.fromtimestamp(bar[0], timezone.utc), *bar[1:])
+
+    def close_idle(self, now=None):
+        # bars of quiet tickers would otherwise stay open until their next update
+        now = time.time() if now is None else now
+        for bars, rows in ((self.book_bars, self.book_rows), (self.trade_bars, self.trade_rows)):
+            for (ticker, interval), bar in list(bars.items()):
+                if now >= bar[0] + 2 * interval:
+                    rows.append(self._row(ticker, interval, bar))
+                    del bars[(ticker, interval)]
+
+    async def flush(self, conn):
+        book_rows, self.book_rows = self.book_rows, []
+        trade_rows, self.trade_rows = self.trade_rows, []
+        if book_rows:
+            await conn.executemany(UPSERT_BOOK_BARS, book_rows)
+        if trade_rows:
+            await conn.executemany(UPSERT_TRADE_BARS, trade_rows)
+        return len(book_rows) + len(trade_rows)
+
+    async def run_writer(self, conn, interval=1.0):
+        # batched writes, one executemany per table per interval
+        while True:
+            await asyncio.sleep(interval)
+            self.close_idle()
+            try:
+                rows = await self.flush(conn)
+                if rows and should_sample("bars_flushed", 60):
+                    logger.info("Flushed bars", extra=fields(rows=rows, sampled_every=60))
+            except Exception as e:
+                logger.error("Error while writing bars", extra=fields(error=repr(e)))
+
+
+async def backfill_bars(conn, day, intervals=INTERVALS):
+    # bars of one UTC day (one partition of the raw tables) rebuilt from orderbooks and orders, for days collected
+    # before the aggregator ran or whose bars were lost. Only for days the collector is done with: a live flush
+    # would be merged on top of the rebuilt bar. Books stored as orderbook_deltas only get trade bars
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    rows = 0
+    for interval in intervals:
+        for query in (BACKFILL_BOOK_BARS, BACKFILL_TRADE_BARS):
+            status = await conn.execute(query, interval, start, end)
+            rows += int(status.split()[-1])
+    logger.info("Backfilled bars", extra=fields(day=str(day), rows=rows))
+    return rows
+
+
+def _benchmark():
+    import random
+
+    aggregator = BarAggregator()
+    rng = random.Random(0)
+    start_ts = datetime(2026, 10, 19, 10, tzinfo=timezone.utc).timestamp()
+    n = 500_000 # book updates, 10 per second for each of 50 tickers
+    stamps = [datetime.fromtimestamp(start_ts + i * 0.002, timezone.utc) for i in range(n)]
+
+    start = time.perf_counter()
+    for i, timestamp in enumerate(stamps):
+        bid = 10 + rng.randint(0, 20) / 100
+        aggregator.on_book(f"SR{270 + 10 * (i % 50)}CG6D", timestamp, bid, bid + 0.05)
+        if i % 10 == 0:
+            aggregator.on_trade(f"SR{270 + 10 * (i % 50)}CG6D", timestamp, bid, 1, bid * 100)
+    elapsed = time.perf_counter() - start
+    aggregator.close_idle(now=stamps[-1].timestamp() + 3600)
+    minute_bars = sum(row[1] == 60 for row in aggregator.book_rows)
+    print(f"{n} book updates: {elapsed / n * 1e6:.2f} us each, 1s book bars: {len(aggregator.book_rows) - minute_bars}, "
+          f"1m book bars: {minute_bars}, trade bars: {len(aggregator.trade_rows)}")
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    if len(sys.argv) > 1:
+        # backfill of past days from the raw tables: python src/aggregates.py 2026-10-01 [2026-10-18]
+        import asyncpg
+        from datetime import date
+        from dotenv import load_dotenv
+        from logs import setup_logging
+
+        async def main(first, last):
+            conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+            try:
+                await ensure_tables(conn)
+                day = first
+                while day <= last:
+                    print(f"{day}: {await backfill_bars(conn, day)} bars")
+                    day += timedelta(days=1)
+            finally:
+                await conn.close()
+
+        load_dotenv()
+        setup_logging(level=os.getenv("LOG_LEVEL", "INFO"))
+        first = date.fromisoformat(sys.argv[1])
+        asyncio.run(main(first, date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else first))
+    else:
+        _benchmark()
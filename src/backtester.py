@@ -1,50 +1,197 @@
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 from dotenv import load_dotenv
 import os
-from sqlalchemy import create_engine
-
-
-
-def load_datasets(db_url, ticker):
+import json
+import time
+import hashlib
+import inspect
+import itertools
+import zipfile
+from functools import lru_cache
+from sqlalchemy import create_engine, text, bindparam
+from order_book import OrderBook
+from book_codec import decode_rows
+import metrics
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "backtest_cache")
+
+ORDERBOOK_COLUMNS = ["id", "ticker", "timestamp", "bids", "asks"]
+ORDERBOOK_DELTA_COLUMNS = ["ticker", "payload", "id", "timestamp"] # ticker, payload first for decode_rows
+ORDERS_COLUMNS = ["ticker", "timestamp", "side", "volume", "price", "quantity"]
+BOOK_BAR_COLUMNS = ["ticker", "timestamp", "bid_open", "bid_close", "ask_open", "ask_close",
+                    "mid_open", "mid_high", "mid_low", "mid_close", "spread_sum", "updates"]
+TRADE_BAR_COLUMNS = ["ticker", "timestamp", "open", "high", "low", "close", "quantity", "volume", "trades"]
+
+
+@lru_cache(maxsize=None)
+def get_engine(db_url, pool_size=5, max_overflow=5):
+    # one pooled engine per url for the whole process instead of a new one per load
     try:
-        engine = create_engine(db_url)
+        return create_engine(
+            db_url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True,
+            pool_recycle=1800
+        )
     except Exception as e:
         print("Exception while connecting to db")
         raise
 
-    columns = ["id", "ticker", "timestamp", "bids", "asks"]
 
-    query = f"""
+def build_query(table, columns, tickers, start=None, end=None, order_by=("ticker", "timestamp"), **equals):
+    # (ticker, timestamp) filters, so the planner can use an index on them, plus optional column = value ones
+    conditions = ["ticker IN :tickers"]
+    params = {"tickers": list(tickers)}
+    for column, value in equals.items():
+        conditions.append(f"{column} = :{column}")
+        params[column] = value
+    if start is not None:
+        conditions.append("timestamp >= :start")
+        params["start"] = pd.Timestamp(start).to_pydatetime()
+    if end is not None:
+        conditions.append("timestamp < :end")
+        params["end"] = pd.Timestamp(end).to_pydatetime()
+
+    query = text(f"""
     SELECT {', '.join(columns)}
-    FROM orderbooks
-    WHERE ticker = '{ticker}'
-    """
+    FROM {table}
+    WHERE {' AND '.join(conditions)}
+    ORDER BY {', '.join(order_by)}
+    """).bindparams(bindparam("tickers", expanding=True))
+
+    return query, params
+
+
+def get_tickers(db_url, table="orderbooks"):
+    query = text(f"SELECT DISTINCT ticker FROM {table}")
+    with get_engine(db_url).connect() as conn:
+        return [row[0] for row in conn.execute(query)]
+
+
+LAST_KEYFRAME_QUERY = text("""
+SELECT min(last_keyframe) FROM (
+    SELECT max(timestamp) AS last_keyframe
+    FROM orderbook_deltas
+    WHERE keyframe AND ticker IN :tickers AND timestamp < :start
+    GROUP BY ticker
+) keyframes
+""").bindparams(bindparam("tickers", expanding=True))
+
+
+def stream_orderbook_deltas(conn, tickers, start=None, end=None, chunk_size=10_000):
+    # orderbook_deltas rows (book_codec.py) decoded while the server streams them, yields (id, ticker, timestamp,
+    # bids, asks) one book at a time with bids/asks as (ticks, quantity). Deltas have to be applied in write order:
+    # rows come by (ticker, timestamp, id), the id breaks timestamp ties. Reading starts at the last keyframe before
+    # `start`, so the first books of the window are complete; rows before `start` only rebuild the state
+    read_from = start
+    if start is not None:
+        params = {"tickers": list(tickers), "start": pd.Timestamp(start).to_pydatetime()}
+        read_from = conn.execute(LAST_KEYFRAME_QUERY, params).scalar() or start
+        start = pd.Timestamp(start)
+
+    query, params = build_query("orderbook_deltas", ORDERBOOK_DELTA_COLUMNS, tickers, read_from, end,
+                                order_by=("ticker", "timestamp", "id"))
+    result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query, params)
+    in_window = set() # tickers past `start`, no more timestamp comparisons for them
+    for row, bids, asks in decode_rows(result):
+        ticker = row[0]
+        if start is not None and ticker not in in_window:
+            timestamp = pd.Timestamp(row[3])
+            if (timestamp.tzinfo is None) != (start.tzinfo is None):
+                timestamp = timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC").tz_localize(None)
+            if timestamp < start:
+                continue
+            in_window.add(ticker)
+        yield row[2], ticker, row[3], bids, asks
+
 
-    option_df = pd.read_sql_query(query, con=engine)
+def prepare_orderbooks(option_df, tick_levels=False):
     option_df['timestamp'] = pd.to_datetime(option_df['timestamp'])
     option_df.set_index('timestamp', inplace=True)
 
-    option_df['best_bid'] = option_df['bids'].apply(lambda bids: bids[0]['price'] if bids else None)
-    option_df['best_ask'] = option_df['asks'].apply(lambda asks: asks[0]['price'] if asks else None)
+    # same parsing as the live engine, one OrderBook reused for every row
+    book = OrderBook()
+    set_levels = book.set_tick_levels if tick_levels else book.set_levels
+    best_bid, best_ask, microprice, imbalance = [], [], [], []
+    for bids, asks in zip(option_df['bids'], option_df['asks']):
+        set_levels(bids, asks)
+        best_bid.append(book.best_bid)
+        best_ask.append(book.best_ask)
+        microprice.append(book.microprice)
+        imbalance.append(book.imbalance(levels=book.depth))
+
+    option_df['best_bid'] = pd.to_numeric(pd.Series(best_bid, index=option_df.index, dtype=object))
+    option_df['best_ask'] = pd.to_numeric(pd.Series(best_ask, index=option_df.index, dtype=object))
     option_df['mid_price'] = option_df['best_bid'] + (option_df['best_ask'] - option_df['best_bid']) / 2
     option_df['spread'] = option_df['best_ask'] - option_df['best_bid']
+    option_df['microprice'] = pd.to_numeric(pd.Series(microprice, index=option_df.index, dtype=object))
+    option_df['imbalance'] = imbalance
+    return option_df
 
-    columns = ["timestamp", "side", "volume", "price", "quantity"]
-
-    query = f"""
-    SELECT {', '.join(columns)}
-    FROM orders
-    WHERE ticker = '{ticker}'
-    """
 
-    orders_df = pd.read_sql_query(query, con=engine)
+def prepare_orders(orders_df):
     orders_df['timestamp'] = pd.to_datetime(orders_df['timestamp'])
     orders_df.set_index('timestamp', inplace=True)
 
     orders_df['price'] = orders_df['volume'] / orders_df['price']
+    return orders_df
+
+
+def load_many_datasets(db_url, tickers, start=None, end=None, book_storage="json"):
+    # one query per table for all tickers, split client-side into {ticker: (option_df, orders_df)};
+    # book_storage "delta" reads the books from orderbook_deltas (collector with BOOK_STORAGE=delta)
+    engine = get_engine(db_url)
+    tickers = list(dict.fromkeys(tickers))
+    tick_levels = book_storage == "delta"
+
+    book_query, book_params = build_query("orderbooks", ORDERBOOK_COLUMNS, tickers, start, end)
+    orders_query, orders_params = build_query("orders", ORDERS_COLUMNS, tickers, start, end)
+
+    with engine.connect() as conn:
+        if tick_levels:
+            books = pd.DataFrame.from_records(stream_orderbook_deltas(conn, tickers, start, end), columns=ORDERBOOK_COLUMNS)
+        else:
+            books = pd.read_sql_query(book_query, con=conn, params=book_params)
+        orders = pd.read_sql_query(orders_query, con=conn, params=orders_params)
+
+    books_by_ticker = dict(tuple(books.groupby("ticker", sort=False)))
+    orders_by_ticker = dict(tuple(orders.groupby("ticker", sort=False)))
+
+    datasets = {}
+    for ticker in tickers:
+        option_df = books_by_ticker.get(ticker, books.iloc[0:0]).copy()
+        orders_df = orders_by_ticker.get(ticker, orders.iloc[0:0]).copy()
+        datasets[ticker] = (
+            prepare_orderbooks(option_df, tick_levels),
+            prepare_orders(orders_df.drop(columns="ticker"))
+        )
+    return datasets
+
+
+def load_datasets(db_url, ticker, start=None, end=None, book_storage="json"):
+    return load_many_datasets(db_url, [ticker], start, end, book_storage)[ticker]
+
 
-    return option_df, orders_df
+def load_day(db_url, tickers, day, book_storage="json"):
+    # [day, next day) in UTC, the same bounds as the daily partitions, so each table scans one partition
+    start = pd.Timestamp(day).tz_localize(None).normalize().tz_localize("UTC")
+    return load_many_datasets(db_url, tickers, start, start + pd.Timedelta(days=1), book_storage)
+
+
+def load_bars(db_url, tickers, kind="trade", bar_seconds=60, start=None, end=None):
+    # bars maintained by the collector (aggregates.py), {ticker: df}; kind is "book" or "trade", bars are 1s or 60s
+    table, columns = ("book_bars", BOOK_BAR_COLUMNS) if kind == "book" else ("trade_bars", TRADE_BAR_COLUMNS)
+    query, params = build_query(table, columns, tickers, start, end, bar_seconds=bar_seconds)
+    with get_engine(db_url).connect() as conn:
+        bars = pd.read_sql_query(query, con=conn, params=params)
+
+    bars['timestamp'] = pd.to_datetime(bars['timestamp'])
+    if kind == "book":
+        bars['spread_mean'] = bars['spread_sum'] / bars['updates']
+    return {ticker: df.drop(columns="ticker").set_index("timestamp") for ticker, df in bars.groupby("ticker", sort=False)}
 
 def generate_orders_simple(best_ask, best_bid, order_size, inventory, inventory_limit, inventory_k=0):
 
@@ -101,7 +248,13 @@ def generate_orders_simple(best_ask, best_bid, order_size, inventory, inventory_
         orders.append(ask_order)
     return orders if orders else None
 
-def run_backtest(option_df, orders_df, fee=0.02, plot=False):
+STRATEGIES = {"simple": generate_orders_simple}
+DEFAULT_PARAMS = {"fee": 0.02, "order_size": 1000, "inventory_limit": 100000, "inventory_k": 0}
+INITIAL_BALANCE = 10000
+
+
+def merge_data(option_df, orders_df):
+    # every trade with the last book before it
     orders_df = orders_df.sort_index()
     option_df = option_df.sort_index()
     option_df = option_df.groupby(level=0).last()
@@ -118,17 +271,26 @@ def run_backtest(option_df, orders_df, fee=0.02, plot=False):
         direction="backward"
         )
     df.set_index("timestamp", inplace=True)
+    return option_df, df
 
+
+def simulate(df, strategy="simple", fee=0.02, order_size=1000, inventory_limit=100000, inventory_k=0):
+    # the backtest loop over merge_data output, results as arrays: balance/equity per fill (and the final
+    # liquidation), inventory and mid per trade row, fills split by side
+    generate_orders = STRATEGIES[strategy]
     inventory = 0
-    initial_balance = 10000
-    balance = initial_balance
+    balance = INITIAL_BALANCE
     balance_arr = []
     timestamp_arr = []
     buy_prices_arr = []
     sell_prices_arr = []
+    buy_quantities = []
+    sell_quantities = []
     buy_timestamps = []
     sell_timestamps = []
     inventory_arr = []
+    inventory_timestamps = []
+    mid_arr = []
     equity_arr = []
 
     for row in df.itertuples():
@@ -140,18 +302,22 @@ def run_backtest(option_df, orders_df, fee=0.02, plot=False):
         executed_volume = row.volume
         mid = (best_bid + best_ask) /2
 
-        orders = generate_orders_simple(
+        orders = generate_orders(
             best_ask,
             best_bid,
-            order_size = 1000,
+            order_size=order_size,
             inventory=inventory,
-            inventory_limit=100000,
+            inventory_limit=inventory_limit,
+            inventory_k=inventory_k,
         )
 
         inventory_arr.append(inventory)
+        inventory_timestamps.append(row.Index)
+        mid_arr.append(mid)
 
         if row.Index == df.index[-1]:
             balance += inventory * best_bid - fee * inventory * best_bid
+            sell_quantities.append(inventory)
             inventory = 0
             balance_arr.append(balance)
             timestamp_arr.append(row.Index)
@@ -186,6 +352,7 @@ def run_backtest(option_df, orders_df, fee=0.02, plot=False):
                 balance_arr.append(balance)
                 timestamp_arr.append(row.Index)
                 sell_prices_arr.append(ask_order_price)
+                sell_quantities.append(fill_quantity)
                 sell_timestamps.append(row.Index)
                 equity_arr.append(balance + inventory * mid)
         elif row.side == "SELL":
@@ -207,44 +374,195 @@ def run_backtest(option_df, orders_df, fee=0.02, plot=False):
                 balance_arr.append(balance)
                 timestamp_arr.append(row.Index)
                 buy_prices_arr.append(bid_order_price)
+                buy_quantities.append(fill_quantity)
                 buy_timestamps.append(row.Index)
                 equity_arr.append(balance + inventory * mid)
 
-    if plot:
-        fig, axs = plt.subplots(2, 3, figsize=(12, 8))
-        axs[0, 0].plot(timestamp_arr, balance_arr)
-        axs[0, 0].grid()
-        axs[0, 0].set_title("Balance over time")
-        axs[0, 0].tick_params(axis='x', labelrotation=45)
+    return {
+        "timestamp": np.array(timestamp_arr, dtype="datetime64[us]"),
+        "balance": np.array(balance_arr, dtype=float),
+        "equity": np.array(equity_arr, dtype=float),
+        "inventory_timestamp": np.array(inventory_timestamps, dtype="datetime64[us]"),
+        "inventory": np.array(inventory_arr, dtype=float),
+        "mid": np.array(mid_arr, dtype=float),
+        "buy_timestamp": np.array(buy_timestamps, dtype="datetime64[us]"),
+        "buy_price": np.array(buy_prices_arr, dtype=float),
+        "buy_quantity": np.array(buy_quantities, dtype=float),
+        "sell_timestamp": np.array(sell_timestamps, dtype="datetime64[us]"),
+        "sell_price": np.array(sell_prices_arr, dtype=float),
+        "sell_quantity": np.array(sell_quantities, dtype=float),
+    }
+
+
+def total_return(result):
+    equity = result["equity"]
+    return (equity[-1] - INITIAL_BALANCE)/INITIAL_BALANCE if len(equity) != 0 else 0
+
 
-        axs[0, 1].plot(option_df.index, option_df["mid_price"], color="black")
-        axs[0, 1].scatter(buy_timestamps, buy_prices_arr, color="green", marker="^")
-        axs[0, 1].scatter(sell_timestamps,sell_prices_arr, color="red", marker="v")
-        axs[0, 1].set_title("Trades")
-        axs[0, 1].tick_params(axis='x', labelrotation=45)
-        axs[0, 1].grid()
+def book_mids(option_df):
+    # mid of every book update on merge_data's time axis, markouts look it up at any time after a fill
+    mid = option_df["mid_price"].dropna().sort_index()
+    times = pd.to_datetime(mid.index).tz_localize(None).astype("datetime64[us]")
+    return times.to_numpy(), mid.to_numpy(dtype=float)
 
-        axs[1, 0].plot(df.index, inventory_arr)
-        axs[1, 0].set_title("Inventory over time")
-        axs[1, 0].tick_params(axis='x', labelrotation=45)
-        axs[1, 0].grid()
 
-        axs[1, 1].scatter(df.index, df['spread'])
-        axs[1, 1].set_title("Spread over time")
-        axs[1, 1].tick_params(axis='x', labelrotation=45)
-        axs[1, 1].grid()
+def summarize(result, mid_times=None, mids=None):
+    return {
+        "return": float(total_return(result)),
+        "trades": int(len(result["buy_price"]) + len(result["sell_price"])),
+        **metrics.backtest_metrics(result, INITIAL_BALANCE, mid_times, mids),
+    }
+
+
+def plot_result(result, option_df):
+    fig, axs = plt.subplots(2, 3, figsize=(12, 8))
+    axs[0, 0].plot(result["timestamp"], result["balance"])
+    axs[0, 0].grid()
+    axs[0, 0].set_title("Balance over time")
+    axs[0, 0].tick_params(axis='x', labelrotation=45)
+
+    axs[0, 1].plot(option_df.index, option_df["mid_price"], color="black")
+    axs[0, 1].scatter(result["buy_timestamp"], result["buy_price"], color="green", marker="^")
+    axs[0, 1].scatter(result["sell_timestamp"], result["sell_price"], color="red", marker="v")
+    axs[0, 1].set_title("Trades")
+    axs[0, 1].tick_params(axis='x', labelrotation=45)
+    axs[0, 1].grid()
 
-        axs[0, 2].plot(timestamp_arr, equity_arr)
-        axs[0, 2].grid()
-        axs[0, 2].set_title("Equity over time (inventory value is based on mid price)")
-        axs[0, 2].tick_params(axis='x', labelrotation=45)
+    axs[1, 0].plot(result["inventory_timestamp"], result["inventory"])
+    axs[1, 0].set_title("Inventory over time")
+    axs[1, 0].tick_params(axis='x', labelrotation=45)
+    axs[1, 0].grid()
 
+    axs[1, 1].scatter(option_df.index, option_df['spread'])
+    axs[1, 1].set_title("Spread over time")
+    axs[1, 1].tick_params(axis='x', labelrotation=45)
+    axs[1, 1].grid()
 
-        plt.tight_layout()
-        plt.show()
+    axs[0, 2].plot(result["timestamp"], result["equity"])
+    axs[0, 2].grid()
+    axs[0, 2].set_title("Equity over time (inventory value is based on mid price)")
+    axs[0, 2].tick_params(axis='x', labelrotation=45)
 
-    return (equity_arr[-1] - initial_balance)/initial_balance  if len(equity_arr) != 0  else 0
 
+    plt.tight_layout()
+    plt.show()
+
+
+def run_backtest(option_df, orders_df, fee=0.02, plot=False):
+    option_df, df = merge_data(option_df, orders_df)
+    result = simulate(df, fee=fee)
+    if plot:
+        plot_result(result, option_df)
+    return total_return(result)
+
+
+def data_watermark(option_df, orders_df):
+    # the tick tables are append only: row counts and last timestamps change whenever the data does
+    parts = []
+    for frame in (option_df, orders_df):
+        parts.append(f"{len(frame)}:{frame.index.max() if len(frame) else None}")
+    if "id" in option_df.columns and len(option_df):
+        parts.append(f"id:{option_df['id'].max()}")
+    return "|".join(parts)
+
+
+def code_version(*functions):
+    # source of everything that shapes a result, editing the loop or a strategy invalidates old results
+    digest = hashlib.sha256()
+    for function in functions:
+        digest.update(inspect.getsource(function).encode())
+    return digest.hexdigest()[:16]
+
+
+class BacktestCache:
+    # content addressed results on disk: one .npz per (ticker, data watermark, strategy, params, code version)
+    # holding the raw simulate arrays only, metrics are computed from them after loading so editing summarize or
+    # metrics never serves stale numbers. A hit refreshes the file's mtime, eviction drops the least recently used
+    # files once the directory is over max_bytes
+    def __init__(self, directory=CACHE_DIR, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(ticker, watermark, strategy, params, version):
+        payload = json.dumps([ticker, watermark, strategy, params, version], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        # result arrays or None
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        arrays.pop("summary", None) # files written before summaries were left out
+        return arrays
+
+    def put(self, key, result):
+        path = self.path(key)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **result)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def run_sweep(datasets, param_grid, strategy="simple", cache=None):
+    # every ticker of {ticker: (option_df, orders_df)} against every combination of param_grid ({name: [values]},
+    # unset params take DEFAULT_PARAMS); returns (summary df with one row per cell, {(ticker, params): result})
+    names = list(param_grid)
+    # every step between the raw rows and the result arrays, editing any of them invalidates cached results;
+    # summarize and metrics are not cached, they run on every cell
+    version = code_version(load_many_datasets, stream_orderbook_deltas, decode_rows, OrderBook, prepare_orderbooks,
+                           prepare_orders, merge_data, simulate, STRATEGIES[strategy])
+    rows, results = [], {}
+    for ticker, (option_df, orders_df) in datasets.items():
+        watermark = data_watermark(option_df, orders_df)
+        mid_times, mids = book_mids(option_df)
+        merged = None
+        for values in itertools.product(*(param_grid[name] for name in names)):
+            params = {**DEFAULT_PARAMS, **dict(zip(names, values))}
+            key = BacktestCache.key(ticker, watermark, strategy, params, version)
+            start = time.perf_counter()
+            cached = result = cache.get(key) if cache is not None else None
+            if result is None:
+                if merged is None:
+                    merged = merge_data(option_df, orders_df)[1]
+                result = simulate(merged, strategy, **params)
+                if cache is not None:
+                    cache.put(key, result)
+            summary = summarize(result, mid_times, mids)
+            results[(ticker, values)] = result
+            rows.append({"ticker": ticker, **dict(zip(names, values)), **summary, "cached": cached is not None,
+                         "seconds": time.perf_counter() - start})
+
+    summary = pd.DataFrame(rows)
+    hits = int(summary["cached"].sum()) if len(summary) else 0
+    print(f"sweep: {len(summary)} cells, {hits} from cache, {len(summary) - hits} computed in "
+          f"{summary['seconds'].sum() if len(summary) else 0:.2f} s")
+    return summary, results
 
 
 def main():
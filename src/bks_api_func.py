@@ -13,7 +13,10 @@ import json
 import threading
 import os
 import pandas as pd
-import time
+import asyncio
+import aiohttp
+from instruments import InstrumentCatalog
+from loop_monitor import offload
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), "..")
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -32,111 +35,34 @@ def get_last_bid_and_ask(ticker):
 
     return {'ask':ask, 'bid':bid}
 
-def get_option_maturity_date(token, stock_ticker, option_ticker, sleep_time=5, size=100):
-    url = "https://be.broker.ru/trade-api-information-service/api/v1/instruments/by-type"
-
-    session = requests.Session()
-    session.headers.update({
-        "Accept": "application/json",
-        "Authorization": f"Bearer {token}"
-    })
-
-    page = 0
-    results = []
-    while True:
-        params = {
-            "type": "OPTIONS",
-            "baseAssetTicker": stock_ticker,
-            "size": size,
-            "page":page
-        }
-
-        response = session.get(url, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-        if not data:
-            break
-
-        results.extend(data)
-        page += 1
-        print(page, end=' ')
-        time.sleep(sleep_time)
-    print("")
-    df = pd.DataFrame(results)
-    settlement_date = df.loc[df["ticker"] == option_ticker, "maturityDate"].values[0]
-    date = datetime.strptime(settlement_date, "%Y%m%d")
-    return date
-
-def get_option_data_by_ticker(token, stock_ticker, option_ticker, sleep_time=5, size=100):
-    url = "https://be.broker.ru/trade-api-information-service/api/v1/instruments/by-type"
-
-    session = requests.Session()
-    session.headers.update({
-        "Accept": "application/json",
-        "Authorization": f"Bearer {token}"
-    })
-
-    page = 0
-    results = []
-    while True:
-        params = {
-            "type": "OPTIONS",
-            "baseAssetTicker": stock_ticker,
-            "size": size,
-            "page": page
-        }
-
-        response = session.get(url, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-        if not data:
-            break
-
-        results.extend(data)
-        page += 1
-        print(page, end=' ')
-        time.sleep(sleep_time)
-    print("")
-    df = pd.DataFrame(results)
-    info = df.loc[df["ticker"] == option_ticker].values[0]
+def load_instrument_catalog(token, stock_ticker, sleep_time=0.25, size=100, force=False):
+    # local snapshot if it is fresh, otherwise pages are fetched concurrently under a rate limit;
+    # runs its own event loop, code already on one awaits load_instrument_catalog_async
+    catalog = InstrumentCatalog(stock_ticker)
+    return asyncio.run(catalog.refresh(token, force=force, page_size=size, min_interval=sleep_time))
+
+async def load_instrument_catalog_async(session, token, stock_ticker, sleep_time=0.25, size=100, force=False):
+    catalog = InstrumentCatalog(stock_ticker)
+    return await catalog.load(session, token, force=force, page_size=size, min_interval=sleep_time)
+
+def get_option_maturity_date(token, stock_ticker, option_ticker, sleep_time=0.25, size=100):
+    catalog = load_instrument_catalog(token, stock_ticker, sleep_time, size)
+    return catalog.maturity_date(option_ticker)
+
+def get_option_data_by_ticker(token, stock_ticker, option_ticker, sleep_time=0.25, size=100):
+    catalog = load_instrument_catalog(token, stock_ticker, sleep_time, size)
+    option = catalog.get(option_ticker)
+    if option is None:
+        print(f"Option {option_ticker} is not in the catalog, None is returned")
+        return None
+    info = pd.Series(option["record"]).values
 
     return info
 
-def find_option_ticker_by_expiry_date(token, stock_ticker, start_date, end_date,  sleep_time=5, size=100):
-    url = "https://be.broker.ru/trade-api-information-service/api/v1/instruments/by-type"
-
-    session = requests.Session()
-    session.headers.update({
-        "Accept": "application/json",
-        "Authorization": f"Bearer {token}"
-    })
-
-    page = 0
-    results = []
-    while True:
-        params = {
-            "type": "OPTIONS",
-            "baseAssetTicker": stock_ticker,
-            "size": size,
-            "page": page
-        }
-
-        response = session.get(url, params=params, timeout=10)
-        response.raise_for_status()
+def find_option_ticker_by_expiry_date(token, stock_ticker, start_date, end_date,  sleep_time=0.25, size=100):
+    catalog = load_instrument_catalog(token, stock_ticker, sleep_time, size)
 
-        data = response.json()
-        if not data:
-            break
-
-        results.extend(data)
-        page += 1
-        print(page, end=' ')
-        time.sleep(sleep_time)
-    print("")
-
-    df = pd.DataFrame(results)
+    df = pd.DataFrame(catalog.records)
     df.to_csv("restilts.csv")
 
     return df.loc[
@@ -409,18 +335,32 @@ def get_current_inventory(token):
     return inventory
 
 def price_option_using_bs(token, spot_ticker, option_ticker):
+    async def price():
+        async with aiohttp.ClientSession() as session:
+            return await price_option_using_bs_async(session, token, spot_ticker, option_ticker)
+    return asyncio.run(price())
+
+async def price_option_using_bs_async(session, token, spot_ticker, option_ticker):
+    # for code on an event loop: the binomial tree is tens of ms of CPU, it runs in the process pool instead
     try:
         from black_scholes import solve_black_scholes
     except:
         print("Couldnt find BS script, NONE is returned")
         return None
 
-    spot_price = get_current_price(token, spot_ticker, class_code="TQBR")
-    expiry = get_option_maturity_date(token, spot_ticker, option_ticker)
-    strike_price = float(option_ticker[2:5])
+    if spot_ticker in order_books: # start_order_book_ws keeps it fresh, no need for a candles request
+        quote = get_last_bid_and_ask(spot_ticker)
+        spot_price = (quote['bid'] + quote['ask']) / 2
+    else:
+        spot_price = await asyncio.to_thread(get_current_price, token, spot_ticker, class_code="TQBR")
+    catalog = await load_instrument_catalog_async(session, token, spot_ticker)
+    option = catalog.get(option_ticker)
+    if option is None:
+        print(f"Option {option_ticker} is not in the catalog, None is returned")
+        return None
     eval_date = datetime.now()
 
-    solution = solve_black_scholes(spot_price, strike_price, 0.15, 0.2, expiry, eval_date)
+    solution = await offload(solve_black_scholes, spot_price, option["strike"], 0.15, 0.2, option["expiry"], eval_date, option["option_type"])
 
     return solution
 
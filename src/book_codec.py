@@ -0,0 +1,170 @@
+import struct
+from order_book import price_to_ticks, ticks_to_price
+
+# payload layouts, little endian:
+#   keyframe: header (kind=1, n_bids, n_asks, 0), then (ticks int32, quantity int32) per level, bids first
+#   delta:    header (kind=0, n_bids, n_asks, n_changes), then (level code uint8, tick change int16, quantity int32)
+#             per changed level; level code = side << 7 | index, side 0 bids / 1 asks, tick change vs the same level
+HEADER = struct.Struct("<BBBB")
+LEVEL = struct.Struct("<ii")
+CHANGE = struct.Struct("<Bhi")
+KEYFRAME, DELTA = 1, 0
+
+# partitioned by day like orderbooks, partitions come from partitions.ensure_partitions
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS orderbook_deltas (
+    id BIGSERIAL,
+    ticker TEXT NOT NULL,
+    class_code TEXT,
+    timestamp TIMESTAMPTZ NOT NULL,
+    keyframe BOOLEAN NOT NULL,
+    payload BYTEA NOT NULL,
+    bid_volume DOUBLE PRECISION,
+    ask_volume DOUBLE PRECISION
+) PARTITION BY RANGE (timestamp);
+CREATE INDEX IF NOT EXISTS orderbook_deltas_ticker_timestamp ON orderbook_deltas (ticker, timestamp);
+"""
+
+
+def to_levels(levels):
+    return [(price_to_ticks(level["price"]), int(level["quantity"])) for level in levels]
+
+
+def from_levels(levels):
+    return [{"price": ticks_to_price(ticks), "quantity": quantity} for ticks, quantity in levels]
+
+
+class BookEncoder:
+    # keeps the last book per ticker; a full keyframe every `keyframe_interval` updates bounds how far a reader has
+    # to go back, everything in between is the levels that changed
+    def __init__(self, keyframe_interval=100):
+        self.keyframe_interval = keyframe_interval
+        self.state = {} # ticker -> (bids, asks, updates since keyframe)
+
+    def encode(self, ticker, bids, asks):
+        # bids/asks as in the websocket message, returns (is keyframe, payload bytes)
+        bids, asks = to_levels(bids), to_levels(asks)
+        previous = self.state.get(ticker)
+        if previous is not None and previous[2] < self.keyframe_interval:
+            payload = self._delta(previous[0], previous[1], bids, asks)
+            if payload is not None:
+                self.state[ticker] = (bids, asks, previous[2] + 1)
+                return False, payload
+        self.state[ticker] = (bids, asks, 1)
+        return True, self._keyframe(bids, asks)
+
+    def reset(self, ticker=None):
+        # after a lost write: the next book of the ticker (of every ticker with None) is a keyframe again
+        if ticker is None:
+            self.state.clear()
+        else:
+            self.state.pop(ticker, None)
+
+    @staticmethod
+    def _keyframe(bids, asks):
+        parts = [HEADER.pack(KEYFRAME, len(bids), len(asks), 0)]
+        parts += [LEVEL.pack(ticks, quantity) for ticks, quantity in bids]
+        parts += [LEVEL.pack(ticks, quantity) for ticks, quantity in asks]
+        return b"".join(parts)
+
+    @staticmethod
+    def _delta(old_bids, old_asks, bids, asks):
+        changes = []
+        for side, old, new in ((0, old_bids, bids), (1, old_asks, asks)):
+            for i, level in enumerate(new):
+                old_level = old[i] if i < len(old) else (0, 0)
+                if level == old_level:
+                    continue
+                tick_change = level[0] - old_level[0]
+                if not -32768 <= tick_change <= 32767:
+                    return None # does not fit, a keyframe goes instead
+                changes.append(CHANGE.pack(side << 7 | i, tick_change, level[1]))
+        if len(changes) > 255:
+            return None
+        return HEADER.pack(DELTA, len(bids), len(asks), len(changes)) + b"".join(changes)
+
+
+class BookDecoder:
+    # streaming counterpart of BookEncoder: payloads of one ticker have to come in the order they were written;
+    # deltas before the first keyframe of a ticker cannot be applied and are skipped (decode returns None).
+    # Levels come back as (ticks, quantity) for OrderBook.set_tick_levels, from_levels() makes message style dicts
+    def __init__(self):
+        self.state = {} # ticker -> [bids, asks] as lists of (ticks, quantity)
+
+    def decode(self, ticker, payload):
+        kind, n_bids, n_asks, n_changes = HEADER.unpack_from(payload)
+        if kind == KEYFRAME:
+            levels = [LEVEL.unpack_from(payload, HEADER.size + i * LEVEL.size) for i in range(n_bids + n_asks)]
+            bids, asks = levels[:n_bids], levels[n_bids:]
+            self.state[ticker] = [bids, asks]
+            return bids, asks
+
+        state = self.state.get(ticker)
+        if state is None:
+            return None
+        bids = state[0][:n_bids] + [(0, 0)] * (n_bids - len(state[0]))
+        asks = state[1][:n_asks] + [(0, 0)] * (n_asks - len(state[1]))
+        for code, tick_change, quantity in CHANGE.iter_unpack(payload[HEADER.size:HEADER.size + n_changes * CHANGE.size]):
+            levels = asks if code >> 7 else bids
+            i = code & 0x7F
+            levels[i] = (levels[i][0] + tick_change, quantity)
+        self.state[ticker] = [bids, asks]
+        return bids, asks
+
+
+def decode_rows(rows):
+    # rows of (ticker, payload, ...) ordered by timestamp per ticker; yields (row, bids, asks) one at a time,
+    # the level lists are replaced on every update, never mutated, so they can be kept
+    decoder = BookDecoder()
+    for row in rows:
+        book = decoder.decode(row[0], bytes(row[1]))
+        if book is not None:
+            yield row, book[0], book[1]
+
+
+if __name__ == "__main__":
+    import json
+    import random
+    import time
+
+    # a day of depth-5 books for one ticker: most updates touch one or two levels
+    rng = random.Random(0)
+    bids = [{"price": round(10.0 - i * 0.01, 2), "quantity": rng.randint(1, 50)} for i in range(5)]
+    asks = [{"price": round(10.05 + i * 0.01, 2), "quantity": rng.randint(1, 50)} for i in range(5)]
+    books = []
+    for _ in range(200_000):
+        side = rng.choice((bids, asks))
+        i = rng.randrange(5)
+        side[i] = {**side[i], "quantity": rng.randint(1, 50)}
+        if rng.random() < 0.1:
+            shift = rng.choice((-0.01, 0.01))
+            bids = [{**level, "price": round(level["price"] + shift, 2)} for level in bids]
+            asks = [{**level, "price": round(level["price"] + shift, 2)} for level in asks]
+        books.append(([dict(level) for level in bids], [dict(level) for level in asks]))
+
+    json_rows = [(json.dumps(b), json.dumps(a)) for b, a in books]
+    json_size = sum(len(b) + len(a) for b, a in json_rows)
+
+    encoder = BookEncoder()
+    start = time.perf_counter()
+    encoded = [("SR310CG6D",) + encoder.encode("SR310CG6D", b, a)[::-1] for b, a in books]
+    encode_rate = len(books) / (time.perf_counter() - start)
+    codec_size = sum(len(payload) for ticker, payload, keyframe in encoded)
+
+    start = time.perf_counter()
+    for b, a in json_rows:
+        json.loads(b), json.loads(a)
+    json_rate = len(books) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    decoded = [(bids, asks) for row, bids, asks in decode_rows(encoded)]
+    codec_rate = len(books) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    as_dicts = [(from_levels(bids), from_levels(asks)) for bids, asks in decoded]
+    dict_rate = len(books) / (time.perf_counter() - start + len(books) / codec_rate)
+
+    assert as_dicts == [(b, a) for b, a in books], "round trip mismatch"
+    print(f"{len(books)} books: json {json_size / 2**20:.1f} MB, delta {codec_size / 2**20:.1f} MB "
+          f"({json_size / codec_size:.1f}x smaller); decode json {json_rate:,.0f}/s, delta {codec_rate:,.0f}/s "
+          f"({dict_rate:,.0f}/s as dicts); encode {encode_rate:,.0f}/s")
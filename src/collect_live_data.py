@@ -1,4 +1,11 @@
 from mm_engine import BrokerClient
+from instruments import InstrumentCatalog
+from universe import UniverseManager
+from aggregates import BarAggregator, ensure_tables
+import book_codec
+import partitions
+from logs import setup_logging, get_logger, fields, should_sample
+import loop_monitor
 import os
 import json
 import asyncio
@@ -6,39 +13,25 @@ import asyncpg
 from datetime import datetime
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
-RESTART_TIME = 7200
 DEPTH = 5
+BOOK_STORAGE = os.getenv("BOOK_STORAGE", "json") # "delta": books go to orderbook_deltas, ~18x smaller (book_codec.py)
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS")) if os.getenv("RETENTION_DAYS") else None # older days go to parquet
 
-postfix_list = [
-    "CS6",
-    "CG6D", #07-22
-    "CS6D",
-    "CG6E", #07-29
-    "CS6E",
-    "CH6",
-    "CT6" # 08-19
-]
-
-ticker = "SR"
-min_strike = 270
-max_strike = 370
-strike_step = 10
-
-strike = min_strike
-INSTRUMENTS = []
-while strike < max_strike:
-    for postfix in postfix_list:
-        option_ticker = ticker + str(strike) + postfix
-        INSTRUMENTS.append({"ticker": option_ticker, "classCode": "OPTSPOT"})
-    strike += strike_step
+UNDERLYING = "SBER"
+N_EXPIRIES = 4
+MONEYNESS = 0.15 # strikes within +-15% of spot
+UNIVERSE_INTERVAL = 600
+
+logger = get_logger("collector")
 
 
 async def connect_db():
-    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
-    return conn
+    # a pool: raw inserts and bar writes run concurrently, a single asyncpg connection allows one query at a time
+    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"), min_size=2, max_size=4)
+    return pool
 
 
-async def save_orderbook(q_orderbooks, conn):
+async def save_orderbook(q_orderbooks, conn, aggregator, encoder=None):
 
     while True:
         try:
@@ -47,35 +40,64 @@ async def save_orderbook(q_orderbooks, conn):
 
                 timestamp = datetime.fromisoformat(data["dateTime"].replace("Z", "+00:00"))
 
-                await conn.execute(
-                    """
-                    INSERT INTO orderbooks (
-                        ticker,
-                        class_code,
+                if encoder is not None:
+                    keyframe, payload = encoder.encode(data["ticker"], data["bids"], data["asks"])
+                    await conn.execute(
+                        """
+                        INSERT INTO orderbook_deltas (
+                            ticker,
+                            class_code,
+                            timestamp,
+                            keyframe,
+                            payload,
+                            bid_volume,
+                            ask_volume
+                        )
+                        VALUES ($1,$2,$3,$4,$5,$6,$7)
+                        """,
+                        data["ticker"],
+                        data["classCode"],
                         timestamp,
-                        bids,
-                        asks,
-                        bid_volume,
-                        ask_volume
+                        keyframe,
+                        payload,
+                        data["bidVolume"],
+                        data["askVolume"]
                     )
-                    VALUES ($1,$2,$3,$4,$5,$6,$7)
-                    """,
-                    data["ticker"],
-                    data["classCode"],
-                    timestamp,
-                    json.dumps(data["bids"]),
-                    json.dumps(data["asks"]),
-                    data["bidVolume"],
-                    data["askVolume"]
-                )
+                else:
+                    await conn.execute(
+                        """
+                        INSERT INTO orderbooks (
+                            ticker,
+                            class_code,
+                            timestamp,
+                            bids,
+                            asks,
+                            bid_volume,
+                            ask_volume
+                        )
+                        VALUES ($1,$2,$3,$4,$5,$6,$7)
+                        """,
+                        data["ticker"],
+                        data["classCode"],
+                        timestamp,
+                        json.dumps(data["bids"]),
+                        json.dumps(data["asks"]),
+                        data["bidVolume"],
+                        data["askVolume"]
+                    )
+                bids, asks = data["bids"], data["asks"]
+                aggregator.on_book(data["ticker"], timestamp, bids[0]["price"] if bids else None, asks[0]["price"] if asks else None)
 
-                print(f"Updated order book {data['ticker']}")
+                if should_sample("orderbook_saved", 500):
+                    logger.info("Saved order book", extra=fields(ticker=data['ticker'], sampled_every=500))
 
         except Exception as e:
-            print(f"Error while saving: orderbook {e}")
+            logger.error("Error while saving orderbook", extra=fields(error=repr(e)))
+            if encoder is not None:
+                encoder.reset() # the failed row may have been the base of the next deltas
             await asyncio.sleep(10)
 
-async def save_orderflow(q_orderflow, conn):
+async def save_orderflow(q_orderflow, conn, aggregator):
     while True:
         try:
             data = await q_orderflow.get()
@@ -103,12 +125,14 @@ async def save_orderflow(q_orderflow, conn):
                     data["price"],
                     data["quantity"]
                 )
+                aggregator.on_trade(data["ticker"], timestamp, data["price"], data["quantity"], data["volume"])
 
-                print(f"Updated orderflow{data['ticker']}")
+                if should_sample("orderflow_saved", 100):
+                    logger.info("Saved orderflow", extra=fields(ticker=data['ticker'], sampled_every=100))
 
 
         except Exception as e:
-            print(f"Error while saving orderflow: {e}")
+            logger.error("Error while saving orderflow", extra=fields(error=repr(e)))
             await asyncio.sleep(10)
 
 async def run():
@@ -116,42 +140,76 @@ async def run():
     client = BrokerClient(token)
 
     conn = await connect_db()
+    await ensure_tables(conn)
+    aggregator = BarAggregator() # 1s and 1m bars in book_bars / trade_bars
+    encoder = None
+    if BOOK_STORAGE == "delta":
+        await conn.execute(book_codec.CREATE_TABLE)
+        encoder = book_codec.BookEncoder() # new per run: the first book of every ticker is a keyframe
+    await partitions.ensure_partitions(conn) # before the first insert, the maintenance task keeps days ahead
 
     while True:
         try:
             await client.start()
             break
         except Exception as e:
-            print(f"Exception while starting a client {e}")
+            logger.error("Exception while starting a client", extra=fields(error=repr(e)))
             await asyncio.sleep(10)
 
-    save_orderflow_task = asyncio.create_task(save_orderflow(client.q_orderflow, conn))
-    save_orderbook_task = asyncio.create_task(save_orderbook(client.q_orderbooks, conn))
-
-    order_flow_task = asyncio.create_task(client.start_orderflow_ws(instruments=INSTRUMENTS))
-    order_book_task = asyncio.create_task(client.start_order_book_ws(instruments=INSTRUMENTS, depth=DEPTH))
-
+    catalog = InstrumentCatalog(UNDERLYING) # snapshot on disk, the api is only hit once it expires
+    await catalog.load(client.session, client.access_token)
+
+    spot_task = asyncio.create_task(client.start_spot_ws(instruments=[{"ticker": UNDERLYING, "classCode": "TQBR"}]))
+    universe = UniverseManager(client, catalog, underlying=UNDERLYING, n_expiries=N_EXPIRIES, moneyness=MONEYNESS, interval=UNIVERSE_INTERVAL)
+    instruments = await universe.initialize()
+    universe_task = asyncio.create_task(universe.run())
+    token_task = asyncio.create_task(client.start_token_refresher()) # no periodic cold restarts needed
+    loop_lag_task = asyncio.create_task(loop_monitor.LoopLagMonitor(latency=client.latency).run())
+
+    save_orderflow_task = asyncio.create_task(save_orderflow(client.q_orderflow, conn, aggregator))
+    save_orderbook_task = asyncio.create_task(save_orderbook(client.q_orderbooks, conn, aggregator, encoder))
+    bars_task = asyncio.create_task(aggregator.run_writer(conn))
+    partitions_task = asyncio.create_task(partitions.run_maintenance(conn, retention_days=RETENTION_DAYS))
+
+    order_flow_task = asyncio.create_task(client.start_orderflow_ws(instruments=instruments))
+    order_book_task = asyncio.create_task(client.start_order_book_ws(instruments=instruments, depth=DEPTH))
+
+    tasks = [
+        save_orderflow_task,
+        save_orderbook_task,
+        bars_task,
+        partitions_task,
+        order_flow_task,
+        order_book_task,
+        spot_task,
+        universe_task,
+        token_task,
+        loop_lag_task
+    ]
     try:
-        await asyncio.gather(
-            save_orderflow_task,
-            save_orderbook_task,
-            order_flow_task,
-            order_book_task
-        )
+        await asyncio.gather(*tasks)
 
     finally:
+        # gather gives up on the first failure but leaves the siblings running, they would outlive the pool
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         await client.close()
+        await conn.close()
 
 async def main():
     while True:
         try:
-            print("Started")
-            await asyncio.wait_for(run(),timeout=RESTART_TIME)
+            logger.info("Started")
+            # no RESTART_TIME bound any more: it was a cold restart to get a fresh token, the token refresher
+            # does that in place now, so run() only returns on a failure
+            await run()
 
-        except Exception as e:
-            print(f"Exception in main loop {e}")
+        except Exception:
+            logger.exception("Exception in main loop")
             await asyncio.sleep(10)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging(level=os.getenv("LOG_LEVEL", "INFO"))
+    loop_monitor.run(main(), use_uvloop=os.getenv("USE_UVLOOP") == "1")
 
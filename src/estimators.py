@@ -0,0 +1,229 @@
+import math
+import time
+import numpy as np
+import pandas as pd
+from order_book import TICK_SIZE
+
+
+class RealizedVolatility:
+    # rolling realized volatility of the mid over the last `window` changes, in price units per sqrt(second)
+    def __init__(self, window=300, min_observations=30):
+        self.window = window
+        self.min_observations = min_observations
+        self.sq_changes = np.zeros(window)
+        self.dts = np.zeros(window)
+        self.head = 0
+        self.count = 0
+        self.sum_sq = 0.0
+        self.sum_dt = 0.0
+        self.last_mid = None
+        self.last_t = None
+
+    def update(self, t, mid): # t in seconds
+        if mid is None:
+            return
+        if self.last_mid is None or t <= self.last_t:
+            if self.last_mid is None:
+                self.last_t = t
+            self.last_mid = mid
+            return
+
+        sq_change = (mid - self.last_mid) ** 2
+        dt = t - self.last_t
+
+        i = self.head
+        self.sum_sq += sq_change - self.sq_changes[i]
+        self.sum_dt += dt - self.dts[i]
+        self.sq_changes[i] = sq_change
+        self.dts[i] = dt
+        self.head = (i + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+
+        self.last_mid = mid
+        self.last_t = t
+
+    @property
+    def sigma(self):
+        if self.count < self.min_observations or self.sum_dt <= 0:
+            return None
+        return math.sqrt(max(self.sum_sq, 0.0) / self.sum_dt)
+
+
+class TradeIntensity:
+    # Avellaneda-Stoikov arrival rate lambda(delta) = A * exp(-k * delta), delta being the distance of a trade from mid.
+    # Trades are counted into fixed distance buckets with exponential time decay, so memory is constant
+    # and the fit is a least squares over the buckets
+    def __init__(self, bucket_ticks=1, n_buckets=50, halflife=600.0, min_trades=20):
+        self.bucket_size = bucket_ticks * TICK_SIZE
+        self.n_buckets = n_buckets
+        self.tau = halflife / math.log(2)
+        self.min_trades = min_trades
+        self.counts = np.zeros(n_buckets)
+        self.deltas = (np.arange(n_buckets)) * self.bucket_size
+        self.exposure = 0.0 # decayed observation time in seconds
+        self.trades = 0
+        self.last_t = None
+        self._fit = None
+
+    def _decay(self, t):
+        if self.last_t is None:
+            self.last_t = t
+            return
+        dt = t - self.last_t
+        if dt <= 0:
+            return
+        decay = math.exp(-dt / self.tau)
+        self.counts *= decay
+        self.exposure = self.exposure * decay + self.tau * (1 - decay)
+        self.last_t = t
+
+    def update(self, t, trade_price, mid):
+        if mid is None:
+            return
+        self._decay(t)
+        bucket = min(int(abs(trade_price - mid) / self.bucket_size), self.n_buckets - 1)
+        self.counts[bucket] += 1
+        self.trades += 1
+        self._fit = None
+
+    def fit(self):
+        if self._fit is not None:
+            return self._fit
+        if self.trades < self.min_trades or self.exposure <= 0:
+            return None
+        # rate of trades reaching at least delta away from mid
+        rates = np.cumsum(self.counts[::-1])[::-1] / self.exposure
+        self._fit = fit_exponential_intensity(self.deltas, rates)
+        return self._fit
+
+    @property
+    def k(self):
+        fit = self.fit()
+        return fit[1] if fit else None
+
+    @property
+    def A(self):
+        fit = self.fit()
+        return fit[0] if fit else None
+
+
+def fit_exponential_intensity(deltas, rates):
+    # log(rate) = log(A) - k * delta, only buckets that saw trades
+    mask = rates > 0
+    if mask.sum() < 2:
+        return None
+    slope, intercept = np.polyfit(deltas[mask], np.log(rates[mask]), 1)
+    k = -slope
+    if k <= 0:
+        return None
+    return math.exp(intercept), k
+
+
+def calibrate_volatility(option_df):
+    # batch counterpart of RealizedVolatility over a whole order book history
+    mid = option_df["mid_price"].dropna()
+    mid = mid[~mid.index.duplicated(keep="last")]
+    if len(mid) < 2:
+        return None
+    seconds = (mid.index - mid.index[0]).total_seconds()
+    elapsed = seconds[-1]
+    if elapsed <= 0:
+        return None
+    return math.sqrt(float(np.sum(np.diff(mid.to_numpy()) ** 2)) / elapsed)
+
+
+def calibrate_intensity(option_df, orders_df, bucket_ticks=1, n_buckets=50):
+    # batch counterpart of TradeIntensity: distance of every trade from the last known mid
+    books = option_df[["mid_price"]].dropna().sort_index()
+    books = books[~books.index.duplicated(keep="last")]
+    trades = orders_df[["price"]].sort_index()
+    if books.empty or trades.empty:
+        return None
+
+    book_times = books.index.to_numpy()
+    trade_times = trades.index.to_numpy()
+    idx = np.searchsorted(book_times, trade_times, side="right") - 1
+    valid = idx >= 0
+    deltas = np.abs(trades["price"].to_numpy()[valid] - books["mid_price"].to_numpy()[idx[valid]])
+
+    bucket_size = bucket_ticks * TICK_SIZE
+    buckets = np.minimum((deltas / bucket_size).astype(np.int64), n_buckets - 1)
+    counts = np.bincount(buckets, minlength=n_buckets).astype(np.float64)
+
+    elapsed = (trade_times[-1] - min(trade_times[0], book_times[0])) / np.timedelta64(1, "s")
+    if elapsed <= 0:
+        return None
+    rates = np.cumsum(counts[::-1])[::-1] / elapsed
+    return fit_exponential_intensity(np.arange(n_buckets) * bucket_size, rates)
+
+
+def validate_estimators(option_df, orders_df, halflife=None):
+    # replays the history through the streaming estimators and compares their final state with the batch fit
+    books = option_df["mid_price"].dropna()
+    trades = orders_df["price"]
+    events = pd.concat([
+        pd.DataFrame({"mid": books.to_numpy(), "price": np.nan}, index=books.index),
+        pd.DataFrame({"mid": np.nan, "price": trades.to_numpy()}, index=trades.index),
+    ]).sort_index(kind="stable")
+
+    elapsed = (events.index[-1] - events.index[0]).total_seconds() if len(events) else 0.0
+    volatility = RealizedVolatility(window=max(len(books), 1))
+    intensity = TradeIntensity(halflife=halflife or max(elapsed, 1.0) * 1e6) # no decay unless asked
+
+    start = events.index[0] if len(events) else None
+    mid = None
+    for t, row_mid, row_price in zip(events.index, events["mid"].to_numpy(), events["price"].to_numpy()):
+        seconds = (t - start).total_seconds()
+        if not math.isnan(row_mid):
+            mid = row_mid
+            volatility.update(seconds, mid)
+        elif mid is not None:
+            intensity.update(seconds, row_price, mid)
+
+    return {
+        "sigma_streaming": volatility.sigma,
+        "sigma_batch": calibrate_volatility(option_df),
+        "intensity_streaming": intensity.fit(),
+        "intensity_batch": calibrate_intensity(option_df, orders_df),
+    }
+
+
+if __name__ == "__main__":
+    from order_book import OrderBook
+    from signals import BookSignals
+
+    n = 200_000
+    rng = np.random.default_rng(0)
+    mids = 10 + np.cumsum(rng.choice([-0.01, 0.0, 0.01], size=n))
+    trade_prices = mids + rng.exponential(0.05, size=n) * rng.choice([-1, 1], size=n)
+
+    volatility = RealizedVolatility()
+    intensity = TradeIntensity()
+    book = OrderBook("BENCH")
+    signals = BookSignals()
+    levels = [[{"price": m - 0.01 * i, "quantity": 5} for i in range(5)] for m in mids[:1000]]
+    asks = [[{"price": m + 0.05 + 0.01 * i, "quantity": 3} for i in range(5)] for m in mids[:1000]]
+
+    start = time.perf_counter()
+    for i in range(n):
+        volatility.update(i * 0.1, mids[i])
+    volatility_ns = (time.perf_counter() - start) / n * 1e9
+
+    start = time.perf_counter()
+    for i in range(n):
+        intensity.update(i * 0.1, trade_prices[i], mids[i])
+    intensity_ns = (time.perf_counter() - start) / n * 1e9
+
+    start = time.perf_counter()
+    for i in range(n):
+        book.set_levels(levels[i % 1000], asks[i % 1000])
+        signals.update(book)
+    book_ns = (time.perf_counter() - start) / n * 1e9
+
+    start = time.perf_counter()
+    fit = intensity.fit()
+    fit_us = (time.perf_counter() - start) * 1e6
+
+    print(f"RealizedVolatility.update: {volatility_ns:.0f} ns/event, sigma={volatility.sigma:.5f}")
+    print(f"TradeIntensity.update: {intensity_ns:.0f} ns/event, fit {fit_us:.0f} us, A={fit[0]:.3f} k={fit[1]:.2f}")
+    print(f"OrderBook.set_levels + BookSignals.update: {book_ns:.0f} ns/event")
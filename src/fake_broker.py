@@ -0,0 +1,207 @@
+import asyncio
+import random
+import time
+import uuid
+from aiohttp import web
+from logs import setup_logging, get_logger, fields
+
+logger = get_logger("fake_broker")
+
+ORDERS_PATH = "/trade-api-bff-operations/api/v1/orders"
+
+
+class FakeBroker:
+    # local stand-in for the REST side of the broker API, BrokerClient(token, rest_url=broker.url) talks to it;
+    # every request waits `latency` seconds and fails with 503 with probability `failure_rate`, or is carried out but
+    # still answered with 503 with probability `lost_rate` (the response lost on the way back)
+    def __init__(self, latency=0.0, failure_rate=0.0, lost_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lost_rate = lost_rate
+        self.random = random.Random(seed)
+        self.orders = {}
+        self.positions = {} # ticker -> quantity, what the portfolio endpoint reports
+        self.market_data_ws = [] # open market data sockets, the test pushes messages or closes them
+        self.orders_ws = [] # open order transaction sockets, likewise
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_post("/trade-api-keycloak/realms/tradeapi/protocol/openid-connect/token", self.token)
+        self.app.router.add_post(ORDERS_PATH, self.place)
+        self.app.router.add_post(ORDERS_PATH + "/{id}/cancel", self.cancel)
+        self.app.router.add_post(ORDERS_PATH + "/{id}", self.edit)
+        self.app.router.add_get(ORDERS_PATH + "/{id}", self.status)
+        self.app.router.add_post("/trade-api-bff-order-details/api/v1/orders/search", self.search)
+        self.app.router.add_get("/trade-api-bff-portfolio/api/v1/portfolio", self.portfolio)
+        self.app.router.add_get("/trade-api-market-data-connector/api/v1/market-data/ws", self.market_data)
+        self.app.router.add_get(ORDERS_PATH + "/transaction/ws", self.order_transactions)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return web.Response(status=503, text="service unavailable")
+        response = await handler(request)
+        if self.lost_rate and self.random.random() < self.lost_rate:
+            return web.Response(status=503, text="service unavailable")
+        return response
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        logger.info("Fake broker started", extra=fields(url=self.url))
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def token(self, request):
+        return web.json_response({"access_token": str(uuid.uuid4()), "expires_in": 3600})
+
+    async def place(self, request):
+        payload = await request.json()
+        order_id = payload["clientOrderId"]
+        if order_id in self.orders:
+            return web.Response(status=409, text="duplicate clientOrderId")
+        self.orders[order_id] = {
+            "clientOrderId": order_id,
+            "ticker": payload["ticker"],
+            "classCode": payload["classCode"],
+            "side": payload["side"],
+            "price": payload["price"],
+            "orderQuantity": payload["orderQuantity"],
+            "remainedQuantity": payload["orderQuantity"],
+            "orderStatus": "0"
+        }
+        return web.json_response({"clientOrderId": order_id})
+
+    async def cancel(self, request):
+        order = self.orders.pop(request.match_info["id"], None)
+        if order is None:
+            return web.Response(status=404, text="order not found")
+        return web.json_response({"clientOrderId": (await request.json())["clientOrderId"]})
+
+    async def edit(self, request):
+        order = self.orders.pop(request.match_info["id"], None)
+        if order is None:
+            return web.Response(status=404, text="order not found")
+        payload = await request.json()
+        order = {**order, "clientOrderId": payload["clientOrderId"], "price": payload["price"],
+                 "orderQuantity": payload["orderQuantity"], "remainedQuantity": payload["orderQuantity"]}
+        self.orders[order["clientOrderId"]] = order
+        return web.json_response({"clientOrderId": order["clientOrderId"]})
+
+    async def status(self, request):
+        order = self.orders.get(request.match_info["id"])
+        if order is None:
+            return web.Response(status=404, text="order not found")
+        return web.json_response({"data": order})
+
+    async def search(self, request):
+        return web.json_response({"records": list(self.orders.values())})
+
+    async def market_data(self, request):
+        return await self._test_driven_ws(request, self.market_data_ws)
+
+    async def order_transactions(self, request):
+        return await self._test_driven_ws(request, self.orders_ws)
+
+    async def _test_driven_ws(self, request, sockets):
+        # subscriptions are accepted and ignored, messages only come from the test
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sockets.append(ws)
+        try:
+            async for msg in ws:
+                pass
+        finally:
+            sockets.remove(ws)
+        return ws
+
+    async def portfolio(self, request):
+        return web.json_response([{"ticker": ticker, "quantity": quantity} for ticker, quantity in self.positions.items() if quantity])
+
+
+async def time_to_flat(n_orders=100, latency=0.02, failure_rate=0.05):
+    from mm_engine import BrokerClient
+
+    broker = FakeBroker(latency=latency, failure_rate=failure_rate, seed=1)
+    url = await broker.start()
+    client = BrokerClient("fake", rest_url=url)
+    await client.start()
+
+    async def place_orders():
+        await asyncio.gather(*(client.place_limit_order(f"SR{270 + 10 * (i % 10)}CG6D", "OPTSPOT", 1 + i % 2, 10.0, 1)
+                               for i in range(n_orders)))
+
+    try:
+        await place_orders()
+        start = time.perf_counter()
+        for order_id in list(client.active_orders):
+            await client.cancel_order(order_id, retry_delay=0.2)
+        serial = time.perf_counter() - start
+
+        await place_orders()
+        start = time.perf_counter()
+        failed = await client.kill("benchmark")
+        concurrent = time.perf_counter() - start
+    finally:
+        await client.close()
+        await broker.stop()
+
+    print(f"{n_orders} orders, {latency * 1e3:.0f} ms latency, {failure_rate:.0%} failures: "
+          f"serial cancel {serial * 1e3:.0f} ms, cancel_all {concurrent * 1e3:.0f} ms, "
+          f"left open {len(failed)} (broker {len(broker.orders)})")
+
+
+def serve(port, latency=0.0):
+    # blocking, for running the broker in its own process so it doesn't share the event loop with the client
+    async def main():
+        await FakeBroker(latency=latency).start(port=port)
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+async def placement_latency(n_orders=2000, concurrency=8, latency=0.0, port=8787):
+    # p50/p99 of place_limit_order round trips, plain ClientSession vs the tuned pool with warm up
+    import multiprocessing
+    from mm_engine import BrokerClient
+
+    process = multiprocessing.Process(target=serve, args=(port, latency), daemon=True)
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    await asyncio.sleep(1)
+    try:
+        for tuned in (False, True):
+            client = BrokerClient("fake", rest_url=url)
+            await client.start(tuned=tuned)
+
+            async def worker(k):
+                for i in range(k, n_orders, concurrency):
+                    await client.place_limit_order("SR310CG6D", "OPTSPOT", '1', 10.0, 1)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(k) for k in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            stats = client.latency.histogram("place_ack").summary()
+            await client.close()
+            print(f"{'tuned' if tuned else 'default'}: p50 {stats['p50_us']:.0f} us, p99 {stats['p99_us']:.0f} us, "
+                  f"max {stats['max_us']:.0f} us, {n_orders / elapsed:.0f} orders/s")
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    setup_logging(level="ERROR")
+    asyncio.run(time_to_flat())
+    asyncio.run(placement_latency())
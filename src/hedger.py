@@ -0,0 +1,165 @@
+import asyncio
+import time
+from datetime import datetime
+import numpy as np
+from black_scholes import black_scholes_greeks
+from instruments import parse_option_ticker
+from order_book import TICK_SIZE
+from logs import get_logger, fields
+
+logger = get_logger("hedger")
+
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+
+def build_option_specs(expiries):
+    # {ticker: expiry datetime} -> {ticker: {"strike", "expiry", "option_type"}}
+    specs = {}
+    for ticker, expiry in expiries.items():
+        parsed = parse_option_ticker(ticker)
+        if parsed is None:
+            logger.warning("Unable to parse option ticker, skipping it", extra=fields(ticker=ticker))
+            continue
+        specs[ticker] = {"strike": parsed["strike"], "expiry": expiry, "option_type": parsed["option_type"]}
+    return specs
+
+
+class DeltaHedger:
+    def __init__(self, client, options, underlying="SBER", class_code="TQBR", risk_free_rate=0.15, volatility=0.2,
+                 contract_size=100, lot_size=10, delta_threshold=50, gamma_limit=None, min_interval=5,
+                 price_offset_ticks=5, spot_interval=5):
+        self.client = client
+        self.underlying = underlying
+        self.class_code = class_code
+        self.risk_free_rate = risk_free_rate
+        self.contract_size = contract_size # underlying shares per option contract
+        self.lot_size = lot_size # underlying shares per lot
+        self.delta_threshold = delta_threshold # in shares
+        self.gamma_limit = gamma_limit
+        self.min_interval = min_interval
+        self.price_offset = price_offset_ticks * TICK_SIZE
+        self.spot_interval = spot_interval
+
+        # the whole option book as flat arrays, positions are written in place on inventory updates
+        self.tickers = list(options)
+        self.index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.strikes = np.array([options[t]["strike"] for t in self.tickers], dtype=np.float64)
+        self.expiries = np.array([options[t]["expiry"].timestamp() for t in self.tickers], dtype=np.float64)
+        self.is_call = np.array([options[t]["option_type"] == "call" for t in self.tickers], dtype=bool)
+        self.volatilities = np.full(len(self.tickers), volatility, dtype=np.float64)
+        self.positions = np.zeros(len(self.tickers), dtype=np.float64)
+        self.underlying_position = 0.0
+
+        self.portfolio_delta = 0.0
+        self.portfolio_gamma = 0.0
+        self.hedge_order_id = None
+        self.last_hedge_time = 0.0
+
+    def update_positions(self, inventory):
+        self.positions[:] = 0.0
+        for ticker, quantity in inventory.items():
+            i = self.index.get(ticker)
+            if i is not None:
+                self.positions[i] = quantity
+        self.underlying_position = inventory.get(self.underlying, 0)
+
+    def compute_greeks(self, spot, now=None):
+        now = time.time() if now is None else now
+        taus = (self.expiries - now) / SECONDS_PER_YEAR
+        alive = taus > 0
+        greeks = black_scholes_greeks(spot, self.strikes, taus, self.risk_free_rate, self.volatilities, self.is_call)
+
+        weights = np.where(alive, self.positions, 0.0) * self.contract_size
+        self.portfolio_delta = float(weights @ greeks["delta"]) # in shares of the underlying
+        self.portfolio_gamma = float(weights @ greeks["gamma"])
+        return self.portfolio_delta, self.portfolio_gamma
+
+    def pending_hedge_shares(self):
+        order = self.client.active_orders.get(self.hedge_order_id) if self.hedge_order_id else None
+        if order is None:
+            self.hedge_order_id = None
+            return 0.0
+        sign = 1 if order["side"] == '1' else -1
+        return sign * order["quantity"] * self.lot_size
+
+    async def on_spot(self, spot):
+        self.compute_greeks(spot)
+
+        if self.gamma_limit is not None and abs(self.portfolio_gamma) > self.gamma_limit:
+            logger.warning("Portfolio gamma is above the limit", extra=fields(gamma=self.portfolio_gamma, limit=self.gamma_limit))
+
+        net_delta = self.portfolio_delta + self.underlying_position + self.pending_hedge_shares()
+        if abs(net_delta) < self.delta_threshold:
+            return
+        if time.monotonic() - self.last_hedge_time < self.min_interval:
+            return
+
+        lots = round(abs(net_delta) / self.lot_size)
+        if lots == 0:
+            return
+        side = '2' if net_delta > 0 else '1'
+        price = spot - self.price_offset if side == '2' else spot + self.price_offset
+        self.last_hedge_time = time.monotonic()
+
+        existing = self.client.active_orders.get(self.hedge_order_id) if self.hedge_order_id else None
+        if existing is not None:
+            try:
+                if existing["side"] != side:
+                    await self.client.cancel_order(id=self.hedge_order_id)
+                    self.hedge_order_id = None
+                    return
+                lots += existing["quantity"] # resize the live hedge instead of stacking another order
+                self.hedge_order_id = await self.client.edit_order(id=self.hedge_order_id, price=price, quantity=lots)
+                return
+            except ValueError:
+                self.hedge_order_id = None
+                return
+
+        logger.info("Hedging delta", extra=fields(net_delta=net_delta, side=side, lots=lots, ticker=self.underlying, price=price))
+        self.hedge_order_id = await self.client.place_limit_order(
+            ticker=self.underlying,
+            class_code=self.class_code,
+            side=side,
+            price=price,
+            quantity=lots
+        )
+
+    async def run(self): # needs client.start_spot_ws running for the underlying
+        while True:
+            try:
+                updated = await self.client.spot.wait_for_update(self.underlying, timeout=self.spot_interval)
+                spot = self.client.spot.price(self.underlying)
+                if spot is None:
+                    if not updated:
+                        logger.warning("Spot price is stale, not hedging", extra=fields(ticker=self.underlying))
+                    continue
+                self.update_positions(self.client.inventory)
+                await self.on_spot(spot)
+            except Exception:
+                logger.exception("Exception in delta hedger")
+                await asyncio.sleep(self.spot_interval)
+
+
+if __name__ == "__main__":
+    n = 1000
+    rng = np.random.default_rng(0)
+    expiries = {}
+    for i in range(n):
+        month = "ABCDEFGHIJKLMNOPQRSTUVWX"[i % 24]
+        expiries[f"SR{200 + i // 4}C{month}6{'ABCD'[i % 4]}"] = datetime(2026, 1 + i % 12, 20)
+    specs = build_option_specs(expiries)
+
+    class _Client:
+        active_orders = {}
+        inventory = {ticker: int(q) for ticker, q in zip(specs, rng.integers(-20, 20, len(specs)))}
+
+    hedger = DeltaHedger(_Client(), specs)
+    hedger.update_positions(_Client.inventory)
+    now = datetime(2026, 1, 1).timestamp()
+
+    runs = 1000
+    start = time.perf_counter()
+    for _ in range(runs):
+        hedger.compute_greeks(300 + rng.normal(), now=now)
+    elapsed = (time.perf_counter() - start) / runs * 1e3
+    print(f"{len(specs)} options: {elapsed:.3f} ms per book greeks recomputation, delta={hedger.portfolio_delta:.1f}")
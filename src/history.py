@@ -0,0 +1,131 @@
+import os
+import time
+import numpy as np
+
+TRADE_DTYPE = np.dtype([("time", "f8"), ("price", "f8"), ("quantity", "f8"), ("side", "i1")])
+TOP_DTYPE = np.dtype([("time", "f8"), ("bid", "f8"), ("ask", "f8"), ("bid_qty", "f8"), ("ask_qty", "f8"), ("mid", "f8")])
+
+TRADE_SIDES = {"1": 1, "B": 1, "Buy": 1, "2": -1, "S": -1, "Sell": -1}
+
+
+class RingBuffer:
+    # fixed capacity structured array; every row is written twice (at i and i + capacity), so the last n rows are
+    # always one contiguous slice and windows are views, never copies
+    def __init__(self, dtype, capacity):
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def append(self, row):
+        i = self.count % self.capacity
+        self.data[i] = row
+        self.data[i + self.capacity] = row
+        self.count += 1
+
+    def last(self, n=None):
+        # view of the last n rows, oldest first; valid until capacity - n more rows are appended
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity + self.capacity
+        return self.data[end - n:end]
+
+    def since(self, t):
+        # view of the rows with time >= t, times are appended in order
+        window = self.last()
+        return window[np.searchsorted(window["time"], t):]
+
+    def to_array(self):
+        return self.last().copy()
+
+
+class TickerHistory:
+    __slots__ = ("trades", "tops")
+
+    def __init__(self, trade_capacity, top_capacity):
+        self.trades = RingBuffer(TRADE_DTYPE, trade_capacity)
+        self.tops = RingBuffer(TOP_DTYPE, top_capacity)
+
+
+class HistoryStore:
+    # recent trades and top of book per ticker for windowed signals; memory per ticker is fixed up front:
+    # 2 * (trade_capacity * 25 + top_capacity * 48) bytes, ~7 MB with the defaults
+    def __init__(self, trade_capacity=50_000, top_capacity=50_000):
+        self.trade_capacity = trade_capacity
+        self.top_capacity = top_capacity
+        self.tickers = {}
+
+    def get(self, ticker):
+        history = self.tickers.get(ticker)
+        if history is None:
+            history = self.tickers[ticker] = TickerHistory(self.trade_capacity, self.top_capacity)
+        return history
+
+    def on_order_book(self, ticker, book, t=None):
+        if not book.n_bids or not book.n_asks:
+            return
+        t = time.time() if t is None else t
+        self.get(ticker).tops.append((t, book.best_bid, book.best_ask, book.best_bid_qty, book.best_ask_qty, book.mid))
+
+    def on_trade(self, data, t=None):
+        t = time.time() if t is None else t
+        side = TRADE_SIDES.get(str(data.get("side")), 0)
+        self.get(data["ticker"]).trades.append((t, data["price"], data.get("quantity", 0), side))
+
+    def trades(self, ticker, n=None):
+        return self.get(ticker).trades.last(n)
+
+    def tops(self, ticker, n=None):
+        return self.get(ticker).tops.last(n)
+
+    def memory_per_ticker(self):
+        return 2 * (self.trade_capacity * TRADE_DTYPE.itemsize + self.top_capacity * TOP_DTYPE.itemsize)
+
+    def dump_parquet(self, directory):
+        # one file per ticker and kind, e.g. SR310CG6D_trades_20261019T120000.parquet; needs pyarrow
+        import pandas as pd
+
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        paths = []
+        for ticker, history in self.tickers.items():
+            for kind, buffer in (("trades", history.trades), ("tops", history.tops)):
+                if not len(buffer):
+                    continue
+                df = pd.DataFrame(buffer.to_array())
+                df["time"] = pd.to_datetime(df["time"], unit="s", utc=True)
+                path = os.path.join(directory, f"{ticker}_{kind}_{stamp}.parquet")
+                df.to_parquet(path, index=False)
+                paths.append(path)
+        return paths
+
+
+if __name__ == "__main__":
+    import tempfile
+    from order_book import OrderBook
+
+    store = HistoryStore()
+    book = OrderBook()
+    n = 200_000
+    start = time.perf_counter()
+    for i in range(n):
+        price = 10 + (i % 50) / 100
+        book.set_levels([{"price": price, "quantity": 5}], [{"price": price + 0.05, "quantity": 7}])
+        store.on_order_book("SR310CG6D", book, t=i * 0.01)
+        store.on_trade({"ticker": "SR310CG6D", "price": price, "quantity": 1, "side": "1"}, t=i * 0.01)
+    append_us = (time.perf_counter() - start) / n * 1e6
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        window = store.tops("SR310CG6D", 10_000)
+        window["mid"].std()
+    window_us = (time.perf_counter() - start) / 1000 * 1e6
+
+    paths = store.dump_parquet(tempfile.mkdtemp())
+    print(f"book + trade append: {append_us:.2f} us, std over a 10k window: {window_us:.0f} us, "
+          f"view: {window.base is not None}, memory per ticker: {store.memory_per_ticker() / 2**20:.1f} MB, dumped {len(paths)} files")
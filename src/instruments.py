@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+import aiohttp
+from logs import get_logger, fields
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+INSTRUMENTS_URL = "https://be.broker.ru/trade-api-information-service/api/v1/instruments/by-type"
+SNAPSHOT_TTL = 24 * 3600
+
+logger = get_logger("instruments")
+
+CALL_MONTHS = "ABCDEFGHIJKL"
+PUT_MONTHS = "MNOPQRSTUVWX"
+
+# SR310CG6D: base asset code, strike, settlement type, month letter (calls A-L, puts M-X), year digit, weekly series
+OPTION_TICKER_RE = re.compile(r"^([A-Z]{2})(\d+(?:\.\d+)?)([A-Z])([A-X])(\d)([A-Z]?)$")
+
+
+def parse_option_ticker(ticker):
+    match = OPTION_TICKER_RE.match(ticker)
+    if match is None:
+        return None
+    base, strike, settlement, month_letter, year, series = match.groups()
+
+    if month_letter in CALL_MONTHS:
+        option_type = "call"
+        month = CALL_MONTHS.index(month_letter) + 1
+    else:
+        option_type = "put"
+        month = PUT_MONTHS.index(month_letter) + 1
+
+    return {
+        "ticker": ticker,
+        "base": base,
+        "strike": float(strike),
+        "settlement": settlement,
+        "option_type": option_type,
+        "month": month,
+        "year_digit": int(year),
+        "series": series
+    }
+
+
+class RateLimiter:
+    # spaces out request starts by at least min_interval seconds across concurrent tasks
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.lock = asyncio.Lock()
+        self.next_time = 0.0
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+                now = self.next_time
+            self.next_time = now + self.min_interval
+
+
+class InstrumentCatalog:
+    # reference data of one underlying, kept in a local json snapshot and indexed for O(1) lookups
+    def __init__(self, underlying, instrument_type="OPTIONS", snapshot_path=None, ttl=SNAPSHOT_TTL):
+        self.underlying = underlying
+        self.instrument_type = instrument_type
+        self.snapshot_path = snapshot_path or os.path.join(DATA_DIR, f"instruments_{instrument_type.lower()}_{underlying}.json")
+        self.ttl = ttl
+        self.fetched_at = None
+        self.records = []
+        self.build_index([])
+
+    def build_index(self, records):
+        self.records = records
+        self.by_ticker = {}
+        self.by_underlying = {}
+        self.by_expiry = {}
+        self.by_strike = {}
+        self.by_contract = {}
+
+        for record in records:
+            ticker = record["ticker"]
+            parsed = parse_option_ticker(ticker) or {}
+            underlying = record.get("baseAssetTicker") or self.underlying
+            strike = record.get("strikePrice") or parsed.get("strike")
+            option_type = parsed.get("option_type")
+            expiry = record.get("maturityDate")
+
+            spec = {
+                "ticker": ticker,
+                "class_code": record.get("classCode"),
+                "underlying": underlying,
+                "strike": float(strike) if strike is not None else None,
+                "option_type": option_type,
+                "expiry": datetime.strptime(expiry, "%Y%m%d") if expiry else None,
+                "record": record
+            }
+
+            self.by_ticker[ticker] = spec
+            self.by_underlying.setdefault(underlying, []).append(spec)
+            self.by_expiry.setdefault(spec["expiry"], []).append(spec)
+            self.by_strike.setdefault((underlying, spec["strike"]), []).append(spec)
+            self.by_contract[(underlying, spec["expiry"], spec["strike"], option_type)] = spec
+
+    def get(self, ticker):
+        return self.by_ticker.get(ticker)
+
+    def maturity_date(self, ticker):
+        spec = self.by_ticker.get(ticker)
+        return spec["expiry"] if spec else None
+
+    def strike(self, ticker):
+        spec = self.by_ticker.get(ticker)
+        return spec["strike"] if spec else None
+
+    def find(self, expiry, strike, option_type, underlying=None):
+        return self.by_contract.get((underlying or self.underlying, expiry, float(strike), option_type))
+
+    def expiries(self, after=None):
+        expiries = sorted(e for e in self.by_expiry if e is not None)
+        return [e for e in expiries if after is None or e >= after]
+
+    def option_specs(self, tickers):
+        # in the format DeltaHedger expects
+        specs = {}
+        for ticker in tickers:
+            spec = self.by_ticker.get(ticker)
+            if spec is None or spec["expiry"] is None:
+                logger.warning("No reference data, skipping it", extra=fields(ticker=ticker))
+                continue
+            specs[ticker] = {"strike": spec["strike"], "expiry": spec["expiry"], "option_type": spec["option_type"]}
+        return specs
+
+    def is_fresh(self):
+        return self.fetched_at is not None and time.time() - self.fetched_at < self.ttl
+
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to read instruments snapshot", extra=fields(path=self.snapshot_path, error=repr(e)))
+            return False
+        self.fetched_at = snapshot["fetched_at"]
+        self.build_index(snapshot["records"])
+        return self.is_fresh()
+
+    def save_snapshot(self):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"fetched_at": self.fetched_at, "records": self.records}, file)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def _fetch_page(self, session, token, page, page_size, limiter):
+        headers = {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {token}"
+        }
+        params = {
+            "type": self.instrument_type,
+            "baseAssetTicker": self.underlying,
+            "size": page_size,
+            "page": page
+        }
+
+        for attempt in range(4):
+            await limiter.wait()
+            try:
+                async with session.get(INSTRUMENTS_URL, headers=headers, params=params, timeout=10) as resp:
+                    if resp.status != 200:
+                        text = await resp.text()
+                        logger.warning("Invalid response while getting instruments page", extra=fields(page=page, status=resp.status, text=text))
+                        await asyncio.sleep(3 + 2 * attempt)
+                        continue
+                    return await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Failed attempt while getting instruments page", extra=fields(page=page, attempt=attempt + 1, error=repr(e)))
+                await asyncio.sleep(3 + 2 * attempt)
+
+        raise Exception(f"Failed to get instruments page {page} with 4 attempts")
+
+    async def fetch(self, session, token, page_size=100, concurrency=4, min_interval=0.25):
+        # pages are requested `concurrency` at a time until one comes back empty
+        limiter = RateLimiter(min_interval)
+        records = []
+        page = 0
+        while True:
+            pages = await asyncio.gather(*[
+                self._fetch_page(session, token, p, page_size, limiter) for p in range(page, page + concurrency)
+            ])
+            done = False
+            for data in pages:
+                if not data:
+                    done = True
+                    break
+                records.extend(data)
+            if done:
+                break
+            page += concurrency
+
+        self.fetched_at = time.time()
+        self.build_index(records)
+        logger.info("Fetched instruments", extra=fields(count=len(records), type=self.instrument_type, underlying=self.underlying))
+        return self
+
+    async def load(self, session, token, force=False, **fetch_kwargs):
+        if not force and (self.is_fresh() or self.load_snapshot()):
+            return self
+        await self.fetch(session, token, **fetch_kwargs)
+        self.save_snapshot()
+        return self
+
+    async def refresh(self, token, force=False, **fetch_kwargs): # for scripts without a running client
+        async with aiohttp.ClientSession() as session:
+            return await self.load(session, token, force=force, **fetch_kwargs)
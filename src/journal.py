@@ -0,0 +1,178 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from logs import get_logger, fields
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+JOURNAL_FILE = os.path.join(DATA_DIR, "orders_journal.sqlite")
+
+logger = get_logger("journal")
+
+FINAL_STATUSES = ('2', '4', '6', '8')
+
+COLUMNS = ("ts", "event", "client_order_id", "orig_id", "ticker", "class_code", "side", "price", "quantity", "status", "level")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    event TEXT NOT NULL,
+    client_order_id TEXT,
+    orig_id TEXT,
+    ticker TEXT,
+    class_code TEXT,
+    side TEXT,
+    price REAL,
+    quantity REAL,
+    status TEXT,
+    level INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_positions ON events (ticker, seq) WHERE event = 'position';
+"""
+
+
+class OrderJournal:
+    # append-only sqlite (WAL) log of every place/edit/cancel/fill; record() only puts a tuple on a queue,
+    # a writer thread inserts them in batches so the event loop never waits on the disk
+    def __init__(self, path=JOURNAL_FILE, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'events'").fetchone() is not None:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(events)")]
+            if "level" not in columns: # journals written before levels were recorded
+                conn.execute("ALTER TABLE events ADD COLUMN level INTEGER")
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._writer, name="order-journal", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record(self, event, client_order_id=None, orig_id=None, ticker=None, class_code=None, side=None,
+               price=None, quantity=None, status=None, level=None):
+        self.queue.put((time.time(), event, client_order_id, orig_id, ticker, class_code,
+                        None if side is None else str(side), price, quantity, status, level))
+
+    def _writer(self):
+        conn = self._connect()
+        insert = f"INSERT INTO events ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None or None in batch:
+                running = False
+                batch = [row for row in batch if row is not None]
+            try:
+                conn.executemany(insert, batch)
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error("Failed to write order journal batch", extra=fields(rows=len(batch), error=repr(e)))
+        conn.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def recover(self, since=None):
+        # replays the journal into (active_orders, positions); with `since`, positions start from the last snapshot
+        # of each ticker before it, fills alone would only be the change over the window
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            query = f"SELECT {', '.join(COLUMNS[1:])} FROM events"
+            if since is None:
+                rows = conn.execute(query + " ORDER BY seq").fetchall()
+            else:
+                rows = conn.execute(
+                    query + " WHERE seq IN (SELECT MAX(seq) FROM events WHERE event = 'position' AND ts < ? GROUP BY ticker)"
+                    " OR ts >= ? ORDER BY seq", (since, since)
+                ).fetchall()
+        finally:
+            conn.close()
+        return replay(rows)
+
+
+def replay(rows):
+    active_orders = {}
+    positions = {}
+    for event, client_order_id, orig_id, ticker, class_code, side, price, quantity, status, level in rows:
+        if event == "place":
+            active_orders[client_order_id] = {
+                "ticker": ticker,
+                "class_code": class_code,
+                "side": side,
+                "price": price,
+                "quantity": quantity,
+                "status": status or '0',
+                "level": level # None for orders the order manager did not place
+            }
+        elif event == "edit":
+            order = active_orders.pop(orig_id, None)
+            if order is not None:
+                active_orders[client_order_id] = {**order, "price": price, "quantity": quantity, "status": '0',
+                                                  "level": order["level"] if level is None else level}
+        elif event == "cancel":
+            active_orders.pop(client_order_id, None)
+        elif event == "status":
+            if status in FINAL_STATUSES:
+                active_orders.pop(client_order_id, None)
+            elif client_order_id in active_orders:
+                active_orders[client_order_id]["quantity"] = quantity
+                active_orders[client_order_id]["status"] = status
+        elif event == "fill":
+            sign = 1 if side == '1' else -1
+            positions[ticker] = positions.get(ticker, 0) + sign * quantity
+        elif event == "position":
+            positions[ticker] = quantity
+    return active_orders, positions
+
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "journal.sqlite")
+    journal = OrderJournal(path)
+    n_orders = 20_000 # a busy day: every order placed, edited a few times, filled or cancelled
+
+    start = time.perf_counter()
+    events = 0
+    for i in range(n_orders):
+        order_id = f"order-{i}"
+        ticker = f"SR{270 + 10 * (i % 10)}CG6D"
+        side = random.choice(['1', '2'])
+        journal.record("place", order_id, ticker=ticker, class_code="OPTSPOT", side=side, price=10.0, quantity=5, level=i % 3)
+        for j in range(3):
+            new_id = f"{order_id}-{j}"
+            journal.record("edit", new_id, orig_id=order_id, price=10.0 + j / 100, quantity=5)
+            order_id = new_id
+        if i % 3 == 0:
+            journal.record("fill", order_id, ticker=ticker, side=side, price=10.0, quantity=5)
+            journal.record("status", order_id, status='2', quantity=0)
+        elif i % 3 == 1:
+            journal.record("cancel", order_id)
+        events += 6
+    record_us = (time.perf_counter() - start) / events * 1e6
+    journal.close()
+
+    start = time.perf_counter()
+    active_orders, positions = journal.recover()
+    recover_ms = (time.perf_counter() - start) * 1e3
+    print(f"{events} events: record {record_us:.2f} us/event, recovery {recover_ms:.0f} ms, "
+          f"{len(active_orders)} active orders, {len(positions)} positions")
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import time
+import numpy as np
+from logs import get_logger, fields
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+PERCENTILES = (50, 90, 99, 99.9)
+
+logger = get_logger("latency")
+
+
+class LatencyHistogram:
+    # HdrHistogram-like log-linear buckets over nanoseconds: values below 2**precision_bits are exact,
+    # above that every power of two is split into 2**(precision_bits - 1) buckets (~1.5% error for 7 bits)
+    def __init__(self, precision_bits=7, max_value_ns=60 * 10**9):
+        self.precision_bits = precision_bits
+        self.sub_buckets = 1 << precision_bits
+        self.half = self.sub_buckets >> 1
+        self.max_value_ns = max_value_ns
+        self.counts = np.zeros(self._index(max_value_ns) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return self.sub_buckets + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def _lower_bound(self, index):
+        if index < self.sub_buckets:
+            return index
+        shift = (index - self.sub_buckets) // self.half + 1
+        return ((index - self.sub_buckets) % self.half + self.half) << shift
+
+    def record(self, value_ns):
+        value_ns = min(max(int(value_ns), 0), self.max_value_ns)
+        self.counts[self._index(value_ns)] += 1
+        self.count += 1
+        self.total += value_ns
+        if self.min is None or value_ns < self.min:
+            self.min = value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+
+    def percentile(self, percentile):
+        if self.count == 0:
+            return None
+        rank = max(1, int(np.ceil(percentile / 100 * self.count)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self._lower_bound(index), self.max)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def summary(self): # in microseconds
+        if self.count == 0:
+            return {"count": 0}
+        summary = {
+            "count": self.count,
+            "mean_us": self.total / self.count / 1e3,
+            "min_us": self.min / 1e3,
+            "max_us": self.max / 1e3,
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}_us"] = self.percentile(p) / 1e3
+        return summary
+
+
+class LatencyTracker:
+    # one histogram per pipeline stage, timestamps come from time.monotonic_ns()
+    def __init__(self, **histogram_kwargs):
+        self.histogram_kwargs = histogram_kwargs
+        self.stages = {}
+
+    def histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram(**self.histogram_kwargs)
+        return histogram
+
+    def record(self, stage, start_ns, end_ns=None):
+        if start_ns is None:
+            return
+        end_ns = time.monotonic_ns() if end_ns is None else end_ns
+        self.histogram(stage).record(end_ns - start_ns)
+
+    def snapshot(self):
+        return {stage: histogram.summary() for stage, histogram in self.stages.items()}
+
+    def to_prometheus(self, metric="mm_stage_latency_seconds"):
+        lines = [f"# TYPE {metric} summary"]
+        for stage, histogram in self.stages.items():
+            if histogram.count == 0:
+                continue
+            for p in PERCENTILES:
+                lines.append(f'{metric}{{stage="{stage}",quantile="{p / 100:g}"}} {histogram.percentile(p) / 1e9:.9f}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.total / 1e9:.9f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"time": time.time(), "stages": self.snapshot()}, file, indent=2)
+        os.replace(tmp_path, path)
+
+    async def run_exporter(self, path=os.path.join(DATA_DIR, "latency.json"), interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.dump_json(path)
+            except OSError as e:
+                logger.warning("Unable to dump latency stats", extra=fields(error=repr(e)))
+
+    async def start_prometheus_server(self, host="127.0.0.1", port=9108, extra=()):
+        # `extra` are callables returning more exposition text, e.g. RiskGate.to_prometheus
+        from aiohttp import web
+
+        async def metrics(request):
+            text = self.to_prometheus() + "".join(source() for source in extra)
+            return web.Response(text=text, content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Serving latency metrics", extra=fields(url=f"http://{host}:{port}/metrics"))
+        return runner
@@ -0,0 +1,124 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+_listener = None
+_sample_counters = {}
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line, structured fields are passed as extra={"fields": {...}};
+    # they are serialized on the listener thread, so pass copies of containers the event loop keeps mutating
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    # the stock prepare renders the traceback into msg and clears exc_info, JsonFormatter would lose "exc";
+    # the listener is in this process, so only the message is rendered here and the traceback goes over as is
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level="INFO", json_output=True, stream=None, filename=None):
+    # handlers run on a listener thread, the event loop only pays for putting the record on a queue
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = JsonFormatter() if json_output else TextFormatter()
+    handlers = [logging.StreamHandler(stream or sys.stdout)]
+    if filename:
+        handlers.append(logging.FileHandler(filename))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def get_logger(name):
+    return logging.getLogger(name)
+
+
+def fields(**kwargs):
+    return {"fields": kwargs}
+
+
+def should_sample(key, every):
+    # for per-tick messages: true once per `every` calls with the same key, checked before a record is even built
+    count = _sample_counters.get(key, 0)
+    _sample_counters[key] = count + 1
+    return count % every == 0
+
+
+if __name__ == "__main__":
+    import io
+
+    listener = setup_logging(stream=io.StringIO())
+    logger = get_logger("bench")
+    n = 100_000
+
+    def drain():
+        while not listener.queue.empty():
+            time.sleep(0.01)
+
+    start = time.perf_counter()
+    for i in range(n):
+        logger.info("Updated order book", extra=fields(ticker="SR310CG6D", n=i))
+    queued_us = (time.perf_counter() - start) / n * 1e6
+    drain()
+
+    start = time.perf_counter()
+    for i in range(n):
+        if should_sample("book", 100):
+            logger.info("Updated order book", extra=fields(ticker="SR310CG6D", sampled_every=100))
+    sampled_us = (time.perf_counter() - start) / n * 1e6
+    drain()
+
+    start = time.perf_counter()
+    for i in range(n):
+        logger.debug("Updated order book", extra=fields(ticker="SR310CG6D", n=i))
+    disabled_us = (time.perf_counter() - start) / n * 1e6
+
+    print(f"queued: {queued_us:.2f} us, sampled 1/100: {sampled_us:.2f} us, below level: {disabled_us:.2f} us per call")
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from latency import LatencyHistogram
+from logs import get_logger, fields
+
+logger = get_logger("loop_monitor")
+
+_cpu_executor = None
+
+
+def run(main, use_uvloop=False, debug=False):
+    # asyncio.run with uvloop when it is installed and asked for
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("uvloop is not installed, falling back to the default event loop")
+        else:
+            logger.info("Running on uvloop")
+            return uvloop.run(main, debug=debug)
+    return asyncio.run(main, debug=debug)
+
+
+class LoopLagMonitor:
+    # wakes up every `interval` seconds and measures how late it was scheduled; a late wakeup means some
+    # callback kept the loop busy, which is exactly what would delay websocket reads
+    def __init__(self, interval=0.05, threshold=0.1, latency=None, report_interval=60):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.latency = latency # LatencyTracker to export lag next to the pipeline stages
+        self.histogram = latency.histogram("loop_lag") if latency is not None else LatencyHistogram()
+        self.stalls = 0
+        self.worst_ns = 0
+
+    async def run(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic_ns() + int(self.interval * 1e9)
+            await asyncio.sleep(self.interval)
+            lag_ns = max(time.monotonic_ns() - expected, 0)
+            self.histogram.record(lag_ns)
+            self.worst_ns = max(self.worst_ns, lag_ns)
+
+            if lag_ns > self.threshold * 1e9:
+                self.stalls += 1
+                logger.warning("Event loop stalled", extra=fields(lag_ms=lag_ns / 1e6, stalls=self.stalls, tasks=len(asyncio.all_tasks())))
+
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                logger.info("Event loop lag", extra=fields(**self.summary()))
+
+    def summary(self):
+        summary = {
+            "p50_ms": (self.histogram.percentile(50) or 0) / 1e6,
+            "p99_ms": (self.histogram.percentile(99) or 0) / 1e6,
+            "p999_ms": (self.histogram.percentile(99.9) or 0) / 1e6,
+            "max_ms": self.worst_ns / 1e6,
+            "stalls": self.stalls,
+        }
+        return summary
+
+
+def get_cpu_executor(max_workers=None):
+    # processes, not threads: the QuantLib tree and pandas code hold the GIL
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=max_workers)
+    return _cpu_executor
+
+
+async def offload(func, *args, executor=None, **kwargs):
+    # runs blocking/CPU bound work off the event loop, func and arguments have to be picklable for processes
+    loop = asyncio.get_running_loop()
+    executor = executor or get_cpu_executor()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+def shutdown_cpu_executor():
+    global _cpu_executor
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=False, cancel_futures=True)
+        _cpu_executor = None
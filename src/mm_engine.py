@@ -6,27 +6,176 @@ from datetime import datetime, timedelta
 from datetime import timezone
 import uuid
 import math
+import time
+from order_book import OrderBook, price_to_ticks, TICK_SIZE
+from signals import BookSignals
+from estimators import RealizedVolatility, TradeIntensity
+from spot_feed import SpotCache
+from latency import LatencyTracker
+from logs import setup_logging, get_logger, fields, should_sample
+from journal import OrderJournal, FINAL_STATUSES
+from risk import RiskGate, RiskRejected
+from requote import RequotePolicy
+from order_diff import OrderDiffEngine
+from history import HistoryStore
+import loop_monitor
+import logging
+import signal
+
+logger = get_logger("mm_engine")
+
+REST_URL = "https://be.broker.ru"
+WS_URL = "wss://ws.broker.ru"
+
+REST_ENDPOINTS = {
+    "token": "/trade-api-keycloak/realms/tradeapi/protocol/openid-connect/token",
+    "portfolio": "/trade-api-bff-portfolio/api/v1/portfolio",
+    "orders_search": "/trade-api-bff-order-details/api/v1/orders/search",
+    "orders": "/trade-api-bff-operations/api/v1/orders",
+    "order": "/trade-api-bff-operations/api/v1/orders/{id}",
+    "order_cancel": "/trade-api-bff-operations/api/v1/orders/{id}/cancel",
+    "candles": "/trade-api-market-data-connector/api/v1/candles-chart",
+}
+WS_ENDPOINTS = {
+    "market_data": "/trade-api-market-data-connector/api/v1/market-data/ws",
+    "orders": "/trade-api-bff-operations/api/v1/orders/transaction/ws",
+}
 
 class BrokerClient:
-    def __init__(self, token):
+    def __init__(self, token, rest_url=REST_URL, ws_url=WS_URL):
         self.refresh_token = token
+        self.rest_url = rest_url
+        self.ws_url = ws_url
+        self.urls = {name: rest_url + path for name, path in REST_ENDPOINTS.items()} # built once, not per request
+        self.ws_urls = {name: ws_url + path for name, path in WS_ENDPOINTS.items()}
         self.session = None
         self.access_token = None
+        self.token_expires_at = None # time.monotonic() deadline
+        self.headers = {}
+        self.open_ws = {} # name -> open websocket, reauthenticated one by one after a token refresh
+        self.ws_connected = {}
         self.active_orders = {}
+        self.inventory = {}
+        self.spot = SpotCache()
+        self.subscriptions = {} # data type -> {ticker: instrument}
+        self.market_data_ws = {} # data type -> open websocket
+        self.book_depth = 5
+        self.latency = LatencyTracker() # per stage histograms, events carry monotonic_ns stamps in "_t_recv"
+        self.history = HistoryStore() # recent trades and top of book per ticker, windows for signals are views into it
+        self.journal = None # OrderJournal, when set every order event is persisted for crash recovery
+        self.risk = None # RiskGate checked before every place/edit, see set_risk_gate()
+        self.halted = False # the order manager stops quoting while set: kill switch or a market data feed down
+        self.killed = False # kill switch engaged, only resume() clears it
+        self.feeds_down = set() # market data websockets lost and not delivering data again yet
+        self.cancel_on_disconnect = False # halt and flatten when a market data feed drops, on for the trading engine only
+        self.expected_ws_close = set() # sockets closed on purpose (token refresh), they must not trip the kill switch
 
         self.q_inventory = asyncio.Queue()
         self.q_orderbooks = asyncio.Queue()
         self.q_orderflow = asyncio.Queue()
 
-    async def start(self):
-        self.session = aiohttp.ClientSession()
+    async def start(self, tuned=True, warm_up=True):
+        if tuned:
+            # one long lived pool: connections stay open between orders instead of paying TCP + TLS on a cold socket
+            connector = aiohttp.TCPConnector(limit=100, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=120,
+                                             enable_cleanup_closed=True)
+            timeout = aiohttp.ClientTimeout(total=10, connect=3, sock_read=5) # the only timeout policy for REST calls
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        else:
+            self.session = aiohttp.ClientSession()
         await self.authorize()
+        if tuned and warm_up:
+            await self.warm_up()
+
+    async def warm_up(self, connections=4):
+        # opens a few pooled connections to the REST host before the first order needs one; the status is irrelevant
+        async def touch():
+            try:
+                async with self.session.head(self.rest_url, headers=self.headers["get"]) as resp:
+                    await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Connection warm up failed", extra=fields(error=repr(e)))
+
+        t_start = time.monotonic_ns()
+        await asyncio.gather(*(touch() for _ in range(connections)))
+        logger.info("Warmed up REST connections", extra=fields(connections=connections, ms=(time.monotonic_ns() - t_start) / 1e6))
+
+    def set_risk_gate(self, risk):
+        risk.on_breach = lambda reason: asyncio.create_task(self.kill(f"risk breach: {reason}"))
+        risk.set_spot(self.spot) # collar reference for the underlying, which has no strategy book
+        risk.reset_orders(self.active_orders)
+        risk.on_positions(self.inventory)
+        self.risk = risk
+
+    def _set_order(self, order_id, order): # every change of active_orders goes through these two, the risk counters follow them
+        self.active_orders[order_id] = order
+        if self.risk is not None:
+            self.risk.on_order(order_id, order)
+
+    def _drop_order(self, order_id):
+        self.active_orders.pop(order_id, None)
+        if self.risk is not None:
+            self.risk.on_order_removed(order_id)
+
+    def _journal(self, event, client_order_id, **kwargs):
+        if self.journal is not None:
+            self.journal.record(event, client_order_id, **kwargs)
+
+    async def recover_from_journal(self, since=None):
+        # rebuilds active orders and positions from the local journal, then reconciles them with a single search
+        # request instead of asking the status of every order. Positions come from the broker's portfolio, the
+        # journal's are only compared: a missed fill there must not look like a limit breach
+        t_start = time.monotonic_ns()
+        active_orders, positions = self.journal.recover(since)
+        inventory = await self.get_inventory()
+        mismatched = {ticker: (quantity, inventory.get(ticker, 0)) for ticker, quantity in positions.items()
+                      if quantity != inventory.get(ticker, 0)}
+        if mismatched:
+            logger.warning("Journal positions differ from the portfolio", extra=fields(positions=mismatched))
+        records = await self.get_all_active_orders()
+
+        broker_orders = {}
+        for record in records:
+            order_id = record.get('clientOrderId') or record.get('originalClientOrderId')
+            if order_id is not None:
+                broker_orders[order_id] = record
+
+        stale = [order_id for order_id in active_orders if order_id not in broker_orders]
+        for order_id in stale:
+            active_orders.pop(order_id)
+            self._journal("status", order_id, status='4')
+        unknown = 0
+        for order_id, record in broker_orders.items():
+            quantity = record.get('remainedQuantity', record.get('orderQuantity'))
+            if order_id in active_orders:
+                active_orders[order_id]['quantity'] = quantity
+                continue
+            unknown += 1
+            active_orders[order_id] = {
+                "ticker": record.get('ticker'),
+                "class_code": record.get('classCode'),
+                "side": str(record.get('side')),
+                "price": record.get('price'),
+                "quantity": quantity,
+                "status": '0',
+                "level": None
+            }
+            self._journal("place", order_id, ticker=record.get('ticker'), class_code=record.get('classCode'),
+                          side=record.get('side'), price=record.get('price'), quantity=quantity)
+
+        self.active_orders = active_orders
+        if self.risk is not None:
+            self.risk.reset_orders(active_orders)
+        logger.info("Recovered state from journal", extra=fields(active_orders=len(active_orders), positions=len(inventory),
+                                                                 mismatched=len(mismatched), dropped=len(stale), unknown=unknown,
+                                                                 ms=(time.monotonic_ns() - t_start) / 1e6))
+        return active_orders
 
     async def close(self):
         await self.session.close()
 
     async def authorize(self):
-        url = "https://be.broker.ru/trade-api-keycloak/realms/tradeapi/protocol/openid-connect/token"\
+        url = self.urls["token"]
 
         payload = {
             "client_id": "trade-api-write",
@@ -41,111 +190,217 @@ class BrokerClient:
 
         for attempt in range(4):
             try:
-                async with self.session.post(url, headers=headers, data=payload, timeout=10) as resp:
+                async with self.session.post(url, headers=headers, data=payload) as resp:
                     if resp.status!= 200:
                         text = await resp.text()
-                        print(f"Invalid response while authorizing \n {resp.status} \n {text}")
+                        logger.warning("Invalid response while authorizing", extra=fields(status=resp.status, text=text))
                         await asyncio.sleep(3 + 2*attempt)
                         attempt += 1
                         continue
                     data = await resp.json()
-                    self.access_token = data['access_token']
-                    print("Authorized")
+                    self.set_access_token(data['access_token'], data.get('expires_in', 300))
+                    if data.get('refresh_token'): #keycloak may rotate it
+                        self.refresh_token = data['refresh_token']
+                    logger.info("Authorized", extra=fields(expires_in=data.get('expires_in')))
                     return
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt+1} while authorizing: \n {e}")
+                logger.warning("Failed attempt while authorizing", extra=fields(attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(3 + 2*attempt)
 
         raise Exception("Failed to authorize with 4 attempts")
 
+    def set_access_token(self, access_token, expires_in):
+        # headers are swapped as whole dicts, requests that are already built keep the old ones
+        authorization = f"Bearer {access_token}"
+        self.headers = {
+            "json": {"Content-Type": "application/json", "Accept": "application/json", "Authorization": authorization},
+            "get": {"Accept": "application/json", "Authorization": authorization},
+            "ws": {"Authorization": authorization}
+        }
+        self.access_token = access_token
+        self.token_expires_at = time.monotonic() + expires_in
+
+    async def start_token_refresher(self, margin=60):
+        while True:
+            delay = self.token_expires_at - time.monotonic() - margin
+            await asyncio.sleep(max(delay, 5))
+            try:
+                await self.authorize()
+                await self.reauthenticate_websockets()
+            except Exception as e:
+                logger.error("Failed to refresh access token", extra=fields(error=repr(e)))
+                await asyncio.sleep(10)
+
+    def _ws_opened(self, name, ws):
+        self.open_ws[name] = ws
+        self.ws_connected.setdefault(name, asyncio.Event()).set()
+
+    def _ws_closed(self, name):
+        self.open_ws.pop(name, None)
+        event = self.ws_connected.get(name)
+        if event is not None:
+            event.clear()
+
+    async def reauthenticate_websockets(self, timeout=30):
+        # one socket at a time: close it, its loop reconnects with the new token, then move on to the next one
+        for name, ws in list(self.open_ws.items()):
+            event = self.ws_connected[name]
+            event.clear()
+            self.expected_ws_close.add(name)
+            await ws.close()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+                logger.info("Reauthenticated websocket", extra=fields(ws=name))
+            except asyncio.TimeoutError:
+                logger.warning("Websocket did not reconnect after token refresh", extra=fields(ws=name, timeout=timeout))
+
     async def start_order_book_ws(self, instruments, depth):
-        url = "wss://ws.broker.ru/trade-api-market-data-connector/api/v1/market-data/ws"
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        await self.start_market_data_ws(0, instruments, self.q_orderbooks, depth=depth)
+
+    async def start_orderflow_ws(self, instruments):
+        await self.start_market_data_ws(2, instruments, self.q_orderflow)
+
+    def _subscribe_message(self, data_type, instruments, subscribe_type=0):
+        message = {
+            "subscribeType": subscribe_type, # 0 - subscribe, 1 - unsubscribe
+            "dataType": data_type,
+            "instruments": instruments
+        }
+        if data_type == 0:
+            message["depth"] = self.book_depth
+        return message
+
+    async def start_market_data_ws(self, data_type, instruments, queue, depth=None): # 0 - order books, 2 - trades
+        url = self.ws_urls["market_data"]
+        name = "order book" if data_type == 0 else "order flow"
+        if depth is not None:
+            self.book_depth = depth
+
+        # the subscription set outlives the connection, so reconnects and update_subscriptions share it
+        subscriptions = self.subscriptions.setdefault(data_type, {})
+        for instrument in instruments:
+            subscriptions[instrument["ticker"]] = instrument
 
         attempt = 0
         while True:
             try:
-                async with self.session.ws_connect(url, headers=headers) as ws:
-                    subscribe_message = {
-                        "subscribeType": 0,
-                        "dataType": 0,
-                        "depth": depth,
-                        "instruments": instruments
-                    }
-                    await ws.send_json(subscribe_message)
-                    print(f"connected ws for {instruments}")
+                async with self.session.ws_connect(url, headers=self.headers["ws"]) as ws:
+                    self.market_data_ws[data_type] = ws
+                    self._ws_opened(name, ws)
+                    if subscriptions:
+                        await ws.send_json(self._subscribe_message(data_type, list(subscriptions.values())))
+                    logger.info("Connected market data websocket", extra=fields(ws=name, instruments=len(subscriptions)))
                     async for msg in ws:
                         if msg.type == aiohttp.WSMsgType.TEXT:
+                            t_recv = time.monotonic_ns()
                             try:
                                 data = json.loads(msg.data)
                             except Exception as e:
-                                print("Invalid json")
+                                logger.warning("Invalid json in websocket message")
                                 continue
-                            await self.q_orderbooks.put(data)
+                            data["_t_recv"] = t_recv
+                            self.latency.record("ws_decode", t_recv)
+                            if name in self.feeds_down and data.get("responseType") in ("OrderBook", "LastTrades"):
+                                self.feed_restored(name) # the strategy gets this fresh update before quoting again
+                            await queue.put(data)
                         elif msg.type == aiohttp.WSMsgType.ERROR:
-                            print(f"Websocket message error: \n {ws.exception()}")
+                            logger.warning("Websocket message error", extra=fields(error=repr(ws.exception())))
                             break
                         elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING):
-                            print("Websocket closed by server")
+                            logger.info("Websocket closed by server")
                             break
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while opening order book websocket for {instruments}: \n {e}")
+                logger.warning("Failed attempt while opening websocket", extra=fields(ws=name, attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
-
-    async def start_orderflow_ws(self, instruments):
-        url = "wss://ws.broker.ru/trade-api-market-data-connector/api/v1/market-data/ws"
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+            finally:
+                self.market_data_ws.pop(data_type, None)
+                self._ws_closed(name)
+                if name in self.expected_ws_close:
+                    self.expected_ws_close.discard(name)
+                elif self.cancel_on_disconnect and not self.session.closed:
+                    asyncio.create_task(self.feed_lost(name))
+
+    async def update_subscriptions(self, data_type, add=(), remove=()):
+        # applied on the open socket, without a reconnect; if the socket is down the next connect picks them up
+        subscriptions = self.subscriptions.setdefault(data_type, {})
+        add = [instrument for instrument in add if instrument["ticker"] not in subscriptions]
+        remove = [subscriptions[ticker] for ticker in (i["ticker"] for i in remove) if ticker in subscriptions]
+
+        for instrument in add:
+            subscriptions[instrument["ticker"]] = instrument
+        for instrument in remove:
+            subscriptions.pop(instrument["ticker"], None)
+
+        ws = self.market_data_ws.get(data_type)
+        if ws is None or ws.closed:
+            return
+        if remove:
+            await ws.send_json(self._subscribe_message(data_type, remove, subscribe_type=1))
+        if add:
+            await ws.send_json(self._subscribe_message(data_type, add))
+
+    async def start_spot_ws(self, instruments):
+        # top of book and trades of the underlying on one connection, written straight into self.spot
+        url = self.ws_urls["market_data"]
 
         attempt = 0
         while True:
             try:
-                async with self.session.ws_connect(url, headers=headers) as ws:
-                    subscribe_message = {
+                async with self.session.ws_connect(url, headers=self.headers["ws"]) as ws:
+                    self._ws_opened("spot", ws)
+                    await ws.send_json({
+                        "subscribeType": 0,
+                        "dataType": 0,
+                        "depth": 1,
+                        "instruments": instruments
+                    })
+                    await ws.send_json({
                         "subscribeType": 0,
                         "dataType": 2,
                         "instruments": instruments
-                    }
-                    await ws.send_json(subscribe_message)
-                    print(f"connected orderflow for {instruments}")
+                    })
+                    logger.info("Connected spot websocket", extra=fields(instruments=[i["ticker"] for i in instruments]))
                     async for msg in ws:
                         if msg.type == aiohttp.WSMsgType.TEXT:
                             try:
                                 data = json.loads(msg.data)
                             except Exception as e:
-                                print("Invalid json")
+                                logger.warning("Invalid json in websocket message")
                                 continue
-                            await self.q_orderflow.put(data)
-
+                            if "spot" in self.feeds_down and data.get("responseType") in ("OrderBook", "LastTrades"):
+                                self.feed_restored("spot")
+                            self.spot.on_message(data)
                         elif msg.type == aiohttp.WSMsgType.ERROR:
-                            print(f"Websocket message error: \n {ws.exception()}")
+                            logger.warning("Websocket message error", extra=fields(error=repr(ws.exception())))
                             break
                         elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING):
-                            print("Websocket closed by server")
+                            logger.info("Websocket closed by server")
                             break
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while opening order flow websocket for {instruments}: \n {e}")
+                logger.warning("Failed attempt while opening websocket", extra=fields(ws="spot", attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
-
+            finally:
+                self._ws_closed("spot")
+                if "spot" in self.expected_ws_close:
+                    self.expected_ws_close.discard("spot")
+                elif self.cancel_on_disconnect and not self.session.closed:
+                    asyncio.create_task(self.feed_lost("spot")) # hedging and the risk collar run on it
 
     async def get_inventory(self):
-        url = "https://be.broker.ru/trade-api-bff-portfolio/api/v1/portfolio"
+        url = self.urls["portfolio"]
 
         payload = {}
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
         attempt = 0
         while True:
             try:
-                async with self.session.get(url, headers=headers, data=payload) as resp:
+                async with self.session.get(url, headers=self.headers["get"], data=payload) as resp:
                     if resp.status!= 200:
                         text = await resp.text()
-                        print(f"Invalid response while updating inventory \n {resp.status} \n {text}")
+                        logger.warning("Invalid response while updating inventory", extra=fields(status=resp.status, text=text))
                         await asyncio.sleep(3 + 2*attempt)
                         attempt += 1
                         continue
@@ -157,11 +412,19 @@ class BrokerClient:
                             continue
                         size = position['quantity']
                         inventory[ticker] = size
+                        if self.inventory.get(ticker) != size:
+                            self._journal("position", None, ticker=ticker, quantity=size)
+                    for ticker in self.inventory.keys() - inventory.keys(): # flat positions are not listed
+                        if self.inventory[ticker]:
+                            self._journal("position", None, ticker=ticker, quantity=0)
+                    self.inventory = inventory
+                    if self.risk is not None:
+                        self.risk.on_positions(inventory)
                     await self.q_inventory.put(inventory)
                     return inventory
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while opening updating inventory: \n {e}")
+                logger.warning("Failed attempt while updating inventory", extra=fields(attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
 
@@ -171,54 +434,61 @@ class BrokerClient:
                 await self.get_inventory()
                 await asyncio.sleep(1)
             except Exception as e:
-                print(f"Failed to update inventory \n {e}")
+                logger.error("Failed to update inventory", extra=fields(error=repr(e)))
                 await asyncio.sleep(1)
 
     async def start_orders_ws(self):
-        url = "wss://ws.broker.ru/trade-api-bff-operations/api/v1/orders/transaction/ws"
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        url = self.ws_urls["orders"]
 
         attempt = 0
         while True:
             try:
-                async with self.session.ws_connect(url, headers=headers) as ws:
-                    print("Connected orders ws")
+                async with self.session.ws_connect(url, headers=self.headers["ws"]) as ws:
+                    self._ws_opened("orders", ws)
+                    logger.info("Connected orders websocket")
                     async for ms in ws:
                         data = json.loads(ms.data)
-                        #print(f"Orders ws message: \n {data}")
                         order_id = data['clientOrderId']
                         order_status = data['data']['orderStatus']
 
                         if order_id in self.active_orders: #edited/cancelled/excecuted
-                            if order_status in ['2', '4', '6', '8']:
-                                self.active_orders.pop(order_id, None)
+                            order = self.active_orders[order_id]
+                            remained = data['data'].get('remainedQuantity', 0 if order_status == '2' else order['quantity'])
+                            filled = order['quantity'] - remained
+                            if filled > 0:
+                                self._journal("fill", order_id, ticker=order['ticker'], class_code=order['class_code'],
+                                              side=order['side'], price=data['data'].get('price', order['price']), quantity=filled)
+                            self._journal("status", order_id, status=order_status, quantity=remained)
+                            if order_status in FINAL_STATUSES:
+                                self._drop_order(order_id)
                             else:
-                                self.active_orders[order_id]['quantity'] = data['data']['remainedQuantity']
-                                self.active_orders[order_id]['status'] = order_status
+                                order['quantity'] = remained
+                                order['status'] = order_status
+                                self._set_order(order_id, order)
                         else: #new order placed
-                            self.active_orders[order_id] = {
+                            self._journal("place", order_id, ticker=data['data']['ticker'], class_code=data['data']['classCode'],
+                                          side=data['data']['side'], price=data['data']['price'], quantity=data['data']['remainedQuantity'])
+                            self._set_order(order_id, {
                                 "ticker": data['data']['ticker'],
                                 "class_code": data['data']['classCode'],
                                 "side": data['data']['side'],
                                 "price": data['data']['price'],
                                 "quantity": data['data']['remainedQuantity'],
                                 "status": '0'
-                            }
+                            })
 
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while opening orders websocket order: \n {e}")
+                logger.warning("Failed attempt while opening websocket", extra=fields(ws="orders", attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
+            finally:
+                self._ws_closed("orders")
+                self.expected_ws_close.discard("orders") # a token refresh close is consumed here, an unplanned one leaves nothing behind
 
     async def get_all_active_orders(self):
-        url = "https://be.broker.ru/trade-api-bff-order-details/api/v1/orders/search"
+        url = self.urls["orders_search"]
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
 
         payload = {
             "StartDateTime":(datetime.now() - timedelta(days=1)).isoformat(),
@@ -229,36 +499,32 @@ class BrokerClient:
         attempt = 0
         while True:
             try:
-                async with self.session.post(url, headers=headers, json=payload) as resp:
+                async with self.session.post(url, headers=self.headers["json"], json=payload) as resp:
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while updating inventory \n {resp.status} \n {text}")
+                        logger.warning("Invalid response while updating inventory", extra=fields(status=resp.status, text=text))
                         await asyncio.sleep(3 + 2 * attempt)
                         attempt += 1
                         continue
                     data = await resp.json()
-                    print(data['records'])
-                    break
+                    logger.info("Active orders found by search", extra=fields(records=len(data['records'])))
+                    return data['records']
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while getting active orders: \n {e}")
+                logger.warning("Failed attempt while getting active orders", extra=fields(attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
 
-    async def place_limit_order(self, ticker, class_code, side, price, quantity):
-        url = "https://be.broker.ru/trade-api-bff-operations/api/v1/orders"
-
-
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}"
-        }
+    async def place_limit_order(self, ticker, class_code, side, price, quantity, level=None, client_order_id=None, max_attempts=5, retry_delay=3):
+        url = self.urls["orders"]
 
         price = round(price, 2)
+        if self.risk is not None:
+            self.risk.check(ticker, side, price, quantity) # raises RiskRejected
 
+        # one id for all retries: if a timed out attempt did reach the broker, the retry is refused instead of doubling the order
+        client_order_id = client_order_id or str(uuid.uuid4())
         attempt = 0
-        while True:
-            client_order_id = str(uuid.uuid4())
+        while attempt < max_attempts:
             payload = {
                 "clientOrderId": client_order_id,
                 "side": str(side),
@@ -269,93 +535,152 @@ class BrokerClient:
                 "price": price
             }
             try:
-                async with self.session.post(url, headers=headers, json=payload) as resp:
+                t_sent = time.monotonic_ns()
+                async with self.session.post(url, headers=self.headers["json"], json=payload) as resp:
+                    self.latency.record("place_ack", t_sent)
 
+                    if 400 <= resp.status < 500: # final, retrying the same request gets the same answer
+                        text = await resp.text()
+                        if attempt > 0 and (resp.status == 409 or "duplicate" in text.lower()):
+                            # an earlier attempt did reach the broker: the order exists, the orders websocket brings it in
+                            logger.warning("Order already placed by an earlier attempt", extra=fields(status=resp.status, ticker=ticker, id=client_order_id))
+                            return client_order_id
+                        raise ValueError(f"Bad request while placing order {client_order_id}: {text}")
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while while placing order \n {resp.status} \n {text}")
-                        await asyncio.sleep(3 + 2 * attempt)
+                        logger.warning("Invalid response while placing order", extra=fields(status=resp.status, text=text, ticker=ticker))
+                        await asyncio.sleep(retry_delay + 2 * attempt)
                         attempt += 1
                         continue
 
                     data = await resp.json()
                     client_order_id = data['clientOrderId']
-                    print(f"Placed order for {ticker} at price {price} with quantity {quantity} and id {client_order_id}")
-                    print(data)
-                    self.active_orders[client_order_id] = {
+                    logger.info("Placed order", extra=fields(ticker=ticker, side=side, price=price, quantity=quantity, id=client_order_id))
+                    logger.debug("Place order response", extra=fields(response=data))
+                    self._set_order(client_order_id, {
                         "ticker": ticker,
                         "class_code": class_code,
                         "side": side,
                         "price": price,
                         "quantity": quantity,
-                        "status": '0'
-                    }
+                        "status": '0',
+                        "level": level # ladder level the order manager placed it for, None for orders it doesn't know
+                    })
+                    self._journal("place", client_order_id, ticker=ticker, class_code=class_code, side=side, price=price, quantity=quantity, level=level)
                     return client_order_id
-                    break
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while placing order: \n {e}")
-                await asyncio.sleep(min(3 + 2 * attempt, 60))
+                logger.warning("Failed attempt while placing order", extra=fields(attempt=attempt + 1, error=repr(e)))
+                await asyncio.sleep(min(retry_delay + 2 * attempt, 60))
                 attempt += 1
+        raise ConnectionError(f"Failed to place order {client_order_id} with {max_attempts} attempts")
 
-    async def cancel_order(self, id):
-        url = f"https://be.broker.ru/trade-api-bff-operations/api/v1/orders/{id}/cancel"
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
+    async def cancel_order(self, id, max_attempts=None, retry_delay=3):
+        url = self.urls["order_cancel"].format(id=id)
 
+        new_id = str(uuid.uuid4())
         attempt = 0
-        while True:
-            new_id = str(uuid.uuid4())
+        while max_attempts is None or attempt < max_attempts:
             payload = {
                 "clientOrderId": new_id
             }
             try:
-                async with self.session.post(url, headers=headers, json=payload) as resp:
+                t_sent = time.monotonic_ns()
+                async with self.session.post(url, headers=self.headers["json"], json=payload) as resp:
+                    self.latency.record("cancel_ack", t_sent)
                     if resp.status == 400 or resp.status == 404:
                         text = await resp.text()
                         raise ValueError(f"Bad request while cancelling order {id}: {text}")
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while canceling order \n {resp.status} \n {text}")
-                        await asyncio.sleep(3 + 2 * attempt)
+                        logger.warning("Invalid response while canceling order", extra=fields(status=resp.status, text=text, id=id))
+                        await asyncio.sleep(retry_delay + 2 * attempt)
                         attempt += 1
                         continue
-                    print(f"Canceled order {id}")
-                    self.active_orders.pop(id, None)
-                    break
+                    logger.info("Canceled order", extra=fields(id=id))
+                    self._drop_order(id)
+                    self._journal("cancel", id)
+                    return
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while canceling order: \n {e}")
-                await asyncio.sleep(min(3 + 2 * attempt, 60))
+                logger.warning("Failed attempt while canceling order", extra=fields(attempt=attempt + 1, error=repr(e)))
+                await asyncio.sleep(min(retry_delay + 2 * attempt, 60))
                 attempt += 1
+        raise ConnectionError(f"Failed to cancel order {id} with {max_attempts} attempts")
+
+    async def cancel_all(self, ticker=None, deadline=5.0, max_attempts=3, retry_delay=0.2):
+        # every open order (of one ticker, if given) is cancelled concurrently; returns ids still open after the deadline
+        t_start = time.monotonic_ns()
+        ids = [order_id for order_id, order in self.active_orders.items() if ticker is None or order["ticker"] == ticker]
+        if not ids:
+            return []
+
+        async def cancel(order_id):
+            try:
+                await self.cancel_order(order_id, max_attempts=max_attempts, retry_delay=retry_delay)
+            except ValueError: #already filled or cancelled
+                self._drop_order(order_id)
+
+        tasks = {asyncio.create_task(cancel(order_id)): order_id for order_id in ids}
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+        failed = [tasks[task] for task in pending]
+        failed += [tasks[task] for task in done if task.exception() is not None]
+
+        self.latency.record("cancel_all", t_start)
+        log = logger.error if failed else logger.info
+        log("Cancelled all orders", extra=fields(ticker=ticker, orders=len(ids), failed=failed,
+                                                 ms=(time.monotonic_ns() - t_start) / 1e6))
+        return failed
+
+    async def kill(self, reason, ticker=None):
+        # kill switch: stop quoting and flatten the book of open orders; triggered manually (SIGUSR1) or by a risk
+        # limit breach. Stays engaged until resume() (SIGUSR2 in main)
+        logger.critical("Kill switch engaged", extra=fields(reason=reason, ticker=ticker, open_orders=len(self.active_orders)))
+        self.killed = True
+        self.halted = True
+        return await self.cancel_all(ticker=ticker)
+
+    def resume(self):
+        self.killed = False
+        self.halted = bool(self.feeds_down)
+        logger.warning("Kill switch released", extra=fields(halted_for_feeds=sorted(self.feeds_down)))
+
+    async def feed_lost(self, name):
+        # quoting blind is worse than not quoting at all: halt and flatten on every unexpected disconnect,
+        # quoting comes back by itself once the feed delivers data again (feed_restored)
+        self.feeds_down.add(name)
+        self.halted = True
+        logger.error("Market data lost, cancelling all orders", extra=fields(ws=name, open_orders=len(self.active_orders)))
+        return await self.cancel_all()
+
+    def feed_restored(self, name):
+        self.feeds_down.discard(name)
+        if not self.feeds_down and not self.killed:
+            self.halted = False
+        logger.warning("Market data is back", extra=fields(ws=name, quoting=not self.halted))
 
     async def get_order_status(self, id):
-        url = f"https://be.broker.ru/trade-api-bff-operations/api/v1/orders/{id}"
+        url = self.urls["order"].format(id=id)
         payload = {
             "originalClientOrderId": id
         }
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
 
         attempt = 0
         while True:
             try:
-                async with self.session.get(url, headers=headers, data=payload) as resp:
+                async with self.session.get(url, headers=self.headers["get"], data=payload) as resp:
                     if resp.status == 400 or resp.status == 404:
                         raise ValueError("Unable to get order status, the order is likely gone")
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while updating order status \n {resp.status} \n {text}")
+                        logger.warning("Invalid response while updating order status", extra=fields(status=resp.status, text=text, id=id))
                         await asyncio.sleep(3 + 2 * attempt)
                         attempt += 1
                         continue
                     data = await resp.json()
                     return data
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while getting order status: \n {e}")
+                logger.warning("Failed attempt while getting order status", extra=fields(attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
 
@@ -364,33 +689,37 @@ class BrokerClient:
             try:
                 order_status = await self.get_order_status(id=order_id)
             except ValueError:
-                self.active_orders.pop(order_id, None)
+                self._drop_order(order_id)
+                self._journal("cancel", order_id)
                 continue
 
             if order_status['data']['orderStatus'] in ['2', '4', '6', '8']:
                 if order_id in self.active_orders:
-                    self.active_orders.pop(order_id, None)
+                    self._drop_order(order_id)
+                    self._journal("status", order_id, status=order_status['data']['orderStatus'], quantity=order_status['data'].get('remainedQuantity'))
             elif order_status['data']['orderStatus'] == '1':
                 if order_id in self.active_orders:
                     self.active_orders[order_id]['quantity'] = order_status['data']['remainedQuantity']
+                    self._set_order(order_id, self.active_orders[order_id])
             else:
                 if order_id in self.active_orders:
                     self.active_orders[order_id]['status'] = order_status['data']['orderStatus']
-        print(f"Current active orders: \n {self.active_orders}")
+        logger.debug("Current active orders", extra=fields(active_orders=dict(self.active_orders)))
 
-    async def edit_order(self, id, price, quantity):
-        url = f"https://be.broker.ru/trade-api-bff-operations/api/v1/orders/{id}"
+    async def edit_order(self, id, price, quantity, level=None, new_id=None, max_attempts=5, retry_delay=3):
+        url = self.urls["order"].format(id=id)
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
         price = round(price, 2)
-
+        order = self.active_orders.get(id)
+        if order is None:
+            # unknown side and ticker: the edit could neither be risk checked nor booked once acked
+            raise ValueError(f"Order {id} is not active, not editing it")
+        if self.risk is not None:
+            self.risk.check(order['ticker'], order['side'], price, quantity, replaces=id) # raises RiskRejected
+
+        new_id = new_id or str(uuid.uuid4())
         attempt = 0
-        while True:
-            new_id = str(uuid.uuid4())
+        while attempt < max_attempts:
             payload = {
                 "clientOrderId": new_id,
                 "price": price,
@@ -398,52 +727,58 @@ class BrokerClient:
             }
 
             try:
-                async with self.session.post(url, headers=headers, json=payload) as resp:
-                    if resp.status == 400 or resp.status == 404:
+                t_sent = time.monotonic_ns()
+                async with self.session.post(url, headers=self.headers["json"], json=payload) as resp:
+                    self.latency.record("edit_ack", t_sent)
+                    if 400 <= resp.status < 500:
                         text = await resp.text()
                         raise ValueError(f"Bad request while editing order {id}: {text}")
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while editing order order \n {resp.status} \n {text}")
-                        await asyncio.sleep(3 + 2 * attempt)
+                        logger.warning("Invalid response while editing order", extra=fields(status=resp.status, text=text, id=id))
+                        await asyncio.sleep(retry_delay + 2 * attempt)
                         attempt += 1
                         continue
 
                     side, ticker, class_code = self.active_orders[id]['side'], self.active_orders[id]['ticker'], self.active_orders[id]['class_code']
-                    self.active_orders.pop(id, None)
-                    self.active_orders[new_id] = {
+                    if level is None:
+                        level = self.active_orders[id].get('level')
+                    self._drop_order(id)
+                    self._set_order(new_id, {
                         "ticker": ticker,
                         "class_code": class_code,
                         "side": side,
                         "price": price,
                         "quantity": quantity,
-                        "status": '0'
-                    }
-                    print(f"edited order {id} with ticker {ticker} \n new price {price}, quantity = {quantity}")
+                        "status": '0',
+                        "level": level
+                    })
+                    self._journal("edit", new_id, orig_id=id, price=price, quantity=quantity, level=level)
+                    logger.info("Edited order", extra=fields(id=id, new_id=new_id, ticker=ticker, price=price, quantity=quantity))
                     return new_id
-                    break
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while canceling order: \n {e}")
-                await asyncio.sleep(min(3 + 2 * attempt, 60))
+                logger.warning("Failed attempt while editing order", extra=fields(attempt=attempt + 1, error=repr(e)))
+                await asyncio.sleep(min(retry_delay + 2 * attempt, 60))
                 attempt += 1
+        raise ConnectionError(f"Failed to edit order {id} with {max_attempts} attempts")
 
     async def start_forced_orders_dict_refresher(self):
         while True:
-            print("updating orders...")
+            logger.debug("Updating orders")
             await self.force_update_orders_dict_status()
             await asyncio.sleep(10)
 
     async def get_current_price(self, ticker, class_code): # will be used to get spot price of the underlying asset to solve Black-Scholes equation
-        url = "https://be.broker.ru/trade-api-market-data-connector/api/v1/candles-chart"
+        price = self.spot.price(ticker) #streamed by start_spot_ws, REST candles are only a fallback
+        if price is not None:
+            return price
+
+        url = self.urls["candles"]
 
         end_date = datetime.now(timezone.utc)
         start_date = end_date - timedelta(days=40)
         start_date_str = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
         end_date_str = end_date.strftime("%Y-%m-%dT%H:%M:%SZ")
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}"
-        }
         payload = {
             "classCode": class_code,
             "ticker": ticker,
@@ -455,28 +790,29 @@ class BrokerClient:
         attempt = 0
         while True:
             try:
-                async with self.session.get(url, headers=headers, params=payload) as resp:
+                async with self.session.get(url, headers=self.headers["get"], params=payload) as resp:
                     if resp.status != 200:
                         text = await resp.text()
-                        print(f"Invalid response while getting candles \n {resp.status} \n {text}")
+                        logger.warning("Invalid response while getting candles", extra=fields(status=resp.status, text=text))
                         await asyncio.sleep(3 + 2 * attempt)
                         attempt += 1
                         continue
                     data = await resp.json()
                     candles = data.get("bars", [])
                     if candles:
-                        print(f"Got current price of {ticker}: {candles[0]['close']}")
+                        logger.debug("Got current price from candles", extra=fields(ticker=ticker, price=candles[0]['close']))
                         return candles[0]['close']
                     else:
                         return None
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Failed attempt {attempt + 1} while getting order status: \n {e}")
+                logger.warning("Failed attempt while getting candles", extra=fields(attempt=attempt + 1, error=repr(e)))
                 await asyncio.sleep(min(3 + 2 * attempt, 60))
                 attempt += 1
 
 
 class MVPStrategy:
-    def __init__(self, client, order_manager, ticker, class_code, order_size, inventory_limit, inventory_k):
+    def __init__(self, client, order_manager, ticker, class_code, order_size, inventory_limit, inventory_k, fair_value="mid", requote=None,
+                 levels=1, level_spacing_ticks=2, level_size_decay=1.0):
         self.client = client
         self.order_manager = order_manager
         self.ticker = ticker
@@ -484,16 +820,28 @@ class MVPStrategy:
         self.order_size = order_size
         self.inventory_limit = inventory_limit
         self.inventory_k = inventory_k
+        self.fair_value = fair_value # mid, microprice, imbalance or ewma
+        self.requote = requote or RequotePolicy() # RequotePolicy(min_ticks=0, min_interval=0, hysteresis_ticks=0, qty_tolerance=0) sends everything
+        self.levels = levels # orders per side, level 0 at the quoted price and every next one level_spacing_ticks further away
+        self.level_spacing_ticks = level_spacing_ticks
+        self.level_size_decay = level_size_decay # size of level i is order size * decay**i
 
         self.inventory = None
         self.best_bid = None
         self.best_ask = None
+        self.book = OrderBook(ticker, class_code)
+        if client.risk is not None:
+            client.risk.set_book(ticker, self.book) # collar reference
+        self.signals = BookSignals()
+        self.volatility = RealizedVolatility()
+        self.intensity = TradeIntensity()
 
     async def run(self):
         while True:
             done, pending = await asyncio.wait(
                 [
-                    asyncio.create_task(self.client.q_orderbooks.get()), # have to add ticker comparison in the future for multiple assets trading
+                    asyncio.create_task(self.client.q_orderbooks.get()),
+                    asyncio.create_task(self.client.q_orderflow.get()),
                     asyncio.create_task(self.client.q_inventory.get())
                 ],
                 return_when=asyncio.FIRST_COMPLETED,
@@ -502,28 +850,53 @@ class MVPStrategy:
             for task in pending:
                 task.cancel()
 
+            t_event = None
             for task in done:
                 data = task.result()
 
-                if "depth" in data:
-                    self.best_ask, self.best_bid = self.get_best_bid_and_asks_from_orderbook(data)
+                if "responseType" in data: #market data, subscription confirmations are skipped
+                    if data.get("ticker") != self.ticker:
+                        continue
+                    t_event = data.get("_t_recv")
+                    self.client.latency.record("market_data_queue", t_event)
+                    if data["responseType"] == "OrderBook":
+                        self.book.update(data)
+                        self.client.history.on_order_book(self.ticker, self.book)
+                        self.signals.update(self.book)
+                        self.volatility.update(time.monotonic(), self.book.mid)
+                        self.best_bid, self.best_ask = self.get_best_bid_and_asks_from_orderbook(self.book)
+                    elif data["responseType"] == "LastTrades":
+                        self.client.history.on_trade(data)
+                        self.intensity.update(time.monotonic(), data["price"], self.book.mid)
                 else:
                     self.inventory = data.get(self.ticker, 0)
-                    print(f"Current inventory: {self.inventory}")
+                    if should_sample("inventory", 60):
+                        logger.debug("Current inventory", extra=fields(ticker=self.ticker, inventory=self.inventory, sampled_every=60))
 
             if self.inventory is None:
-                print("Inventory missing(")
+                if should_sample("inventory_missing", 100):
+                    logger.warning("Inventory missing", extra=fields(ticker=self.ticker, sampled_every=100))
                 continue
-            orders = self.generate_orders_simple()
-            #orders = self.generate_orders_as(sigma=0.1, gamma=0.1, k=1.5, tau=1)
+            t_quote = time.monotonic_ns()
+            orders = self.ladder(self.generate_orders_simple())
+            #orders = self.ladder(self.generate_orders_as(gamma=0.1, tau=1))
+            self.client.latency.record("strategy", t_quote)
+            if orders:
+                orders = self.requote.filter(orders, active_orders=self.client.active_orders)
+                if should_sample("requote", 1000):
+                    logger.info("Requote stats", extra=fields(ticker=self.ticker, **self.requote.snapshot(), sampled_every=1000))
             if orders:
+                t_submit = time.monotonic_ns()
+                for order in orders:
+                    order["_t_recv"] = t_event
+                    order["_t_submit"] = t_submit
                 await self.order_manager.submit_orders(orders)
 
     def generate_orders_simple(self):
         if self.best_bid is None or self.best_ask is None:
             return None
 
-        mid = (self.best_bid + self.best_ask) / 2
+        mid = (self.best_bid + self.best_ask) / 2 + self.signals.fair_value_offset(self.fair_value)
         half_spread = abs((self.best_ask - self.best_bid)) / 2
 
         inventory_shift = self.inventory_k * self.inventory
@@ -580,12 +953,42 @@ class MVPStrategy:
             orders.append(ask_order)
         return orders if orders else None
 
-    def generate_orders_as(self, sigma, gamma, k, tau):
+    def ladder(self, orders):
+        # expands the single bid/ask of a generator into self.levels orders per side; sells stay within inventory,
+        # buys within the room left under inventory_limit, summed over the levels
+        if not orders:
+            return orders
+        ladder = []
+        for order in orders:
+            direction = -1 if order["side"] == '1' else 1
+            remaining = self.inventory if order["side"] == '2' else self.inventory_limit - self.inventory
+            for level in range(self.levels):
+                quantity = min(round(order["quantity"] * self.level_size_decay ** level), remaining)
+                remaining -= quantity
+                if quantity <= 0:
+                    break
+                price = round(order["price"] + direction * level * self.level_spacing_ticks * TICK_SIZE, 2)
+                if price <= 0:
+                    break
+                ladder.append({**order, "price": price, "quantity": quantity, "level": level})
+        return ladder
+
+    def generate_orders_as(self, gamma, tau, k=None, sigma=None, default_k=1.5, default_sigma=0.1):
+        # tau in seconds, so sigma (and default_sigma) is in price units per sqrt(second), RealizedVolatility's unit
         if self.best_bid is None or self.best_ask is None:
             return None
         q = self.inventory
 
-        s =  (self.best_bid + self.best_ask) / 2 #mid
+        if sigma is None: #live estimate once enough books were seen
+            sigma = self.volatility.sigma
+            if sigma is None:
+                sigma = default_sigma
+        if k is None: #fitted order arrival intensity
+            k = self.intensity.k
+            if k is None:
+                k = default_k
+
+        s =  (self.best_bid + self.best_ask) / 2 + self.signals.fair_value_offset(self.fair_value) #mid
         r = s - q * gamma * sigma**2 * tau   #optimal mid price
         delta = 1/gamma * math.log(1 + gamma/k) + 1/2 * gamma * sigma**2 * tau #half spread
 
@@ -629,142 +1032,151 @@ class MVPStrategy:
             orders.append(ask_order)
         return orders if orders else None
 
-    def get_best_bid_and_asks_from_orderbook(self, orderbook): #we have to exclude our own orders from orderbook to find real best bid and ask
-        bids = orderbook.get("bids", [])
-        asks = orderbook.get("asks", [])
-
-        my_bid_volume_by_price = {}
-        my_ask_volume_by_price = {}
+    def get_best_bid_and_asks_from_orderbook(self, book): #we have to exclude our own orders from orderbook to find real best bid and ask
+        my_bid_volume_by_ticks = {}
+        my_ask_volume_by_ticks = {}
 
         for order in self.client.active_orders.values():
             if order["ticker"] != self.ticker:
                 continue
 
-            price = order["price"]
-            price = round(price, 2)
+            ticks = price_to_ticks(order["price"])
             qty = order["quantity"]
 
             if order["side"] == '1':
-                my_bid_volume_by_price[price] = my_bid_volume_by_price.get(price, 0) + qty
+                my_bid_volume_by_ticks[ticks] = my_bid_volume_by_ticks.get(ticks, 0) + qty
             else:
-                my_ask_volume_by_price[price] = my_ask_volume_by_price.get(price, 0) + qty
-
-        external_best_bid = None
-        external_best_ask = None
-
-        for level in bids:
-            price = level["price"]
-            price = round(price, 2)
-            size = level["quantity"]
-
-            my_size = my_bid_volume_by_price.get(price, 0)
-            external_size = size - my_size
-
-            if external_size > 0:
-                external_best_bid = price
-                break
+                my_ask_volume_by_ticks[ticks] = my_ask_volume_by_ticks.get(ticks, 0) + qty
 
-        for level in asks:
-            price = level["price"]
-            price = round(price, 2)
-            size = level["quantity"]
-
-            my_size = my_ask_volume_by_price.get(price, 0)
-            external_size = size - my_size
-
-            if external_size > 0:
-                external_best_ask = price
-                break
-
-        return external_best_bid, external_best_ask
+        return book.external_best_bid_and_ask(my_bid_volume_by_ticks, my_ask_volume_by_ticks)
 
 class OrderManager:
     def __init__(self, client):
         self.client = client
         self.q_desired_orders = asyncio.Queue()
+        self.diff_engine = OrderDiffEngine()
 
     async def submit_orders(self, desired_orders):
         await self.q_desired_orders.put(desired_orders)
 
+    async def _place(self, client_id, desired):
+        try:
+            await self.client.place_limit_order(
+                ticker=desired['ticker'],
+                class_code=desired['class_code'],
+                side=desired['side'],
+                price=desired['price'],
+                quantity=desired['quantity'],
+                level=desired.get('level', 0),
+                client_order_id=client_id
+            )
+            self.client.latency.record("tick_to_trade", desired.get("_t_recv"))
+        except RiskRejected as e:
+            self._rejected(desired, e)
+        except ValueError as e: # refused, nothing was placed
+            logger.warning("Failed to place order", extra=fields(id=client_id, ticker=desired['ticker'], error=str(e)))
+        except ConnectionError as e: # may have reached the broker: stays pending until it shows up or the pending state expires
+            logger.warning("Gave up placing order", extra=fields(id=client_id, ticker=desired['ticker'], error=repr(e)))
+            return
+        self.diff_engine.resolve(client_id)
+
+    async def _edit(self, order_id, new_id, desired):
+        try:
+            await self.client.edit_order(id=order_id, price=desired['price'], quantity=desired['quantity'],
+                                         level=desired.get('level', 0), new_id=new_id)
+            self.client.latency.record("tick_to_trade", desired.get("_t_recv"))
+        except ValueError:
+            # the old order may still be live, so no new one goes in before it is cancelled (next cycles)
+            logger.warning("Failed to edit, cancelling the order instead", extra=fields(id=order_id))
+            self.diff_engine.edit_failed(order_id, new_id)
+            await self._cancel(order_id)
+            return
+        except ConnectionError as e: # outcome unknown, both ids stay pending until active orders show it or they expire
+            logger.warning("Gave up editing order", extra=fields(id=order_id, error=repr(e)))
+            return
+        except RiskRejected as e:
+            self._rejected(desired, e)
+        self.diff_engine.resolve(order_id)
+        self.diff_engine.resolve(new_id)
+
+    async def _cancel(self, order_id):
+        try:
+            await self.client.cancel_order(id=order_id, max_attempts=3, retry_delay=0.2)
+        except ValueError:
+            pass
+        except ConnectionError as e: # stays pending, its level is frozen until the order is gone or the pending state expires
+            logger.warning("Failed to cancel redundant order", extra=fields(id=order_id, error=repr(e)))
+            return
+        self.diff_engine.resolve(order_id)
+
+    def _rejected(self, desired, e):
+        if should_sample("risk_rejected", 10):
+            logger.warning("Order rejected by risk gate", extra=fields(ticker=desired['ticker'], side=desired['side'], level=desired.get('level'),
+                                                                    price=desired['price'], reason=e.reason, error=str(e), sampled_every=10))
+
     async def run(self):
         while True:
             desired_orders = await self.q_desired_orders.get()
-            print(f"Desired orders: \n {desired_orders}")
-            print(f"Active orders \n {self.client.active_orders}")
-
-            occupied_ids = []
-            for desired_order in desired_orders:
-                current_orders = self.client.active_orders  #get the freshest one each time
-                order_to_edit = None
-                order_id_to_edit = None
-
-                for client_id, order in current_orders.items():
-                    if order["ticker"] == desired_order["ticker"] and order["side"] == desired_order["side"]: #and client_id not in occupied_ids:
-                        order_to_edit = order
-                        order_id_to_edit = client_id
-                        break
-
-                if order_to_edit is None:
-                    print(f"Found no matches for side {desired_order['side']}, so placing a new order")
-                    order_id = await self.client.place_limit_order(
-                        ticker=desired_order['ticker'],
-                        class_code=desired_order['class_code'],
-                        side=desired_order['side'],
-                        price=desired_order['price'],
-                        quantity=desired_order['quantity']
-                    )
-                    occupied_ids.append(order_id)
-                else:
-                    print(f"Found a match for side {desired_order['side']}")
-                    occupied_ids.append(order_id_to_edit)
-                    if (
-                            abs(desired_order['price'] - order_to_edit['price']) >= 0.01 or
-                            desired_order['quantity'] != order_to_edit['quantity']
-                    ):
-                        print(f"Trying to edit for side {desired_order['side']}")
-                        try:
-                            order_id = await self.client.edit_order(id=order_id_to_edit, price=desired_order['price'], quantity=desired_order['quantity'])
-                            occupied_ids.append(order_id)
-                            print("Edited ")
-                        except ValueError:
-                            print("Failed to edit, placing order now")
-                            order_id = await self.client.place_limit_order(
-                                ticker=desired_order['ticker'],
-                                class_code=desired_order['class_code'],
-                                side=desired_order['side'],
-                                price=desired_order['price'],
-                                quantity=desired_order['quantity']
-                            )
-                            occupied_ids.append(order_id)
-
-            # #cancelling redundant orders
-            for client_id, order in list(current_orders.items()):
-                 if client_id not in occupied_ids:
-                     try:
-                        await self.client.cancel_order(id=client_id)
-                     except ValueError:
-                         continue
-
-
+            if self.client.halted:
+                continue
+            t_cycle = time.monotonic_ns()
+            if desired_orders:
+                self.client.latency.record("manager_queue", desired_orders[0].get("_t_submit"), t_cycle)
+            if logger.isEnabledFor(logging.DEBUG) and should_sample("manager_cycle", 20):
+                logger.debug("Order manager cycle", extra=fields(desired=desired_orders, active=dict(self.client.active_orders), sampled_every=20))
+
+            actions = self.diff_engine.diff(desired_orders, self.client.active_orders)
+            # cancels first so they free risk capacity for the new levels, then all edits and places at once
+            await asyncio.gather(*(self._cancel(order_id) for order_id in actions.cancel))
+            await asyncio.gather(*(self._edit(order_id, new_id, order) for order_id, new_id, order in actions.edit),
+                                 *(self._place(client_id, order) for client_id, order in actions.place))
+
+            self.client.latency.record("manager_cycle", t_cycle)
             await asyncio.sleep(1)
 
 async def main():
     token = os.getenv("BKS_TOKEN")
     client = BrokerClient(token)
+    client.cancel_on_disconnect = True # a market data feed dropping halts quoting and cancels every order
     await client.start()
+    client.journal = OrderJournal() # data/orders_journal.sqlite
+    await client.recover_from_journal(since=time.time() - 24 * 3600)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(client.kill("manual"))) # kill -USR1 <pid>
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, client.resume) # kill -USR2 <pid> releases it
+
+    # option limits by default; the hedger trades SBER in lots of 10 shares and its position is in shares
+    client.set_risk_gate(RiskGate(max_order_qty=20, max_position=10, max_orders_per_second=5,
+                                  ticker_limits={"SBER": {"max_order_qty": 200, "max_position": 3000, "lot_size": 10}}))
 
     order_manager = OrderManager(client=client)
-    strategy = MVPStrategy(client, order_manager, "SR310CC6", "OPTSPOT",5, 10, 0.0)
+    background = {
+        asyncio.create_task(client.start_token_refresher()),
+        asyncio.create_task(client.latency.run_exporter()), # data/latency.json, or client.latency.start_prometheus_server(extra=[client.risk.to_prometheus])
+        asyncio.create_task(loop_monitor.LoopLagMonitor(latency=client.latency).run()),
+    }
     task = asyncio.create_task(client.start_orderflow_ws(instruments=[{"ticker": "SBER", "classCode": "TQBR"}]))
     # task0 = asyncio.create_task(client.start_orders_ws())
     # task1 = asyncio.create_task(client.start_order_book_ws(ticker="SR310CC6", class_code="OPTSPOT", depth=5))
     # task2 = asyncio.create_task(client.start_inventory_refresher())
+    # strategy = MVPStrategy(client, order_manager, "SR310CC6", "OPTSPOT",5, 10, 0.0, levels=3, level_size_decay=0.7)
     # task3 = asyncio.create_task(strategy.run())
     # task4 = asyncio.create_task(order_manager.run())
     # task5 = asyncio.create_task(client.start_forced_orders_dict_refresher())
+    # catalog = await InstrumentCatalog("SBER").load(client.session, client.access_token) # from instruments import InstrumentCatalog
+    # hedger = DeltaHedger(client, catalog.option_specs(["SR310CC6"])) # from hedger import DeltaHedger
+    # task6 = asyncio.create_task(hedger.run())
+    # task7 = asyncio.create_task(client.start_spot_ws(instruments=[{"ticker": "SBER", "classCode": "TQBR"}]))
     #
-    await asyncio.gather(task)
-    await client.close()
+    try:
+        await asyncio.gather(task)
+    finally:
+        for background_task in background:
+            background_task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        client.history.dump_parquet(os.path.join(os.path.dirname(__file__), "..", "data", "history"))
+        await client.close()
+        client.journal.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging(level=os.getenv("LOG_LEVEL", "INFO"))
+    loop_monitor.run(main(), use_uvloop=os.getenv("USE_UVLOOP") == "1")
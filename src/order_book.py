@@ -0,0 +1,170 @@
+import numpy as np
+
+TICK_SIZE = 0.01
+MAX_DEPTH = 20
+
+
+def price_to_ticks(price):
+    return int(round(price / TICK_SIZE))
+
+
+def ticks_to_price(ticks):
+    return round(ticks * TICK_SIZE, 2)
+
+
+class OrderBook:
+    # parsed once on arrival: prices are stored as integer ticks, level 0 is the top of the book,
+    # cumulative quantities are filled during parsing so depth sums are O(1)
+    __slots__ = (
+        "ticker", "class_code", "timestamp", "depth",
+        "bid_ticks", "bid_qty", "bid_cum", "n_bids",
+        "ask_ticks", "ask_qty", "ask_cum", "n_asks",
+    )
+
+    def __init__(self, ticker=None, class_code=None, depth=MAX_DEPTH):
+        self.ticker = ticker
+        self.class_code = class_code
+        self.timestamp = None
+        self.depth = depth
+
+        self.bid_ticks = np.zeros(depth, dtype=np.int64)
+        self.bid_qty = np.zeros(depth, dtype=np.float64)
+        self.bid_cum = np.zeros(depth, dtype=np.float64)
+        self.n_bids = 0
+
+        self.ask_ticks = np.zeros(depth, dtype=np.int64)
+        self.ask_qty = np.zeros(depth, dtype=np.float64)
+        self.ask_cum = np.zeros(depth, dtype=np.float64)
+        self.n_asks = 0
+
+    @classmethod
+    def from_message(cls, data, depth=MAX_DEPTH):
+        book = cls(data.get("ticker"), data.get("classCode"), depth)
+        book.update(data)
+        return book
+
+    def update(self, data): # raw OrderBook websocket message
+        if data.get("ticker") is not None:
+            self.ticker = data["ticker"]
+        if data.get("classCode") is not None:
+            self.class_code = data["classCode"]
+        self.timestamp = data.get("dateTime")
+        self.set_levels(data.get("bids", []), data.get("asks", []))
+        return self
+
+    def set_levels(self, bids, asks): # lists of {'price', 'quantity'} dicts
+        self.n_bids = self._fill(bids or (), self.bid_ticks, self.bid_qty, self.bid_cum)
+        self.n_asks = self._fill(asks or (), self.ask_ticks, self.ask_qty, self.ask_cum)
+        return self
+
+    def set_tick_levels(self, bids, asks): # lists of (ticks, quantity), as book_codec decodes them
+        self.n_bids = self._fill_ticks(bids, self.bid_ticks, self.bid_qty, self.bid_cum)
+        self.n_asks = self._fill_ticks(asks, self.ask_ticks, self.ask_qty, self.ask_cum)
+        return self
+
+    def _fill_ticks(self, levels, ticks, qty, cum):
+        n = 0
+        total = 0.0
+        for level_ticks, size in levels[:self.depth]:
+            ticks[n] = level_ticks
+            qty[n] = size
+            total += size
+            cum[n] = total
+            n += 1
+        return n
+
+    def _fill(self, levels, ticks, qty, cum):
+        n = 0
+        total = 0.0
+        for level in levels:
+            if n >= self.depth:
+                break
+            ticks[n] = int(round(level["price"] / TICK_SIZE))
+            size = level["quantity"]
+            qty[n] = size
+            total += size
+            cum[n] = total
+            n += 1
+        return n
+
+    @property
+    def best_bid(self):
+        return ticks_to_price(self.bid_ticks[0]) if self.n_bids else None
+
+    @property
+    def best_ask(self):
+        return ticks_to_price(self.ask_ticks[0]) if self.n_asks else None
+
+    @property
+    def best_bid_qty(self):
+        return float(self.bid_qty[0]) if self.n_bids else 0.0
+
+    @property
+    def best_ask_qty(self):
+        return float(self.ask_qty[0]) if self.n_asks else 0.0
+
+    @property
+    def mid(self):
+        if not self.n_bids or not self.n_asks:
+            return None
+        return (self.bid_ticks[0] + self.ask_ticks[0]) * TICK_SIZE / 2
+
+    @property
+    def spread(self):
+        if not self.n_bids or not self.n_asks:
+            return None
+        return ticks_to_price(self.ask_ticks[0] - self.bid_ticks[0])
+
+    def bid_depth(self, levels=None):
+        n = self.n_bids if levels is None else min(levels, self.n_bids)
+        return float(self.bid_cum[n - 1]) if n > 0 else 0.0
+
+    def ask_depth(self, levels=None):
+        n = self.n_asks if levels is None else min(levels, self.n_asks)
+        return float(self.ask_cum[n - 1]) if n > 0 else 0.0
+
+    @property
+    def microprice(self): # top of book mid weighted by the opposite side size
+        if not self.n_bids or not self.n_asks:
+            return None
+        bid_qty = self.bid_qty[0]
+        ask_qty = self.ask_qty[0]
+        if bid_qty + ask_qty <= 0:
+            return self.mid
+        return float(self.bid_ticks[0] * ask_qty + self.ask_ticks[0] * bid_qty) / (bid_qty + ask_qty) * TICK_SIZE
+
+    def imbalance(self, levels=1): # in [-1, 1], positive when bids dominate
+        bid_depth = self.bid_depth(levels)
+        ask_depth = self.ask_depth(levels)
+        total = bid_depth + ask_depth
+        if total <= 0:
+            return 0.0
+        return (bid_depth - ask_depth) / total
+
+    def bids(self):
+        return [(ticks_to_price(self.bid_ticks[i]), float(self.bid_qty[i])) for i in range(self.n_bids)]
+
+    def asks(self):
+        return [(ticks_to_price(self.ask_ticks[i]), float(self.ask_qty[i])) for i in range(self.n_asks)]
+
+    def external_best_bid_and_ask(self, own_bid_qty_by_ticks, own_ask_qty_by_ticks):
+        # first level on each side that still has volume once our own orders are taken out
+        external_best_bid = None
+        external_best_ask = None
+
+        for i in range(self.n_bids):
+            ticks = int(self.bid_ticks[i])
+            if self.bid_qty[i] - own_bid_qty_by_ticks.get(ticks, 0) > 0:
+                external_best_bid = ticks_to_price(ticks)
+                break
+
+        for i in range(self.n_asks):
+            ticks = int(self.ask_ticks[i])
+            if self.ask_qty[i] - own_ask_qty_by_ticks.get(ticks, 0) > 0:
+                external_best_ask = ticks_to_price(ticks)
+                break
+
+        return external_best_bid, external_best_ask
+
+    def __repr__(self):
+        return f"OrderBook({self.ticker}, bid={self.best_bid}x{self.best_bid_qty}, ask={self.best_ask}x{self.best_ask_qty})"
@@ -0,0 +1,145 @@
+import time
+import uuid
+from collections import namedtuple
+from order_book import price_to_ticks
+
+PENDING_NEW = "pending_new"
+PENDING_EDIT = "pending_edit"
+PENDING_CANCEL = "pending_cancel"
+
+Actions = namedtuple("Actions", ["place", "edit", "cancel"]) # [(client id, desired)], [(order id, new id, desired)], [order id]
+
+
+class OrderDiffEngine:
+    # turns (desired orders, active orders) into the minimal list of place/edit/cancel requests. Client ids are made
+    # here, before anything is sent, and every id stays "pending" until the request is resolved, so an order whose
+    # request is still in flight (or whose edit failed and may still be live) keeps its slot and is never placed twice
+    def __init__(self, pending_timeout=10.0, new_id=lambda: str(uuid.uuid4())):
+        self.pending_timeout = pending_timeout # after that the broker's view (active orders) wins
+        self.new_id = new_id
+        self.pending = {} # id -> (state, slot, since); slot = (ticker, side, level)
+        self.tickers = set() # tickers the strategy ever quoted; active orders of other tickers (hedges, manual) are not ours
+        self.adopted = {} # id -> level given to a spare (no level: recovered, manual) that already quoted what was wanted
+
+    @staticmethod
+    def slot(order):
+        return order["ticker"], order["side"], order.get("level", 0)
+
+    @staticmethod
+    def slot_of(order): # of an active order, None for orders placed outside the manager
+        return order["ticker"], order["side"], order.get("level")
+
+    def diff(self, desired_orders, active_orders, now=None):
+        now = time.monotonic() if now is None else now
+        self.tickers.update(desired["ticker"] for desired in desired_orders)
+        for order_id, (state, slot, since) in list(self.pending.items()):
+            if now - since > self.pending_timeout or (state == PENDING_NEW and order_id in active_orders):
+                del self.pending[order_id] # acknowledged, or given up on: active_orders is the truth from here
+        for order_id in [order_id for order_id in self.adopted if order_id not in active_orders]:
+            del self.adopted[order_id]
+
+        # slot -> occupant id; a slot whose occupant is in flight is frozen: nothing is sent for it this round
+        slots = {}
+        spares = {}
+        frozen = set()
+        for order_id, (state, slot, since) in self.pending.items():
+            if state == PENDING_CANCEL:
+                if order_id in active_orders: # may still fill, its level waits until it is gone
+                    frozen.add(slot)
+            else:
+                frozen.add(slot)
+                slots[slot] = order_id
+
+        for order_id, order in active_orders.items():
+            if order_id in self.pending or order["ticker"] not in self.tickers:
+                continue
+            level = self._level(order_id, order)
+            slot = (order["ticker"], order["side"], level)
+            if level is None or slot in slots:
+                spares.setdefault(slot[:2], []).append(order_id)
+            else:
+                slots[slot] = order_id
+
+        place, edit = [], []
+        for desired in desired_orders:
+            slot = self.slot(desired)
+            if slot in frozen:
+                slots.pop(slot, None)
+                continue
+            order_id = slots.pop(slot, None)
+            if order_id is None:
+                side_spares = spares.get(slot[:2])
+                if side_spares:
+                    order_id = side_spares.pop()
+                else:
+                    client_id = self.new_id()
+                    self.pending[client_id] = (PENDING_NEW, slot, now)
+                    place.append((client_id, desired))
+                    continue
+            order = active_orders[order_id]
+            same_quote = (price_to_ticks(desired["price"]) == price_to_ticks(order["price"])
+                          and desired["quantity"] == order["quantity"])
+            level = self._level(order_id, order)
+            if same_quote and level is None:
+                self.adopted[order_id] = slot[2] # the level is only ours to know, an edit would just churn the queue position
+            elif not same_quote or level != slot[2]:
+                new_id = self.new_id()
+                self.pending[order_id] = (PENDING_EDIT, slot, now)
+                self.pending[new_id] = (PENDING_NEW, slot, now)
+                edit.append((order_id, new_id, desired))
+
+        cancel = [order_id for slot, order_id in slots.items() if slot not in frozen]
+        for side_spares in spares.values():
+            cancel += side_spares
+        for order_id in cancel:
+            order = active_orders[order_id]
+            self.pending[order_id] = (PENDING_CANCEL, (order["ticker"], order["side"], self._level(order_id, order)), now)
+        return Actions(place, edit, cancel)
+
+    def _level(self, order_id, order):
+        level = order.get("level")
+        return self.adopted.get(order_id) if level is None else level
+
+    def resolve(self, order_id):
+        # the request for this id finished (acknowledged or definitely rejected), active orders reflect it now
+        self.pending.pop(order_id, None)
+
+    def edit_failed(self, order_id, new_id, now=None):
+        # the broker refused the edit, but the old order may still be live: it is cancelled instead and its level
+        # stays frozen until it disappears from the active orders, only then a new order goes in
+        now = time.monotonic() if now is None else now
+        state, slot, since = self.pending.pop(order_id, (None, None, now))
+        self.pending.pop(new_id, None)
+        self.pending[order_id] = (PENDING_CANCEL, slot, now)
+
+
+def naive_diff(desired_orders, active_orders):
+    # the former nested scan, for the benchmark: first active order of the same ticker and side, list membership
+    place, edit, occupied = [], [], []
+    for desired in desired_orders:
+        match = None
+        for order_id, order in active_orders.items():
+            if order["ticker"] == desired["ticker"] and order["side"] == desired["side"] and order_id not in occupied:
+                match = order_id
+                break
+        if match is None:
+            place.append(desired)
+        else:
+            occupied.append(match)
+            edit.append((match, desired))
+    cancel = [order_id for order_id in active_orders if order_id not in occupied]
+    return place, edit, cancel
+
+
+if __name__ == "__main__":
+    # the invariants are checked in tests/test_order_diff.py, this is the benchmark
+    n = 1000
+    active = {f"id{i}": {"ticker": f"T{i // 10}", "class_code": "OPTSPOT", "side": '1' if i % 2 else '2', "level": (i % 10) // 2,
+                         "price": 1.0 + (i % 7) / 100, "quantity": 1} for i in range(n)}
+    desired = [{**order, "price": order["price"] + (0.01 if i % 3 == 0 else 0)} for i, order in enumerate(active.values())]
+    for name, function in (("diff engine", lambda: OrderDiffEngine().diff(desired, active)),
+                           ("nested scan", lambda: naive_diff(desired, active))):
+        start = time.perf_counter()
+        for _ in range(20):
+            function()
+        print(f"{name}: {(time.perf_counter() - start) / 20 * 1e3:.2f} ms for {n} orders")
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from logs import get_logger, fields
+
+logger = get_logger("partitions")
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+
+# tick tables partitioned by day on timestamp (migrations/001_partition_tick_tables.sql, book_codec.CREATE_TABLE);
+# partitions are <table>_YYYYMMDD covering one UTC day, a load bounded to one day only scans that partition
+TABLES = ("orderbooks", "orders", "orderbook_deltas")
+DAYS_AHEAD = 2 # created in advance, a write into a day without a partition fails
+PARTITION_RE = re.compile(r"^(.+)_(\d{8})$")
+
+
+def partition_name(table, day):
+    return f"{table}_{day:%Y%m%d}"
+
+
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+
+async def partitioned_tables(conn, tables=TABLES):
+    # tables not migrated yet are left alone
+    rows = await conn.fetch(
+        """
+        SELECT c.relname FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = ANY($1::text[]) AND pg_table_is_visible(c.oid)
+        """,
+        list(tables)
+    )
+    return [row["relname"] for row in rows]
+
+
+async def ensure_partitions(conn, day=None, days_ahead=DAYS_AHEAD, tables=TABLES):
+    # partitions from `day` (today, UTC) to days_ahead days later; existing ones are skipped
+    day = day or utc_today()
+    created = []
+    for table in await partitioned_tables(conn, tables):
+        for i in range(days_ahead + 1):
+            start = day + timedelta(days=i)
+            name = partition_name(table, start)
+            exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name)
+            if exists:
+                continue
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start} 00:00:00+00') TO ('{start + timedelta(days=1)} 00:00:00+00')"
+            )
+            created.append(name)
+    if created:
+        logger.info("Created partitions", extra=fields(partitions=created))
+    return created
+
+
+async def list_partitions(conn, table):
+    # [(day, partition name)] oldest first, only partitions following the naming scheme
+    rows = await conn.fetch(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = $1 AND pg_table_is_visible(p.oid)
+        """,
+        table
+    )
+    partitions = []
+    for row in rows:
+        match = PARTITION_RE.match(row["relname"])
+        if match is not None and match.group(1) == table:
+            partitions.append((datetime.strptime(match.group(2), "%Y%m%d").date(), row["relname"]))
+    return sorted(partitions)
+
+
+def _write_chunk(writer, path, records):
+    # runs in a thread, conversion and compression would otherwise stall the collector's loop
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(pd.DataFrame([tuple(record) for record in records], columns=list(records[0].keys())), preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema, compression="zstd")
+    else:
+        table = table.cast(writer.schema)
+    writer.write_table(table)
+    return writer
+
+
+async def export_partition(conn, name, path, chunk_size=100_000):
+    # streams the partition through a server side cursor into one parquet file, never the whole day in memory;
+    # written next to its final path and renamed, a file at `path` is always complete. Returns the row count
+    tmp_path = path + ".tmp"
+    writer = None
+    rows = 0
+    try:
+        async with conn.transaction():
+            cursor = await conn.cursor(f"SELECT * FROM {name} ORDER BY ticker, timestamp")
+            while True:
+                records = await cursor.fetch(chunk_size)
+                if not records:
+                    break
+                writer = await asyncio.to_thread(_write_chunk, writer, tmp_path, records)
+                rows += len(records)
+    finally:
+        if writer is not None:
+            await asyncio.to_thread(writer.close)
+    if writer is not None:
+        os.replace(tmp_path, path)
+    return rows
+
+
+async def archive_partitions(conn, retention_days, directory=ARCHIVE_DIR, tables=TABLES, drop=True, today=None):
+    # partitions of days older than retention_days go to <directory>/<table>/<partition>.parquet and, once the file
+    # is written, are dropped. Needs a connection, not a pool: the export cursor lives in a transaction
+    cutoff = (today or utc_today()) - timedelta(days=retention_days)
+    archived = []
+    for table in await partitioned_tables(conn, tables):
+        os.makedirs(os.path.join(directory, table), exist_ok=True)
+        for day, name in await list_partitions(conn, table):
+            if day >= cutoff:
+                break
+            path = os.path.join(directory, table, f"{name}.parquet")
+            rows = await export_partition(conn, name, path)
+            if drop:
+                await conn.execute(f"DROP TABLE {name}")
+            archived.append(name)
+            logger.info("Archived partition", extra=fields(partition=name, rows=rows, path=path if rows else None, dropped=drop))
+    return archived
+
+
+async def run_maintenance(pool, interval=3600, retention_days=None, directory=ARCHIVE_DIR):
+    # next days' partitions every interval; with retention_days, old ones are archived on the same schedule
+    while True:
+        try:
+            await ensure_partitions(pool)
+            if retention_days is not None:
+                async with pool.acquire() as conn:
+                    await archive_partitions(conn, retention_days, directory)
+        except Exception as e:
+            logger.error("Error in partition maintenance", extra=fields(error=repr(e)))
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    import asyncpg
+    from dotenv import load_dotenv
+    from logs import setup_logging
+
+    # one-off retention run: RETENTION_DAYS=30 python src/partitions.py
+    async def main():
+        conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+        try:
+            await ensure_partitions(conn)
+            archived = await archive_partitions(conn, int(os.getenv("RETENTION_DAYS", "30")))
+            print(f"archived {len(archived)} partitions to {ARCHIVE_DIR}")
+        finally:
+            await conn.close()
+
+    load_dotenv()
+    setup_logging(level=os.getenv("LOG_LEVEL", "INFO"))
+    asyncio.run(main())
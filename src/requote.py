@@ -0,0 +1,137 @@
+import time
+from order_book import TICK_SIZE, price_to_ticks
+
+
+class RequotePolicy:
+    # sits between a strategy and the OrderManager and drops quote updates that are not worth an edit: every edit
+    # costs API rate limit and sends us to the back of the queue. A suppressed order is replaced by the one sent
+    # last, so the manager sees no difference and does nothing
+    def __init__(self, min_ticks=1, min_interval=0.5, hysteresis_ticks=3, qty_tolerance=0.2, ack_timeout=3.0, tick_size=TICK_SIZE):
+        # the price rules only hold back moves toward the market, pulling a quote back always goes out at once
+        self.min_ticks = min_ticks # smallest price change worth an edit
+        self.min_interval = min_interval # seconds between edits of one order
+        self.hysteresis_ticks = hysteresis_ticks # a move against the previous one has to be this large, stops flip-flopping
+        self.qty_tolerance = qty_tolerance # relative size increase ignored when the price stays, decreases always go out
+        self.ack_timeout = ack_timeout # seconds a sent quote has to show up in active orders before it counts as dropped
+        self.tick_size = tick_size
+
+        self.last_sent = {} # (ticker, side, level) -> (order, time, direction of the last price move)
+        self.sent = 0
+        self.suppressed = {}
+
+    def _suppress(self, reason):
+        self.suppressed[reason] = self.suppressed.get(reason, 0) + 1
+
+    def reset(self):
+        # forget what was sent, e.g. after the kill switch flattened the book
+        self.last_sent.clear()
+
+    @staticmethod
+    def _live_keys(active_orders):
+        # (ticker, side, level) -> (price ticks, quantity) of the orders actually open
+        live = {}
+        for order in active_orders.values():
+            live[(order["ticker"], order["side"], order.get("level"))] = (price_to_ticks(order["price"]), order["quantity"])
+        return live
+
+    def filter(self, orders, now=None, active_orders=None):
+        # returns the orders to submit, or None when nothing changed compared to what was sent last. With
+        # active_orders, a key whose last sent order is still not live as sent ack_timeout after it was sent
+        # (rejected, refused edit, cancelled by the kill switch, partially filled) is forgotten, so the quote goes out
+        # again instead of being held back forever; before that it may simply not be acknowledged yet
+        now = time.monotonic() if now is None else now
+        result = []
+        changed = False
+        keys = set()
+        live = self._live_keys(active_orders) if active_orders is not None else None
+
+        for order in orders:
+            key = (order["ticker"], order["side"], order.get("level", 0))
+            keys.add(key)
+            last = self.last_sent.get(key)
+            if last is not None and live is not None and now - last[1] > self.ack_timeout:
+                if live.get(key) != (price_to_ticks(last[0]["price"]), last[0]["quantity"]):
+                    last = None
+            if last is None:
+                self.last_sent[key] = (order, now, 0)
+                self.sent += 1
+                changed = True
+                result.append(order)
+                continue
+
+            last_order, last_time, last_direction = last
+            move = round((order["price"] - last_order["price"]) / self.tick_size)
+            direction = (move > 0) - (move < 0)
+            aggressive = direction == (1 if order["side"] == '1' else -1) # bid up or ask down
+
+            if move == 0:
+                if order["quantity"] == last_order["quantity"]:
+                    result.append(dict(last_order))
+                    continue
+                increase = order["quantity"] - last_order["quantity"]
+                if 0 < increase <= self.qty_tolerance * last_order["quantity"]:
+                    self._suppress("quantity")
+                    result.append(dict(last_order))
+                    continue
+            elif aggressive:
+                if abs(move) < self.min_ticks:
+                    self._suppress("price")
+                    result.append(dict(last_order))
+                    continue
+                if direction == -last_direction and abs(move) < self.hysteresis_ticks:
+                    self._suppress("hysteresis")
+                    result.append(dict(last_order))
+                    continue
+                if now - last_time < self.min_interval:
+                    self._suppress("interval")
+                    result.append(dict(last_order))
+                    continue
+
+            self.last_sent[key] = (order, now, direction or last_direction)
+            self.sent += 1
+            changed = True
+            result.append(order)
+
+        for key in list(self.last_sent):
+            if key not in keys: # the side is no longer quoted, the manager cancels it
+                del self.last_sent[key]
+                changed = True
+
+        return result if changed else None
+
+    def snapshot(self):
+        suppressed = sum(self.suppressed.values())
+        return {
+            "sent": self.sent,
+            "suppressed": suppressed,
+            "suppressed_by_reason": dict(self.suppressed),
+            "suppressed_ratio": suppressed / (suppressed + self.sent) if suppressed + self.sent else 0.0,
+        }
+
+    def to_prometheus(self, prefix="mm_requote"):
+        lines = [f"# TYPE {prefix}_sent_total counter", f"{prefix}_sent_total {self.sent}",
+                 f"# TYPE {prefix}_suppressed_total counter"]
+        for reason, count in self.suppressed.items():
+            lines.append(f'{prefix}_suppressed_total{{reason="{reason}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    import numpy as np
+
+    # a noisy fair value around 10.00: a naive requoter edits on every cent of noise
+    rng = np.random.default_rng(0)
+    mids = 10 + np.cumsum(rng.normal(0, 0.004, 20_000)).round(4)
+    policy = RequotePolicy()
+    naive = 0
+    last_prices = None
+    for i, mid in enumerate(mids):
+        orders = [
+            {"ticker": "SR310CG6D", "class_code": "OPTSPOT", "side": '1', "price": round(mid - 0.05, 2), "quantity": 5},
+            {"ticker": "SR310CG6D", "class_code": "OPTSPOT", "side": '2', "price": round(mid + 0.05, 2), "quantity": 5},
+        ]
+        prices = [order["price"] for order in orders]
+        naive += sum(a != b for a, b in zip(prices, last_prices)) if last_prices else 2
+        last_prices = prices
+        policy.filter(orders, now=i * 0.1) # 10 book updates per second
+    print(f"naive edits: {naive}, with policy: {policy.snapshot()}")
@@ -0,0 +1,214 @@
+import time
+from order_book import TICK_SIZE
+from logs import get_logger, fields
+
+logger = get_logger("risk")
+
+
+class RiskRejected(Exception):
+    # not a ValueError on purpose: the order manager treats ValueError on edit as "order is gone, place a new one"
+    def __init__(self, reason, message):
+        super().__init__(f"{reason}: {message}")
+        self.reason = reason
+
+
+class RiskGate:
+    # pre-trade checks in front of place/edit; open exposure is kept as running sums updated on every order event,
+    # so a check is a handful of dict lookups no matter how many orders are open. None disables a limit
+    def __init__(self, max_order_qty=50, max_position=100, max_ticker_notional=None, max_open_notional=None,
+                 max_gross_position=None, max_open_orders=200, collar_ticks=50, collar_pct=0.2,
+                 max_orders_per_second=10, burst=None, multiplier=1, ticker_limits=None, on_breach=None):
+        self.max_order_qty = max_order_qty
+        self.max_position = max_position # worst case per ticker: position plus every open order on one side filled
+        self.max_ticker_notional = max_ticker_notional # open orders, price * quantity * multiplier
+        self.max_open_notional = max_open_notional
+        self.max_gross_position = max_gross_position # sum of |position| over tickers, checked on position updates
+        self.max_open_orders = max_open_orders
+        self.collar_ticks = collar_ticks # fat finger band around the mid is max(collar_ticks ticks, collar_pct * mid)
+        self.collar_pct = collar_pct
+        self.multiplier = multiplier
+        self.lot_size = 1
+        # per ticker overrides of max_order_qty / max_position, plus lot_size: position units per order quantity unit,
+        # e.g. {"SBER": {"max_order_qty": 200, "max_position": 3000, "lot_size": 10}} for the hedger's shares
+        self.ticker_limits = ticker_limits or {}
+        self.on_breach = on_breach # called with a reason when positions end up outside the limits
+
+        self.rate = max_orders_per_second
+        self.capacity = burst or max_orders_per_second
+        self.tokens = self.capacity
+        self.tokens_time = time.monotonic()
+
+        self.books = {} # ticker -> OrderBook used as the collar reference
+        self.spot = None # SpotCache, the collar reference for tickers without a book (the underlying)
+        self.orders = {} # order id -> (ticker, is_buy, quantity, notional)
+        self.open_buy = {}
+        self.open_sell = {}
+        self.open_notional = {}
+        self.total_open_notional = 0.0
+        self.positions = {}
+        self.gross_position = 0
+        self.breached = False
+
+        self.checks = 0
+        self.rejections = {}
+
+    def set_book(self, ticker, book):
+        self.books[ticker] = book
+
+    def set_spot(self, spot):
+        self.spot = spot
+
+    def _limit(self, ticker, name):
+        limits = self.ticker_limits.get(ticker)
+        return limits.get(name, getattr(self, name)) if limits is not None else getattr(self, name)
+
+    def _reference(self, ticker):
+        book = self.books.get(ticker)
+        if book is not None:
+            return book.mid
+        return self.spot.price(ticker) if self.spot is not None else None # fresh mid or last trade
+
+    def _reject(self, reason, message):
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+        raise RiskRejected(reason, message)
+
+    def check(self, ticker, side, price, quantity, replaces=None):
+        # raises RiskRejected; `replaces` is the id of the order an edit would replace
+        self.checks += 1
+        is_buy = str(side) == '1'
+
+        max_order_qty = self._limit(ticker, "max_order_qty")
+        if quantity <= 0 or (max_order_qty is not None and quantity > max_order_qty):
+            self._reject("order_qty", f"{quantity} {ticker}")
+
+        old = self.orders.get(replaces) if replaces is not None else None
+        if old is None and self.max_open_orders is not None and len(self.orders) >= self.max_open_orders:
+            self._reject("open_orders", f"{len(self.orders)} open")
+
+        delta_qty = quantity - (old[2] if old is not None else 0)
+        max_position = self._limit(ticker, "max_position")
+        if max_position is not None:
+            position = self.positions.get(ticker, 0)
+            lot = self._limit(ticker, "lot_size")
+            if is_buy and position + (self.open_buy.get(ticker, 0) + delta_qty) * lot > max_position:
+                self._reject("position", f"buy {quantity} {ticker} with position {position}")
+            if not is_buy and position - (self.open_sell.get(ticker, 0) + delta_qty) * lot < -max_position:
+                self._reject("position", f"sell {quantity} {ticker} with position {position}")
+
+        delta_notional = price * quantity * self.multiplier - (old[3] if old is not None else 0)
+        if self.max_ticker_notional is not None and self.open_notional.get(ticker, 0) + delta_notional > self.max_ticker_notional:
+            self._reject("ticker_notional", f"{ticker} open notional over {self.max_ticker_notional}")
+        if self.max_open_notional is not None and self.total_open_notional + delta_notional > self.max_open_notional:
+            self._reject("open_notional", f"open notional over {self.max_open_notional}")
+
+        if self.collar_ticks is not None or self.collar_pct is not None:
+            mid = self._reference(ticker)
+            if mid is None:
+                self._reject("no_reference", f"no book or fresh spot to collar {ticker} at {price}")
+            band = max((self.collar_ticks or 0) * TICK_SIZE, (self.collar_pct or 0) * mid)
+            if abs(price - mid) > band:
+                self._reject("collar", f"{ticker} at {price} vs mid {mid}")
+
+        # the rate limit goes last, so rejected orders don't use up tokens
+        if self.rate is not None:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.tokens_time) * self.rate)
+            self.tokens_time = now
+            if self.tokens < 1:
+                self._reject("order_rate", f"over {self.rate} orders per second")
+            self.tokens -= 1
+
+    def on_order(self, order_id, order):
+        # new order or an updated one (edit ack, partial fill); keeps the running sums in step with active_orders
+        self.on_order_removed(order_id)
+        ticker = order["ticker"]
+        is_buy = str(order["side"]) == '1'
+        quantity = order["quantity"]
+        notional = order["price"] * quantity * self.multiplier
+        self.orders[order_id] = (ticker, is_buy, quantity, notional)
+        side = self.open_buy if is_buy else self.open_sell
+        side[ticker] = side.get(ticker, 0) + quantity
+        self.open_notional[ticker] = self.open_notional.get(ticker, 0) + notional
+        self.total_open_notional += notional
+
+    def on_order_removed(self, order_id):
+        old = self.orders.pop(order_id, None)
+        if old is None:
+            return
+        ticker, is_buy, quantity, notional = old
+        side = self.open_buy if is_buy else self.open_sell
+        side[ticker] -= quantity
+        self.open_notional[ticker] -= notional
+        self.total_open_notional -= notional
+
+    def reset_orders(self, active_orders):
+        self.orders.clear()
+        self.open_buy.clear()
+        self.open_sell.clear()
+        self.open_notional.clear()
+        self.total_open_notional = 0.0
+        for order_id, order in active_orders.items():
+            self.on_order(order_id, order)
+
+    def on_positions(self, positions):
+        # once per portfolio refresh, not on the order path
+        self.positions = dict(positions)
+        self.gross_position = sum(abs(quantity) for quantity in self.positions.values())
+
+        breaches = []
+        for ticker, quantity in self.positions.items():
+            max_position = self._limit(ticker, "max_position")
+            if max_position is not None and abs(quantity) > max_position:
+                breaches.append(f"{ticker} position {quantity}")
+        if self.max_gross_position is not None and self.gross_position > self.max_gross_position:
+            breaches.append(f"gross position {self.gross_position}")
+
+        if breaches and not self.breached:
+            logger.error("Risk limits breached", extra=fields(breaches=breaches))
+            if self.on_breach is not None:
+                self.on_breach("; ".join(breaches))
+        self.breached = bool(breaches)
+
+    def snapshot(self):
+        return {
+            "checks": self.checks,
+            "rejections": dict(self.rejections),
+            "open_orders": len(self.orders),
+            "open_notional": self.total_open_notional,
+            "gross_position": self.gross_position,
+            "breached": self.breached,
+        }
+
+    def to_prometheus(self, prefix="mm_risk"):
+        lines = [f"# TYPE {prefix}_checks_total counter", f"{prefix}_checks_total {self.checks}",
+                 f"# TYPE {prefix}_rejections_total counter"]
+        for reason, count in self.rejections.items():
+            lines.append(f'{prefix}_rejections_total{{reason="{reason}"}} {count}')
+        lines += [f"# TYPE {prefix}_open_orders gauge", f"{prefix}_open_orders {len(self.orders)}",
+                  f"# TYPE {prefix}_open_notional gauge", f"{prefix}_open_notional {self.total_open_notional}",
+                  f"# TYPE {prefix}_gross_position gauge", f"{prefix}_gross_position {self.gross_position}"]
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    from order_book import OrderBook
+
+    gate = RiskGate(max_orders_per_second=None, max_open_orders=None, max_position=10**9)
+    book = OrderBook()
+    book.set_levels([{"price": 10.0, "quantity": 5}], [{"price": 10.2, "quantity": 5}])
+    gate.set_book("SR310CG6D", book)
+
+    n = 200_000
+    start = time.perf_counter()
+    for i in range(n):
+        gate.check("SR310CG6D", '1', 10.0, 5)
+        gate.on_order(i, {"ticker": "SR310CG6D", "side": '1', "price": 10.0, "quantity": 5})
+    per_check_us = (time.perf_counter() - start) / n * 1e6
+
+    for price in (10.1, 30.0):
+        try:
+            gate.check("SR310CG6D", '2', price, 5)
+            print(f"sell at {price}: passed")
+        except RiskRejected as e:
+            print(f"sell at {price}: rejected ({e})")
+    print(f"check + bookkeeping with {n} open orders: {per_check_us:.2f} us, {gate.snapshot()}")
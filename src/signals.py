@@ -0,0 +1,81 @@
+import numpy as np
+
+FAIR_VALUE_MODES = ("mid", "microprice", "imbalance", "ewma")
+
+
+class BookSignals:
+    # updated on every order book of one ticker, each update is O(levels)
+    def __init__(self, levels=5, level_decay=0.5, alpha=0.05, warmup=20):
+        self.levels = levels
+        self.weights = level_decay ** np.arange(levels)
+        self.alpha = alpha
+        self.warmup = warmup
+
+        self.mid = None
+        self.half_spread = None
+        self.microprice = None
+        self.imbalance = 0.0
+        self.ewma_mid = None
+        self.updates = 0
+
+    def update(self, book):
+        mid = book.mid
+        if mid is None:
+            return self
+
+        n_bids = min(self.levels, book.n_bids)
+        n_asks = min(self.levels, book.n_asks)
+        bid_weighted = float(book.bid_qty[:n_bids] @ self.weights[:n_bids])
+        ask_weighted = float(book.ask_qty[:n_asks] @ self.weights[:n_asks])
+        total = bid_weighted + ask_weighted
+        self.imbalance = (bid_weighted - ask_weighted) / total if total > 0 else 0.0
+
+        self.microprice = book.microprice
+        self.half_spread = book.spread / 2
+
+        if self.ewma_mid is None:
+            self.ewma_mid = mid
+        else:
+            self.ewma_mid = (1 - self.alpha) * self.ewma_mid + self.alpha * mid
+
+        self.mid = mid
+        self.updates += 1
+        return self
+
+    @property
+    def ready(self):
+        return self.updates >= self.warmup
+
+    def fair_value(self, mode="mid"):
+        if self.mid is None:
+            return None
+        if mode == "mid":
+            return self.mid
+        if mode == "microprice":
+            return self.microprice
+        if mode == "imbalance":
+            return self.mid + self.imbalance * self.half_spread
+        if mode == "ewma":
+            return self.ewma_mid
+        raise ValueError(f"Unknown fair value mode {mode}, expected one of {FAIR_VALUE_MODES}")
+
+    def fair_value_offset(self, mode="mid"): # shift of the fair value relative to the plain mid
+        fair_value = self.fair_value(mode)
+        if fair_value is None:
+            return 0.0
+        return fair_value - self.mid
+
+
+class SignalTracker:
+    def __init__(self, **signal_kwargs):
+        self.signal_kwargs = signal_kwargs
+        self.signals = {}
+
+    def update(self, book):
+        signals = self.signals.get(book.ticker)
+        if signals is None:
+            signals = self.signals[book.ticker] = BookSignals(**self.signal_kwargs)
+        return signals.update(book)
+
+    def get(self, ticker):
+        return self.signals.get(ticker)
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+
+class SpotQuote:
+    __slots__ = ("ticker", "bid", "ask", "last", "book_time", "trade_time", "exchange_time")
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.bid = None
+        self.ask = None
+        self.last = None
+        self.book_time = None # time.monotonic() of the last book / trade update
+        self.trade_time = None
+        self.exchange_time = None # raw dateTime of the last message
+
+    @property
+    def mid(self):
+        if self.bid is None or self.ask is None:
+            return None
+        return (self.bid + self.ask) / 2
+
+    def __repr__(self):
+        return f"SpotQuote({self.ticker}, bid={self.bid}, ask={self.ask}, last={self.last}, time={self.exchange_time})"
+
+
+class SpotCache:
+    # filled by the underlying's order book / trades websocket, read synchronously by pricing and hedging code
+    def __init__(self, max_age=5.0):
+        self.max_age = max_age
+        self.quotes = {}
+        self.events = {}
+
+    def _quote(self, ticker):
+        quote = self.quotes.get(ticker)
+        if quote is None:
+            quote = self.quotes[ticker] = SpotQuote(ticker)
+        return quote
+
+    def _notify(self, ticker):
+        event = self.events.get(ticker)
+        if event is not None:
+            event.set()
+
+    def on_message(self, data):
+        response_type = data.get("responseType")
+        if response_type == "OrderBook":
+            self.on_order_book(data)
+        elif response_type == "LastTrades":
+            self.on_trade(data)
+
+    def on_order_book(self, data):
+        quote = self._quote(data["ticker"])
+        bids = data.get("bids")
+        asks = data.get("asks")
+        quote.bid = bids[0]["price"] if bids else None
+        quote.ask = asks[0]["price"] if asks else None
+        quote.book_time = time.monotonic()
+        quote.exchange_time = data.get("dateTime")
+        self._notify(quote.ticker)
+
+    def on_trade(self, data):
+        quote = self._quote(data["ticker"])
+        quote.last = data["price"]
+        quote.trade_time = time.monotonic()
+        quote.exchange_time = data.get("dateTime")
+        self._notify(quote.ticker)
+
+    def get(self, ticker):
+        return self.quotes.get(ticker)
+
+    def _fresh(self, updated_at, max_age):
+        max_age = self.max_age if max_age is None else max_age
+        return updated_at is not None and time.monotonic() - updated_at <= max_age
+
+    def mid(self, ticker, max_age=None):
+        quote = self.quotes.get(ticker)
+        if quote is None or not self._fresh(quote.book_time, max_age):
+            return None
+        return quote.mid
+
+    def last(self, ticker, max_age=None):
+        quote = self.quotes.get(ticker)
+        if quote is None or not self._fresh(quote.trade_time, max_age):
+            return None
+        return quote.last
+
+    def price(self, ticker, max_age=None): # fresh mid, otherwise fresh last trade, otherwise None
+        mid = self.mid(ticker, max_age)
+        return mid if mid is not None else self.last(ticker, max_age)
+
+    def is_stale(self, ticker, max_age=None):
+        return self.price(ticker, max_age) is None
+
+    def age(self, ticker):
+        quote = self.quotes.get(ticker)
+        if quote is None:
+            return None
+        times = [t for t in (quote.book_time, quote.trade_time) if t is not None]
+        return time.monotonic() - max(times) if times else None
+
+    async def wait_for_update(self, ticker, timeout=None):
+        event = self.events.get(ticker)
+        if event is None:
+            event = self.events[ticker] = asyncio.Event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        event.clear()
+        return True
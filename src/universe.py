@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime
+from logs import get_logger, fields
+
+logger = get_logger("universe")
+
+
+class UniverseManager:
+    # picks the options worth collecting/quoting: strikes within a moneyness band around spot for the nearest expiries
+    def __init__(self, client, catalog, underlying="SBER", underlying_class_code="TQBR", class_code="OPTSPOT",
+                 n_expiries=3, moneyness=0.15, interval=600, data_types=(0, 2)):
+        self.client = client
+        self.catalog = catalog
+        self.underlying = underlying
+        self.underlying_class_code = underlying_class_code
+        self.class_code = class_code
+        self.n_expiries = n_expiries
+        self.moneyness = moneyness
+        self.interval = interval
+        self.data_types = data_types # websocket subscriptions the universe is applied to
+        self.current = {}
+
+    def select(self, spot, today=None):
+        today = today or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        low = spot * (1 - self.moneyness)
+        high = spot * (1 + self.moneyness)
+
+        selected = {}
+        for expiry in self.catalog.expiries(after=today)[:self.n_expiries]:
+            for spec in self.catalog.by_expiry[expiry]:
+                if spec["underlying"] != self.underlying or spec["strike"] is None:
+                    continue
+                if low <= spec["strike"] <= high:
+                    selected[spec["ticker"]] = {"ticker": spec["ticker"], "classCode": spec["class_code"] or self.class_code}
+        return selected
+
+    def instruments(self):
+        return list(self.current.values())
+
+    async def get_spot(self):
+        return await self.client.get_current_price(self.underlying, self.underlying_class_code)
+
+    async def initialize(self):
+        spot = await self.get_spot()
+        if spot is None:
+            raise ValueError(f"No spot price for {self.underlying}, unable to select instruments")
+        self.current = self.select(spot)
+        logger.info("Selected instruments", extra=fields(count=len(self.current), spot=spot))
+        return self.instruments()
+
+    async def apply(self, spot):
+        selected = self.select(spot)
+        add = [instrument for ticker, instrument in selected.items() if ticker not in self.current]
+        remove = [instrument for ticker, instrument in self.current.items() if ticker not in selected]
+        if not add and not remove:
+            return add, remove
+
+        for data_type in self.data_types:
+            await self.client.update_subscriptions(data_type, add=add, remove=remove)
+        self.current = selected
+        logger.info("Universe updated", extra=fields(spot=spot, added=len(add), removed=len(remove), count=len(selected)))
+        return add, remove
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.catalog.load(self.client.session, self.client.access_token) # refetched only when the snapshot expires
+                spot = await self.get_spot()
+                if spot is not None:
+                    await self.apply(spot)
+            except Exception:
+                logger.exception("Exception while updating instruments universe")
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+import backtester
+
+
+def synthetic_dataset(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    book_times = pd.date_range("2025-01-10 10:00", periods=n, freq="s", tz="UTC")
+    mid = 10 + np.cumsum(rng.normal(0, 0.01, n))
+    option_df = pd.DataFrame({"best_bid": (mid - 0.05).round(2), "best_ask": (mid + 0.05).round(2)},
+                             index=pd.Index(book_times, name="timestamp"))
+    option_df["mid_price"] = (option_df["best_bid"] + option_df["best_ask"]) / 2
+    trade_times = book_times[::7] + pd.Timedelta(milliseconds=500)
+    sides = rng.choice(("BUY", "SELL"), len(trade_times))
+    orders_df = pd.DataFrame({"side": sides, "price": mid[::7].round(2) + np.where(sides == "BUY", 0.06, -0.06),
+                              "volume": rng.integers(1, 2000, len(trade_times))},
+                             index=pd.Index(trade_times, name="timestamp"))
+    return option_df, orders_df
+
+
+def test_cached_sweep_recomputes_metrics(tmp_path, monkeypatch):
+    datasets = {"SR310CG6D": synthetic_dataset()}
+    cache = backtester.BacktestCache(str(tmp_path))
+    first, _ = backtester.run_sweep(datasets, {"fee": [0.0, 0.01]}, cache=cache)
+    assert not first["cached"].any()
+
+    # the cached arrays stay valid when the metrics change, the summary follows the code
+    monkeypatch.setattr(backtester.metrics, "backtest_metrics", lambda *args, **kwargs: {"sharpe": 42.0})
+    second, _ = backtester.run_sweep(datasets, {"fee": [0.0, 0.01]}, cache=cache)
+    assert second["cached"].all()
+    assert (second["return"] == first["return"]).all()
+    assert (second["sharpe"] == 42.0).all()
+
+
+def test_editing_the_merge_invalidates_the_cache(tmp_path, monkeypatch):
+    datasets = {"SR310CG6D": synthetic_dataset()}
+    cache = backtester.BacktestCache(str(tmp_path))
+    backtester.run_sweep(datasets, {"fee": [0.0]}, cache=cache)
+    real_getsource = backtester.inspect.getsource
+    monkeypatch.setattr(backtester.inspect, "getsource",
+                        lambda f: real_getsource(f) + ("# edited" if f is backtester.merge_data else ""))
+    summary, _ = backtester.run_sweep(datasets, {"fee": [0.0]}, cache=cache)
+    assert not summary["cached"].any()
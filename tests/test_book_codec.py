@@ -0,0 +1,45 @@
+import random
+
+from book_codec import BookEncoder, decode_rows, from_levels
+
+
+def random_books(rng, n):
+    bids = [{"price": round(10.0 - i * 0.01, 2), "quantity": rng.randint(1, 50)} for i in range(5)]
+    asks = [{"price": round(10.05 + i * 0.01, 2), "quantity": rng.randint(1, 50)} for i in range(5)]
+    books = []
+    for _ in range(n):
+        side = rng.choice((bids, asks))
+        i = rng.randrange(len(side))
+        side[i] = {**side[i], "quantity": rng.randint(1, 50)}
+        if rng.random() < 0.1:
+            shift = rng.choice((-0.01, 0.01, 500.0)) # the last one does not fit a delta
+            bids = [{**level, "price": round(level["price"] + shift, 2)} for level in bids]
+            asks = [{**level, "price": round(level["price"] + shift, 2)} for level in asks]
+        if rng.random() < 0.05: # depth changes
+            bids = bids[:rng.randint(1, 5)] + [{"price": round(bids[0]["price"] - 0.01 * i, 2), "quantity": 1} for i in range(5, 5 + rng.randint(0, 2))]
+        books.append(([dict(level) for level in bids], [dict(level) for level in asks]))
+    return books
+
+
+def test_round_trip():
+    rng = random.Random(0)
+    books = random_books(rng, 5000)
+    encoder = BookEncoder(keyframe_interval=50)
+    rows = []
+    for bids, asks in books:
+        keyframe, payload = encoder.encode("SR310CG6D", bids, asks)
+        rows.append(("SR310CG6D", payload, keyframe))
+    decoded = [(from_levels(bids), from_levels(asks)) for row, bids, asks in decode_rows(rows)]
+    assert decoded == books
+    assert sum(keyframe for ticker, payload, keyframe in rows) < len(rows) / 5
+
+
+def test_reading_starts_at_a_keyframe():
+    rng = random.Random(1)
+    books = random_books(rng, 300)
+    encoder = BookEncoder(keyframe_interval=100)
+    rows = [("SR310CG6D",) + encoder.encode("SR310CG6D", bids, asks)[::-1] for bids, asks in books]
+    # deltas before the first keyframe are skipped, from there on every book is exact
+    start = next(i for i, row in enumerate(rows) if i > 10 and row[2])
+    decoded = [(from_levels(bids), from_levels(asks)) for row, bids, asks in decode_rows(rows[start - 10:])]
+    assert decoded == books[start:]
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from fake_broker import FakeBroker
+from mm_engine import BrokerClient
+
+
+def run_with_broker(scenario, **broker_args):
+    async def main():
+        broker = FakeBroker(**broker_args)
+        client = BrokerClient("fake", rest_url=await broker.start())
+        await client.start(warm_up=False)
+        try:
+            return await scenario(broker, client)
+        finally:
+            await client.close()
+            await broker.stop()
+    return asyncio.run(main())
+
+
+def test_lost_place_response_does_not_double_the_order():
+    async def scenario(broker, client):
+        broker.lost_rate = 1.0 # placed, but the client only sees 503
+        task = asyncio.create_task(client.place_limit_order("SR310CG6D", "OPTSPOT", '1', 10.0, 1, retry_delay=0))
+        while not broker.orders:
+            await asyncio.sleep(0)
+        broker.lost_rate = 0.0
+        return await task, dict(broker.orders)
+
+    order_id, broker_orders = run_with_broker(scenario)
+    assert list(broker_orders) == [order_id]
+
+
+def test_refused_place_is_final():
+    async def scenario(broker, client):
+        await client.place_limit_order("SR310CG6D", "OPTSPOT", '1', 10.0, 1, client_order_id="taken")
+        requests = broker.requests
+        with pytest.raises(ValueError):
+            await client.place_limit_order("SR310CG6D", "OPTSPOT", '1', 10.0, 1, client_order_id="taken")
+        return broker.requests - requests
+
+    assert run_with_broker(scenario) == 1
+
+
+def test_place_retries_are_capped():
+    async def scenario(broker, client):
+        broker.failure_rate = 1.0
+        requests = broker.requests
+        with pytest.raises(ConnectionError):
+            await client.place_limit_order("SR310CG6D", "OPTSPOT", '1', 10.0, 1, max_attempts=2, retry_delay=0)
+        return broker.requests - requests, dict(client.active_orders)
+
+    assert run_with_broker(scenario) == (2, {})
+
+
+def test_edit_of_an_unknown_order_is_not_sent():
+    async def scenario(broker, client):
+        requests = broker.requests
+        with pytest.raises(ValueError):
+            await client.edit_order("gone", 10.0, 1)
+        return broker.requests - requests
+
+    assert run_with_broker(scenario) == 0
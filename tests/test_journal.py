@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+import time
+
+from fake_broker import FakeBroker
+from journal import OrderJournal
+from mm_engine import BrokerClient
+from risk import RiskGate
+
+
+def test_recover_since_starts_from_the_last_position_snapshot(tmp_path):
+    journal = OrderJournal(str(tmp_path / "journal.sqlite"))
+    journal.record("position", ticker="SR310CG6D", quantity=3)
+    journal.record("position", ticker="SR310CG6D", quantity=8)
+    journal.record("fill", "a", ticker="SR310CG6D", side='2', price=10.0, quantity=5)
+    journal.close()
+    since = time.time() + 0.001
+    time.sleep(0.01)
+    journal = OrderJournal(journal.path)
+    journal.record("place", "b", ticker="SR310CG6D", class_code="OPTSPOT", side='1', price=10.0, quantity=2, level=1)
+    journal.record("edit", "c", orig_id="b", price=10.01, quantity=2)
+    journal.record("fill", "c", ticker="SR310CG6D", side='1', price=10.01, quantity=1)
+    journal.close()
+
+    active_orders, positions = journal.recover(since)
+    # the snapshot of 8 went in before the sell of 5, which is outside the window as well
+    assert positions == {"SR310CG6D": 9}
+    assert active_orders["c"]["level"] == 1
+    assert journal.recover()[1] == {"SR310CG6D": 4}
+
+
+def test_old_journal_gets_the_level_column(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE events (seq INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, event TEXT NOT NULL, "
+                 "client_order_id TEXT, orig_id TEXT, ticker TEXT, class_code TEXT, side TEXT, price REAL, quantity REAL, status TEXT)")
+    conn.execute("INSERT INTO events (ts, event, client_order_id, ticker, side, price, quantity) VALUES (1, 'place', 'a', 'T', '1', 1.0, 1)")
+    conn.commit()
+    conn.close()
+
+    journal = OrderJournal(path)
+    journal.record("place", "b", ticker="T", side='1', price=1.0, quantity=1, level=2)
+    journal.close()
+    active_orders, positions = journal.recover()
+    assert active_orders["a"]["level"] is None and active_orders["b"]["level"] == 2
+
+
+def test_recovery_takes_positions_from_the_portfolio(tmp_path):
+    journal = OrderJournal(str(tmp_path / "journal.sqlite"))
+    # a fill the broker never reported makes the journal think the position is far over the limit
+    journal.record("fill", "a", ticker="SR310CG6D", side='1', price=10.0, quantity=50)
+    journal.record("place", "b", ticker="SR310CG6D", class_code="OPTSPOT", side='1', price=10.0, quantity=1, level=2)
+
+    async def main():
+        broker = FakeBroker()
+        broker.orders["b"] = {"clientOrderId": "b", "ticker": "SR310CG6D", "classCode": "OPTSPOT", "side": '1',
+                              "price": 10.0, "orderQuantity": 1, "remainedQuantity": 1, "orderStatus": "0"}
+        broker.positions = {"SR310CG6D": 2}
+        client = BrokerClient("fake", rest_url=await broker.start())
+        await client.start(warm_up=False)
+        try:
+            client.journal = journal
+            client.set_risk_gate(RiskGate(max_position=10))
+            await client.recover_from_journal()
+            return client.inventory, client.killed, client.active_orders["b"]["level"]
+        finally:
+            await client.close()
+            await broker.stop()
+
+    journal.close()
+    assert asyncio.run(main()) == ({"SR310CG6D": 2}, False, 2)
@@ -0,0 +1,133 @@
+import asyncio
+
+from fake_broker import FakeBroker
+from mm_engine import BrokerClient
+
+
+def run_with_broker(scenario, **broker_args):
+    async def main():
+        broker = FakeBroker(**broker_args)
+        url = await broker.start()
+        client = BrokerClient("fake", rest_url=url, ws_url=url)
+        await client.start(warm_up=False)
+        try:
+            return await scenario(broker, client)
+        finally:
+            await client.close()
+            await broker.stop()
+    return asyncio.run(main())
+
+
+async def place(client, n):
+    await asyncio.gather(*(client.place_limit_order(f"SR{270 + 10 * (i % 5)}CG6D", "OPTSPOT", '1', 10.0, 1)
+                           for i in range(n)))
+
+
+async def wait_until(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def drop_spot_feed(broker):
+    # the server closes the socket, returns once the client is connected again
+    old = broker.market_data_ws[0]
+    await old.close()
+    await wait_until(lambda: broker.market_data_ws and broker.market_data_ws[0] is not old)
+
+
+SPOT = [{"ticker": "SBER", "classCode": "TQBR"}]
+SPOT_BOOK = {"responseType": "OrderBook", "ticker": "SBER", "bids": [{"price": 300.0, "quantity": 1}],
+             "asks": [{"price": 300.2, "quantity": 1}]}
+
+
+def test_cancel_all_flattens_the_broker():
+    async def scenario(broker, client):
+        await place(client, 40)
+        assert len(broker.orders) == 40
+        broker.failure_rate = 0.1 # every cancel gets a few retries
+        failed = await client.cancel_all()
+        return failed, dict(broker.orders), dict(client.active_orders)
+
+    failed, broker_orders, active_orders = run_with_broker(scenario, seed=3)
+    assert failed == []
+    assert broker_orders == {} and active_orders == {}
+
+
+def test_cancel_all_of_one_ticker():
+    async def scenario(broker, client):
+        await place(client, 10)
+        await client.cancel_all(ticker="SR270CG6D")
+        return {order["ticker"] for order in client.active_orders.values()}, len(broker.orders)
+
+    tickers, left = run_with_broker(scenario)
+    assert "SR270CG6D" not in tickers and left == 8
+
+
+def test_feed_loss_halts_and_flattens_until_data_is_back():
+    async def scenario(broker, client):
+        await place(client, 5)
+        await client.feed_lost("order book")
+        state = [(client.halted, len(broker.orders))]
+        client.feed_restored("order book")
+        state.append((client.halted, len(broker.orders)))
+        return state
+
+    assert run_with_broker(scenario) == [(True, 0), (False, 0)]
+
+
+def test_kill_switch_outlives_feed_recovery():
+    async def scenario(broker, client):
+        await client.kill("manual")
+        await client.feed_lost("order book")
+        client.feed_restored("order book")
+        halted_after_feed = client.halted
+        client.resume()
+        return halted_after_feed, client.halted
+
+    assert run_with_broker(scenario) == (True, False)
+
+
+def test_spot_feed_loss_halts_quoting_until_data_is_back():
+    async def scenario(broker, client):
+        client.cancel_on_disconnect = True
+        await place(client, 3)
+        task = asyncio.create_task(client.start_spot_ws(SPOT))
+        await wait_until(lambda: broker.market_data_ws)
+        await drop_spot_feed(broker)
+        await wait_until(lambda: not broker.orders)
+        halted = client.halted
+        await broker.market_data_ws[0].send_json(SPOT_BOOK)
+        await wait_until(lambda: not client.halted)
+        task.cancel()
+        return halted, client.spot.price("SBER")
+
+    assert run_with_broker(scenario) == (True, 300.1)
+
+
+def test_feed_drop_leaves_orders_alone_by_default():
+    async def scenario(broker, client):
+        await place(client, 3)
+        task = asyncio.create_task(client.start_spot_ws(SPOT))
+        await wait_until(lambda: broker.market_data_ws)
+        await drop_spot_feed(broker)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return client.halted, len(broker.orders)
+
+    assert run_with_broker(scenario) == (False, 3)
+
+
+def test_token_refresh_reconnects_without_tripping_the_kill_switch():
+    async def scenario(broker, client):
+        client.cancel_on_disconnect = True
+        await place(client, 3)
+        tasks = [asyncio.create_task(client.start_spot_ws(SPOT)), asyncio.create_task(client.start_orders_ws())]
+        await wait_until(lambda: {"spot", "orders"} <= set(client.open_ws))
+        await client.reauthenticate_websockets(timeout=5)
+        for task in tasks:
+            task.cancel()
+        return client.halted, client.expected_ws_close, len(broker.orders)
+
+    assert run_with_broker(scenario) == (False, set(), 3)
@@ -0,0 +1,31 @@
+import io
+import json
+import logging
+import logging.handlers
+import queue
+
+from logs import JsonFormatter, QueueHandler, fields
+
+
+def test_exception_keeps_its_traceback_through_the_queue():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger = logging.getLogger("test_logs")
+    logger.propagate = False
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    try:
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("Failed to edit %s", "abc", extra=fields(attempt=2))
+    finally:
+        listener.stop()
+        logger.handlers.clear()
+
+    record = json.loads(stream.getvalue())
+    assert record["msg"] == "Failed to edit abc" and record["attempt"] == 2
+    assert "ZeroDivisionError" in record["exc"]
@@ -0,0 +1,35 @@
+import numpy as np
+
+import metrics
+
+
+def result_with_one_buy():
+    # bought at 10.0 at t=0, liquidated at t=100; the only trade rows are t=0 and t=100
+    return {
+        "timestamp": np.array([0.0, 100.0]),
+        "equity": np.array([1e6, 1e6 + 5]),
+        "inventory_timestamp": np.array([0.0, 100.0]),
+        "inventory": np.array([1.0, 0.0]),
+        "mid": np.array([10.0, 10.0]),
+        "buy_timestamp": np.array([0.0]),
+        "buy_price": np.array([10.0]),
+        "buy_quantity": np.array([1.0]),
+        "sell_timestamp": np.array([100.0]),
+        "sell_price": np.array([10.0]),
+        "sell_quantity": np.array([1.0]),
+    }
+
+
+def test_markouts_use_book_updates_between_trades():
+    mid_times = np.array([0.0, 0.5, 3.0, 20.0, 100.0])
+    mids = np.array([10.0, 10.5, 11.0, 9.0, 10.0])
+    result = metrics.backtest_metrics(result_with_one_buy(), 1e6, mid_times, mids)
+    assert result["markout_1s"] == 0.5
+    assert result["markout_5s"] == 1.0
+    assert result["markout_30s"] == -1.0
+    assert result["markout_60s"] == -1.0
+
+
+def test_markouts_fall_back_to_trade_row_mids():
+    result = metrics.backtest_metrics(result_with_one_buy(), 1e6)
+    assert result["markout_1s"] == 0.0
@@ -0,0 +1,127 @@
+import random
+
+import pytest
+
+from order_diff import OrderDiffEngine
+
+
+def random_orders(rng, n_tickers, levels):
+    orders = []
+    for t in range(n_tickers):
+        for side in ('1', '2'):
+            for level in range(rng.randint(0, levels)):
+                orders.append({"ticker": f"T{t}", "class_code": "OPTSPOT", "side": side, "level": level,
+                               "price": round(rng.uniform(1, 2), 2), "quantity": rng.randint(1, 3)})
+    return orders
+
+
+def desired(ticker="T0", side='1', level=0, price=1.5, quantity=1):
+    return {"ticker": ticker, "class_code": "OPTSPOT", "side": side, "level": level, "price": price, "quantity": quantity}
+
+
+def apply(actions, active):
+    # every request acknowledged
+    for order_id in actions.cancel:
+        active.pop(order_id)
+    for order_id, new_id, d in actions.edit:
+        active.pop(order_id)
+        active[new_id] = d
+    for client_id, d in actions.place:
+        active[client_id] = d
+
+
+def test_in_flight_place_is_not_repeated():
+    engine = OrderDiffEngine(pending_timeout=3.0)
+    actions = engine.diff([desired()], {}, now=0.0)
+    assert len(actions.place) == 1
+    # not acknowledged yet, the slot is frozen
+    assert engine.diff([desired(price=1.6)], {}, now=1.0) == ([], [], [])
+    # it shows up through the orders websocket: an edit, not a second order
+    client_id = actions.place[0][0]
+    actions = engine.diff([desired(price=1.6)], {client_id: desired()}, now=2.0)
+    assert actions.place == [] and [order_id for order_id, new_id, d in actions.edit] == [client_id]
+
+
+def test_failed_edit_freezes_the_level_until_the_order_is_gone():
+    engine = OrderDiffEngine(pending_timeout=3.0)
+    active = {"a": desired()}
+    actions = engine.diff([desired(price=1.6)], active, now=0.0)
+    order_id, new_id, d = actions.edit[0]
+    engine.edit_failed(order_id, new_id, now=0.0)
+    assert engine.diff([desired(price=1.6)], active, now=1.0) == ([], [], [])
+    del active["a"]
+    actions = engine.diff([desired(price=1.6)], active, now=2.0)
+    assert len(actions.place) == 1 and actions.edit == [] and actions.cancel == []
+
+
+def test_orders_of_other_tickers_are_left_alone():
+    engine = OrderDiffEngine()
+    active = {"hedge": {"ticker": "SBER", "class_code": "TQBR", "side": '1', "price": 300.0, "quantity": 1, "level": None},
+              "stale": desired(level=3)}
+    actions = engine.diff([desired()], active)
+    assert actions.cancel == ["stale"]
+    assert "hedge" not in [order_id for order_id, new_id, d in actions.edit]
+
+
+def test_spare_quoting_the_wanted_price_takes_the_level_without_an_edit():
+    engine = OrderDiffEngine()
+    active = {"recovered": {**desired(), "level": None}}
+    assert engine.diff([desired()], active) == ([], [], [])
+    # it holds level 0 from then on: the next level is placed next to it, a new price edits it
+    actions = engine.diff([desired(), desired(level=1)], active)
+    assert len(actions.place) == 1 and actions.edit == [] and actions.cancel == []
+    actions = engine.diff([desired(price=1.6)], active)
+    assert [order_id for order_id, new_id, d in actions.edit] == ["recovered"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_randomized_invariants(seed):
+    # simulated broker that loses acks and refuses edits
+    rng = random.Random(seed)
+    for trial in range(60):
+        engine = OrderDiffEngine(pending_timeout=3.0)
+        active = {}
+        inflight = {} # id -> (order the broker shows once acknowledged, when), acks come late but within the timeout
+        now = 0.0
+        for step in range(30):
+            now += 1.0
+            actions = engine.diff(random_orders(rng, 3, 3), active, now=now)
+
+            for order_id, (order, arrival) in list(inflight.items()):
+                if arrival <= now:
+                    active[order_id] = inflight.pop(order_id)[0]
+
+            touched = [order_id for order_id, new_id, d in actions.edit] + actions.cancel
+            assert len(touched) == len(set(touched)), "an order is edited and cancelled in one round"
+            for client_id, d in actions.place:
+                slot = engine.slot(d)
+                occupants = [i for i, o in list(active.items()) + [(i, o) for i, (o, t) in inflight.items()] if engine.slot_of(o) == slot]
+                assert not [i for i in occupants if i not in actions.cancel], f"double place into {slot}"
+
+            for order_id in actions.cancel:
+                if rng.random() < 0.8:
+                    active.pop(order_id, None)
+                    engine.resolve(order_id)
+            for order_id, new_id, d in actions.edit:
+                if rng.random() < 0.15:
+                    engine.edit_failed(order_id, new_id, now=now)
+                else:
+                    active.pop(order_id, None)
+                    active[new_id] = {**d, "level": d.get("level", 0)}
+                    engine.resolve(order_id)
+                    engine.resolve(new_id)
+            for client_id, d in actions.place:
+                order = {**d, "level": d.get("level", 0)}
+                if rng.random() < 0.1: # request timed out, the order shows up later through the orders websocket
+                    inflight[client_id] = (order, now + rng.randint(1, 2))
+                else:
+                    active[client_id] = order
+                    engine.resolve(client_id)
+
+        # once every ack is in and the pending states have expired, one round converges exactly
+        active.update({order_id: order for order_id, (order, arrival) in inflight.items()})
+        target = random_orders(rng, 3, 3)
+        apply(engine.diff(target, active, now=now + 100), active)
+        want = sorted((engine.slot(d), d["price"], d["quantity"]) for d in target)
+        got = sorted((engine.slot(o), o["price"], o["quantity"]) for o in active.values())
+        assert want == got
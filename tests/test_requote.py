@@ -0,0 +1,47 @@
+from requote import RequotePolicy
+
+
+def quote(side, price, quantity, level=0):
+    return {"ticker": "SR310CC6", "class_code": "OPTSPOT", "side": side, "price": price, "quantity": quantity, "level": level}
+
+
+def live(*orders):
+    return {f"id{i}": dict(order) for i, order in enumerate(orders)}
+
+
+def test_size_reduction_is_never_suppressed():
+    policy = RequotePolicy(qty_tolerance=0.2)
+    policy.filter([quote('2', 10.05, 5)], now=0)
+    assert policy.filter([quote('2', 10.05, 4)], now=10) == [quote('2', 10.05, 4)]
+
+
+def test_small_size_increase_is_suppressed():
+    policy = RequotePolicy(qty_tolerance=0.2)
+    policy.filter([quote('2', 10.05, 5)], now=0)
+    assert policy.filter([quote('2', 10.05, 6)], now=10) is None
+
+
+def test_pulling_back_is_never_delayed():
+    policy = RequotePolicy(min_ticks=3, min_interval=5, hysteresis_ticks=3)
+    policy.filter([quote('1', 10.00, 5)], now=0)
+    policy.filter([quote('1', 10.03, 5)], now=10) # up, toward the market
+    assert policy.filter([quote('1', 10.02, 5)], now=10.1) == [quote('1', 10.02, 5)] # 1 tick back, right away
+
+
+def test_hysteresis_holds_back_small_moves_toward_the_market():
+    policy = RequotePolicy(min_ticks=1, min_interval=0, hysteresis_ticks=3)
+    policy.filter([quote('1', 10.00, 5)], now=0)
+    policy.filter([quote('1', 9.98, 5)], now=1)
+    assert policy.filter([quote('1', 9.99, 5)], now=2) is None
+
+
+def test_quote_that_is_not_live_goes_out_again_after_the_ack_timeout():
+    policy = RequotePolicy(min_ticks=1, min_interval=5, hysteresis_ticks=3, ack_timeout=2)
+    stale = live(quote('1', 10.00, 5)) # the edit to 10.05 is not acknowledged yet
+    assert policy.filter([quote('1', 10.05, 5)], now=10, active_orders=stale) == [quote('1', 10.05, 5)]
+    for now, price in ((10.1, 10.06), (10.2, 10.07), (10.3, 10.08)):
+        assert policy.filter([quote('1', price, 5)], now=now, active_orders=stale) is None
+    assert policy.snapshot()["suppressed"] == 3
+    # still not live once the ack timeout is over: rejected or dropped, so it goes out again
+    assert policy.filter([quote('1', 10.08, 5)], now=12.5, active_orders=stale) == [quote('1', 10.08, 5)]
+    assert policy.filter([quote('1', 10.09, 5)], now=15, active_orders=live(quote('1', 10.08, 5))) is None
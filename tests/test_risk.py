@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from hedger import DeltaHedger
+from order_book import OrderBook
+from risk import RiskGate, RiskRejected
+from spot_feed import SpotCache
+
+
+HEDGE_LIMITS = {"SBER": {"max_order_qty": 200, "max_position": 3000, "lot_size": 10}}
+
+
+class GatedClient:
+    # what the hedger needs from BrokerClient, with place_limit_order going through the gate like the real one
+    def __init__(self, risk, spot):
+        self.risk = risk
+        self.spot = spot
+        self.active_orders = {}
+        self.inventory = {}
+        self.placed = []
+
+    async def place_limit_order(self, ticker, class_code, side, price, quantity, level=None, client_order_id=None):
+        self.risk.check(ticker, side, price, quantity)
+        order_id = f"id{len(self.placed)}"
+        self.placed.append((ticker, side, price, quantity))
+        self.active_orders[order_id] = {"ticker": ticker, "class_code": class_code, "side": side, "price": price, "quantity": quantity}
+        return order_id
+
+
+def spot_cache(bid=300.0, ask=300.1):
+    spot = SpotCache()
+    spot.on_message({"responseType": "OrderBook", "ticker": "SBER", "bids": [{"price": bid, "quantity": 10}],
+                     "asks": [{"price": ask, "quantity": 10}], "dateTime": "2026-10-19T10:00:00Z"})
+    return spot
+
+
+def test_hedge_order_passes_the_gate():
+    spot = spot_cache()
+    risk = RiskGate(max_order_qty=20, max_position=10, max_orders_per_second=5, ticker_limits=HEDGE_LIMITS)
+    risk.set_spot(spot)
+    client = GatedClient(risk, spot)
+    options = {"SR310CC6": {"strike": 310.0, "expiry": datetime.now() + timedelta(days=30), "option_type": "call"}}
+    hedger = DeltaHedger(client, options)
+    hedger.update_positions({"SR310CC6": 10}) # ~ +400 shares of delta
+
+    asyncio.run(hedger.on_spot(300.05))
+
+    assert len(client.placed) == 1
+    ticker, side, price, quantity = client.placed[0]
+    assert (ticker, side) == ("SBER", '2') and quantity > 20 # above the option max_order_qty
+
+
+def test_underlying_without_fresh_spot_is_rejected():
+    risk = RiskGate(ticker_limits=HEDGE_LIMITS)
+    risk.set_spot(SpotCache())
+    with pytest.raises(RiskRejected) as e:
+        risk.check("SBER", '1', 300.0, 5)
+    assert e.value.reason == "no_reference"
+
+
+def test_ticker_limits_use_lot_size():
+    risk = RiskGate(max_orders_per_second=None, ticker_limits=HEDGE_LIMITS)
+    risk.set_spot(spot_cache())
+    risk.on_positions({"SBER": 2500})
+    risk.check("SBER", '1', 300.0, 50) # 2500 + 500 shares
+    with pytest.raises(RiskRejected) as e:
+        risk.check("SBER", '1', 300.0, 51)
+    assert e.value.reason == "position"
+
+
+def test_options_keep_the_default_limits_and_book_collar():
+    risk = RiskGate(max_order_qty=20, max_position=10, max_orders_per_second=None, ticker_limits=HEDGE_LIMITS)
+    book = OrderBook()
+    book.set_levels([{"price": 10.0, "quantity": 5}], [{"price": 10.2, "quantity": 5}])
+    risk.set_book("SR310CC6", book)
+    risk.check("SR310CC6", '1', 10.0, 5)
+    for price, quantity, reason in ((10.0, 21, "order_qty"), (10.0, 11, "position"), (30.0, 5, "collar")):
+        with pytest.raises(RiskRejected) as e:
+            risk.check("SR310CC6", '1', price, quantity)
+        assert e.value.reason == reason
@@ -0,0 +1,35 @@
+from mm_engine import MVPStrategy
+
+
+class StubClient:
+    risk = None
+
+
+def strategy(**kwargs):
+    strategy = MVPStrategy(StubClient(), None, "SR310CG6D", "OPTSPOT", order_size=10, inventory_limit=100, inventory_k=0, **kwargs)
+    strategy.best_bid, strategy.best_ask = 9.9, 10.1
+    strategy.inventory = 20
+    return strategy
+
+
+def test_as_quotes_take_a_zero_sigma_as_measured():
+    s = strategy()
+    for i in range(50): # a flat mid: realized volatility is 0, not missing
+        s.volatility.update(float(i), 10.0)
+    assert s.volatility.sigma == 0.0
+    assert s.generate_orders_as(gamma=0.1, tau=60) == s.generate_orders_as(gamma=0.1, tau=60, sigma=0.0)
+    assert s.generate_orders_as(gamma=0.1, tau=60) != s.generate_orders_as(gamma=0.1, tau=60, sigma=0.1)
+
+
+def test_as_quotes_fall_back_to_defaults_before_warm_up():
+    s = strategy()
+    assert s.generate_orders_as(gamma=0.1, tau=60) == s.generate_orders_as(gamma=0.1, tau=60, k=1.5, sigma=0.1)
+
+
+def test_ladder_buys_stay_within_the_inventory_limit():
+    s = strategy(levels=4, level_size_decay=1.0)
+    s.inventory = 85
+    ladder = s.ladder([{"ticker": "SR310CG6D", "class_code": "OPTSPOT", "side": '1', "price": 9.9, "quantity": 10},
+                       {"ticker": "SR310CG6D", "class_code": "OPTSPOT", "side": '2', "price": 10.1, "quantity": 10}])
+    assert [order["quantity"] for order in ladder if order["side"] == '1'] == [10, 5]
+    assert [order["quantity"] for order in ladder if order["side"] == '2'] == [10] * 4